@@ -22,9 +22,14 @@
 import inkex
 from inkex import NSS
 from inkex.base import SvgOutputMixin
-from inkex.command import inkscape
+from inkex.command import inkscape, which, INKSCAPE_EXECUTABLE_NAME
+import bisect
 import csv
 import fnmatch
+import hashlib
+import io
+import json
+import multiprocessing
 import re
 import os
 import os.path
@@ -34,6 +39,16 @@ from copy import deepcopy
 import sys
 from tempfile import mkstemp
 import subprocess
+import queue
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from collections import deque
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 NSS["cs"] = "http://www.hexandcounter.org/countersheetsextension/"
 
@@ -42,6 +57,13 @@ NSS["cs"] = "http://www.hexandcounter.org/countersheetsextension/"
 # There should be a better fix.
 BOX_MARGIN = 2.0
 
+# Attributes that refresh mode uses to recognize counters generated
+# by an earlier run: where (layer and position) and from what.
+CS_SLOT = inkex.addNS("slot", "cs")
+CS_SIGNATURE = inkex.addNS("signature", "cs")
+# Set on the layers that stand in for sheets written to their own files.
+CS_SHEETFILE = inkex.addNS("sheetfile", "cs")
+
 # Hardcoded (for now?) what DPI to use for
 # some non-vector content in exported PDF.
 PDF_DPI = 300
@@ -50,6 +72,137 @@ DEFAULT_REGISTRATION_MARK_STYLE = "stroke:#aaa"
 
 DEFAULT_FOLDING_LINE_STYLE = "stroke:#aaa;stroke-dasharray:0.9,0.15;"
 
+# Style properties that spans inherit from the text they are in, so
+# that compact_spans can leave them out where they are the same.
+INHERITED_TEXT_STYLE = frozenset(
+    [
+        "-inkscape-font-specification",
+        "color",
+        "direction",
+        "fill",
+        "fill-opacity",
+        "fill-rule",
+        "font-family",
+        "font-feature-settings",
+        "font-size",
+        "font-size-adjust",
+        "font-stretch",
+        "font-style",
+        "font-variant",
+        "font-variant-caps",
+        "font-variant-ligatures",
+        "font-variant-numeric",
+        "font-weight",
+        "letter-spacing",
+        "line-height",
+        "paint-order",
+        "stroke",
+        "stroke-dasharray",
+        "stroke-dashoffset",
+        "stroke-linecap",
+        "stroke-linejoin",
+        "stroke-miterlimit",
+        "stroke-opacity",
+        "stroke-width",
+        "text-align",
+        "text-anchor",
+        "text-rendering",
+        "visibility",
+        "white-space",
+        "word-spacing",
+        "writing-mode",
+    ]
+)
+
+GEOMETRY_CACHE_DIR = os.path.join(
+    os.path.expanduser("~"), ".countersheetsextension", "geometry"
+)
+
+# Oldest cached template geometries are removed when there are more.
+GEOMETRY_CACHE_MAX_ENTRIES = 64
+
+# Where fonts (and the fontconfig configuration) are usually installed.
+# The cached geometry of text depends on the fonts, so it is keyed on
+# the modification times of these directories and those in them.
+FONT_DIRECTORIES = [
+    "/etc/fonts",
+    "/usr/share/fonts",
+    "/usr/local/share/fonts",
+    "/Library/Fonts",
+    "/System/Library/Fonts",
+    os.path.join(os.path.expanduser("~"), ".fonts"),
+    os.path.join(os.path.expanduser("~"), ".local", "share", "fonts"),
+    os.path.join(os.path.expanduser("~"), ".config", "fontconfig"),
+    os.path.join(os.path.expanduser("~"), "Library", "Fonts"),
+    os.path.join(os.environ.get("WINDIR", "C:\\Windows"), "Fonts"),
+    os.path.join(
+        os.environ.get("LOCALAPPDATA", ""), "Microsoft", "Windows", "Fonts"
+    ),
+]
+
+GLOB_WILDCARDS = re.compile(r"[*?[]")
+
+# Matchers for the globs used in the document being generated, and
+# the ids that each has matched, with the oldest forgotten when there
+# are more, so that they do not grow with the number of counters.
+GLOB_MATCHERS = {}
+GLOB_MATCHERS_MAX_ENTRIES = 256
+GLOB_MATCHER_MAX_FOUND = 4096
+
+# Characters that can start *bold*, /italics/ or {image} markup.
+MARKUP_MARKS = re.compile(r"[*/{]")
+
+# The parsed markup and the spans made for texts that have markup are
+# kept for the texts that come again, the oldest forgotten when there
+# are more.
+MARKUP_CACHE_MAX_ENTRIES = 1024
+
+# Entries kept in each of the StyleCache tables, the oldest forgotten
+# when there are more.
+STYLE_CACHE_MAX_ENTRIES = 4096
+
+# Seconds to wait for an Inkscape shell to start, or to answer one
+# line of commands, before assuming that it hangs.
+INKSCAPE_SHELL_TIMEOUT = 300
+
+# Name (after --sheets-bitmap-name) of the export cache manifest files.
+EXPORT_MANIFEST_NAME = "countersheet-exports.json"
+
+# Export actions to use for the size flags given to export_using_inkscape.
+INKSCAPE_SIZE_ACTIONS = {
+    "-d": "export-dpi",
+    "-w": "export-width",
+    "-h": "export-height",
+}
+
+
+# What the worker processes of CountersheetEffect.pregenerate work
+# on: the effect, the placements and the template rectangles. Set
+# before the processes are forked, so they get their own copies.
+PREGENERATE = None
+
+
+def pregenerate_shard(shard):
+    """Generate the counters of a shard of sheets, (index in the
+    placements, back side or not, autonumber) for each, in a worker
+    process."""
+    effect, placements, rects = PREGENERATE
+    return [
+        effect.pregenerate_counter(placements[i], back, nr, rects)
+        for i, back, nr in shard
+    ]
+
+
+def glob_matcher(globs):
+    """The GlobMatcher for globs (any sequence), shared between all
+    users of the same globs in the same order."""
+    key = tuple(globs)
+    if key not in GLOB_MATCHERS:
+        if len(GLOB_MATCHERS) >= GLOB_MATCHERS_MAX_ENTRIES:
+            del GLOB_MATCHERS[next(iter(GLOB_MATCHERS))]
+        GLOB_MATCHERS[key] = GlobMatcher(key)
+    return GLOB_MATCHERS[key]
+
 
 def popen3(cmd):
     p = subprocess.Popen(
@@ -121,12 +274,10 @@ class Counter:
     def is_included(self, eid):
         if eid is None:
             return True
-        for iglob in self.includeids:
-            if fnmatch.fnmatchcase(eid, iglob):
-                return True
-        for eglob in self.excludeids:
-            if fnmatch.fnmatchcase(eid, eglob):
-                return False
+        if glob_matcher(self.includeids).positions(eid):
+            return True
+        if glob_matcher(self.excludeids).positions(eid):
+            return False
         return True
 
 
@@ -203,9 +354,79 @@ class RepeatMinFillSheet(Repeat):
             self.keep_going = False
 
 
-class BleedMaker:
-    def __init__(self, svg, defs):
+class DefsRegistry:
+    """The elements in defs by id, and by what they link to with
+    xlink:href, found once and then kept up to date with what is added
+    with add(). The uses of the elements added with add() are counted
+    with ref() and unref(), so that prune() can remove the ones that
+    are no longer used."""
+
+    def __init__(self, defs):
         self.defs = defs
+        self.ids = {}
+        self.hrefs = {}
+        self.added = {}
+        self.refs = {}
+        for element in defs:
+            self.index(element)
+
+    def index(self, element):
+        if not isinstance(element.tag, str):
+            return
+        eid = element.get("id")
+        if eid is not None:
+            self.ids.setdefault(eid, element)
+        href = element.get(inkex.addNS("href", "xlink"))
+        if href is not None:
+            self.hrefs.setdefault(href, element)
+
+    def get(self, eid):
+        return self.ids.get(eid)
+
+    def linking_to(self, eid):
+        return self.hrefs.get("#" + eid)
+
+    def add(self, element):
+        self.defs.append(element)
+        self.index(element)
+        self.adopt(element)
+
+    def adopt(self, element):
+        """Count the uses of element, already in defs, as if added."""
+        self.added[element.get("id")] = element
+        self.refs[element.get("id")] = 0
+
+    def ref(self, eid):
+        if eid in self.refs:
+            self.refs[eid] += 1
+
+    def unref(self, eid):
+        if eid in self.refs:
+            self.refs[eid] -= 1
+
+    def prune(self, ids=None):
+        """Remove the added elements (or only those of ids) that are
+        not used, and return their ids."""
+        unused = [
+            eid
+            for eid, n in self.refs.items()
+            if n <= 0 and (ids is None or eid in ids)
+        ]
+        for eid in unused:
+            element = self.added.pop(eid)
+            del self.refs[eid]
+            if self.ids.get(eid) is element:
+                del self.ids[eid]
+            href = element.get(inkex.addNS("href", "xlink"))
+            if href is not None and self.hrefs.get(href) is element:
+                del self.hrefs[href]
+            self.defs.remove(element)
+        return unused
+
+
+class BleedMaker:
+    def __init__(self, registry):
+        self.registry = registry
         self.bleed_added = {}
         self.unbleed = {}
 
@@ -233,10 +454,7 @@ class BleedMaker:
             bleed_down,
             bleed_right,
         )
-        existing = self.defs.xpath(
-            "svg:clipPath[@id='%s']" % name, namespaces=NSS
-        )
-        if len(existing) == 0:
+        if self.registry.get(name) is None:
             clipPath = etree.Element(inkex.addNS("clipPath", "svg"))
             clipPath.set("id", name)
             rect = etree.Element(inkex.addNS("rect", "svg"))
@@ -261,7 +479,7 @@ class BleedMaker:
             rect.set("height", str(abs(y1 - y2)))
 
             clipPath.append(rect)
-            self.defs.append(clipPath)
+            self.registry.add(clipPath)
         return name
 
     def add_bleed_to(self, counters):
@@ -278,9 +496,7 @@ class BleedMaker:
                     True,
                     True,
                 )
-                self.setclip(element, bleedclip)
-                self.bleed_added[element] = bleedclip
-                self.unbleed[bleedclip] = front_unbleed
+                self.keep(element, bleedclip, front_unbleed)
             if counter.hasback:
                 back_unbleed = self.getbleed(
                     counter.back.width,
@@ -299,9 +515,26 @@ class BleedMaker:
                         True,
                         counter.bleed_left[i],
                     )
-                    self.setclip(element, back_bleedclip)
-                    self.bleed_added[element] = back_bleedclip
-                    self.unbleed[back_bleedclip] = back_unbleed
+                    self.keep(element, back_bleedclip, back_unbleed)
+
+    def keep(self, element, bleedclip, unbleed):
+        """Clip element with bleedclip, and keep track of it for
+        hideall (that clips it with unbleed instead) and showall."""
+        self.forget([element])
+        self.setclip(element, bleedclip)
+        self.bleed_added[element] = bleedclip
+        self.unbleed[bleedclip] = unbleed
+        self.registry.ref(bleedclip)
+        self.registry.ref(unbleed)
+
+    def forget(self, elements):
+        """Stop keeping track of elements (that are no longer in the
+        document), for hideall and showall."""
+        for element in elements:
+            clip = self.bleed_added.pop(element, None)
+            if clip is not None:
+                self.registry.unref(clip)
+                self.registry.unref(self.unbleed[clip])
 
     def setclip(self, element, clip):
         element.set("clip-path", "url(#%s)" % clip)
@@ -315,6 +548,676 @@ class BleedMaker:
             self.setclip(element, clip)
 
 
+class MarkPath:
+    """Lines with the same style in a layer, drawn as a single path.
+    Lines that are the same, or that overlap or touch along the same
+    horizontal or vertical line, are drawn as one stroke."""
+
+    def __init__(self, path):
+        self.path = path
+        self.lines = set()
+
+    def add(self, x1, y1, x2, y2):
+        if (x2, y2) < (x1, y1):
+            x1, y1, x2, y2 = x2, y2, x1, y1
+        self.lines.add((x1, y1, x2, y2))
+
+    def strokes(self):
+        vertical = {}
+        horizontal = {}
+        strokes = []
+        for x1, y1, x2, y2 in self.lines:
+            if x1 == x2:
+                vertical.setdefault(x1, []).append((y1, y2))
+            elif y1 == y2:
+                horizontal.setdefault(y1, []).append((x1, x2))
+            else:
+                strokes.append((x1, y1, x2, y2))
+        strokes.sort()
+        for x, spans in sorted(vertical.items()):
+            strokes.extend((x, a, x, b) for a, b in join_spans(spans))
+        for y, spans in sorted(horizontal.items()):
+            strokes.extend((a, y, b, y) for a, b in join_spans(spans))
+        return strokes
+
+    def update(self):
+        self.path.set(
+            "d", " ".join("M %s,%s %s,%s" % s for s in self.strokes())
+        )
+
+
+class Placement:
+    """One copy of a counter in the layout: sheet and layout box
+    numbers (from 1 and 0), nr (the autonumber), position and size
+    on the sheet, and where its back goes (backx and backy are None
+    for counters without backs) and how it is rotated."""
+
+    def __init__(
+        self,
+        counter,
+        nr,
+        sheet,
+        box,
+        x,
+        y,
+        width,
+        height,
+        rotation,
+        bleed_left,
+        bleed_up,
+    ):
+        self.counter = counter
+        self.nr = nr
+        self.sheet = sheet
+        self.box = box
+        self.x = x
+        self.y = y
+        self.width = width
+        self.height = height
+        self.rotation = rotation
+        self.bleed_left = bleed_left
+        self.bleed_up = bleed_up
+        self.backx = None
+        self.backy = None
+        self.backwidth = 0
+        self.backheight = 0
+        self.backrotation = 0
+
+    def asdict(self):
+        placement = {
+            "nr": self.nr,
+            "id": self.counter.id,
+            "sheet": self.sheet,
+            "box": self.box,
+            "x": self.x,
+            "y": self.y,
+            "w": self.width,
+            "h": self.height,
+            "rotation": self.rotation,
+            "back": None,
+        }
+        if self.backx is not None:
+            placement["back"] = {
+                "id": self.counter.back.id,
+                "x": self.backx,
+                "y": self.backy,
+                "w": self.backwidth,
+                "h": self.backheight,
+                "rotation": self.backrotation,
+            }
+        return placement
+
+
+class LayoutBox:
+    """A full layout box, and where its registration marks go
+    (relative to position, the Rectangle of the box)."""
+
+    def __init__(self, sheet, box, position, xmarks, ymarks):
+        self.sheet = sheet
+        self.box = box
+        self.position = position
+        self.xmarks = xmarks
+        self.ymarks = ymarks
+
+
+class LayoutSheet:
+    """A full sheet, with the Placements on it that have backs."""
+
+    def __init__(self, number, backs):
+        self.number = number
+        self.backs = backs
+
+
+class LayoutPlanner:
+    """Decides where the counters go, without making any SVG.
+
+    plan() yields a Placement for each copy of a counter, a LayoutBox
+    when a layout box is full and a LayoutSheet when a sheet is full.
+    The Repeat of each counter is updated as it is placed. When the
+    counters run out, the last sheet is left in sheet, box, xmarks,
+    ymarks and backs.
+
+    measure(counter, rotation) returns the width and height of a
+    counter as generated with that rotation."""
+
+    def __init__(
+        self,
+        positions,
+        spacing,
+        docwidth,
+        rotation,
+        backrotation,
+        measure,
+        logwrite,
+        before_counter=None,
+    ):
+        self.positions = positions
+        self.spacing = spacing
+        self.docwidth = docwidth
+        self.rotation = rotation
+        self.backrotation = backrotation
+        self.measure = measure
+        self.logwrite = logwrite
+        self.before_counter = before_counter
+        self.nr = 0
+        self.sheet = 1
+        self.box = 0
+        self.xmarks = set([0])
+        self.ymarks = set([0])
+        self.backs = []
+        self.row = 0
+        self.colx = 0
+        self.rowy = 0
+        self.nextrowy = 0
+        self.is_first_col = True
+        self.is_first_row = True
+
+    def plan(self, counters):
+        for i, c in enumerate(counters):
+            if self.before_counter is not None:
+                self.before_counter(c)
+            for step in self.plan_counter(i, c):
+                yield step
+
+    def plan_counter(self, i, c):
+        """Steps for all copies of counter c (number i)."""
+        while c.can_add_another():
+            last_on_row = False
+            last_in_box = False
+            last_on_sheet = False
+            self.nr = self.nr + 1
+            self.logwrite(
+                "laying out counter %d (nr %d/%r, c.nr %d)"
+                " (hasback: %s)\n"
+                % (i, self.nr, c.repeat.nr, c.repeat.keep_going, c.hasback)
+            )
+            position = self.positions[self.box]
+            self.xmarks.add(self.colx)
+            self.ymarks.add(self.rowy)
+            width, height = self.measure(c, self.rotation)
+            placement = Placement(
+                c,
+                self.nr,
+                self.sheet,
+                self.box,
+                position.x + self.colx,
+                position.y + self.rowy,
+                width,
+                height,
+                self.rotation,
+                self.is_first_col or self.spacing > 0,
+                self.is_first_row or self.spacing > 0,
+            )
+            self.is_first_col = False
+            if c.hasback:
+                placement.backrotation = self.backrotation
+                self.add_back(placement)
+            yield placement
+            self.xmarks.add(self.colx + width)
+            self.colx = self.colx + width + self.spacing
+            if self.rowy + height + self.spacing > self.nextrowy:
+                self.nextrowy = self.rowy + height + self.spacing
+                self.ymarks.add(self.rowy + height)
+            if (
+                self.colx + width > position.w + BOX_MARGIN
+                or (c.endbox and not c.must_add_another())
+                or (c.endrow and not c.must_add_another())
+            ):
+                last_on_row = True
+                self.colx = 0
+                self.row = self.row + 1
+                self.rowy = self.nextrowy
+                self.logwrite("new row %d (y=%f)\n" % (self.row, self.rowy))
+                self.is_first_col = True
+                self.is_first_row = False
+                if (
+                    self.nextrowy + height > position.h + BOX_MARGIN
+                    or c.endbox
+                ):
+                    last_in_box = True
+                    last_on_sheet = self.box == len(self.positions) - 1
+                    for step in self.end_box():
+                        yield step
+            c.added_one(last_on_row, last_in_box, last_on_sheet)
+
+    def end_box(self):
+        """Steps for the end of the current layout box, and of the
+        sheet if it was the last box, and go on to the next."""
+        yield LayoutBox(
+            self.sheet,
+            self.box,
+            self.positions[self.box],
+            self.xmarks,
+            self.ymarks,
+        )
+        self.xmarks = set([0])
+        self.ymarks = set([0])
+        self.box = self.box + 1
+        self.logwrite(
+            " now at box %d of %d\n" % (self.box, len(self.positions))
+        )
+        self.row = 0
+        self.rowy = 0
+        self.nextrowy = 0
+        self.is_first_row = True
+        if self.box == len(self.positions):
+            yield LayoutSheet(self.sheet, self.backs)
+            self.sheet = self.sheet + 1
+            self.backs = []
+            self.box = 0
+
+    def add_back(self, placement):
+        """Put the back of placement where it will be behind it (on
+        the other side of the sheet)."""
+        placement.backx = self.docwidth - (placement.x + placement.width)
+        placement.backy = placement.y
+        placement.backwidth, placement.backheight = self.measure(
+            placement.counter.back, placement.backrotation
+        )
+        self.backs.append(placement)
+
+
+class ArrayLayoutPlanner(LayoutPlanner):
+    """LayoutPlanner that works out where the copies of a counter go
+    with NumPy, a layout box at a time, instead of one copy at a
+    time. The coordinates are added up in the same order as in
+    LayoutPlanner so the result is exactly the same. Counters with
+    ENDROW or ENDBOX, or with some other kind of Repeat, are laid out
+    by LayoutPlanner."""
+
+    # Which flag ends each kind of Repeat once the copies are made.
+    FILL = {
+        RepeatExact: None,
+        RepeatMinFillRow: "row",
+        RepeatMinFillBox: "box",
+        RepeatMinFillSheet: "sheet",
+    }
+
+    def plan_counter(self, i, c):
+        width, height = self.measure(c, self.rotation)
+        if (
+            c.endrow
+            or c.endbox
+            or type(c.repeat) not in self.FILL
+            or not c.repeat.keep_going
+            or width + self.spacing <= 0
+            or height + self.spacing <= 0
+        ):
+            for step in LayoutPlanner.plan_counter(self, i, c):
+                yield step
+            return
+        fill = self.FILL[type(c.repeat)]
+        first = max(c.repeat.nr - 1, 0)
+        self.logwrite(
+            "laying out counter %d (from nr %d, c.nr %d) (hasback: %s)\n"
+            % (i, self.nr + 1, c.repeat.nr, c.hasback)
+        )
+        done = 0
+        while True:
+            if fill is None:
+                box = self.box_layout(width, height, first - done + 1)
+                stop = first - done
+            else:
+                box = self.box_layout(width, height, None)
+                after = numpy.nonzero(box[fill][max(first - done, 0) :])[0]
+                stop = max(first - done, 0) + after[0] if len(after) else -1
+            if 0 <= stop < len(box["x"]):
+                for name in box:
+                    box[name] = box[name][: stop + 1]
+            for step in self.place(c, box, width, height):
+                yield step
+            done = done + len(box["x"])
+            if not c.can_add_another():
+                break
+
+    def box_layout(self, width, height, limit):
+        """Arrays with where the next copies of a counter this size go
+        in the current layout box (x, y), which of them are last on a
+        row, in the box and on the sheet, and the row each is on
+        (counted from the current row). All the copies that fit in the
+        box, or only the first limit ones."""
+        position = self.positions[self.box]
+        right = position.w + BOX_MARGIN
+        bottom = position.h + BOX_MARGIN
+        spacing = self.spacing
+
+        def steps(start, size, end):
+            # start, start + size + spacing, ... until past end,
+            # added up in the same order as LayoutPlanner does.
+            n = int(max(end - size - start, 0) // (size + spacing)) + 2
+            adds = numpy.empty(2 * n + 1)
+            adds[0] = start
+            adds[1::2] = size
+            adds[2::2] = spacing
+            return numpy.cumsum(adds)[::2]
+
+        def row(colx):
+            # x of the copies on a row, and of the copy after them.
+            xs = steps(colx, width, right)
+            return xs[: numpy.nonzero(xs[1:] + width > right)[0][0] + 2]
+
+        firstrow = row(self.colx)
+        if self.rowy + height + spacing > self.nextrowy:
+            nexty = self.rowy + height + spacing
+        else:
+            nexty = self.nextrowy
+        ys = numpy.concatenate(([self.rowy], steps(nexty, height, bottom)))
+        rows = numpy.nonzero(ys[1:] + height > bottom)[0][0] + 1
+        counts = [len(firstrow) - 1]
+        if rows > 1:
+            fullrow = row(0)
+            counts = counts + [len(fullrow) - 1] * (rows - 1)
+            x = numpy.concatenate(
+                [firstrow[:-1]] + [fullrow[:-1]] * (rows - 1)
+            )
+            nextx = numpy.concatenate(
+                [firstrow[1:]] + [fullrow[1:]] * (rows - 1)
+            )
+        else:
+            x = firstrow[:-1]
+            nextx = firstrow[1:]
+        rowof = numpy.repeat(numpy.arange(rows), counts)
+        ends = numpy.cumsum(counts) - 1
+        last_on_row = numpy.zeros(len(x), dtype=bool)
+        last_on_row[ends] = True
+        last_in_box = numpy.zeros(len(x), dtype=bool)
+        last_in_box[-1] = True
+        box = {
+            "x": x,
+            "nextx": nextx,
+            "y": ys[rowof],
+            "nexty": ys[rowof + 1],
+            "rowof": rowof,
+            "row": last_on_row,
+            "box": last_in_box,
+            "sheet": last_in_box & (self.box == len(self.positions) - 1),
+        }
+        if limit is not None:
+            for name in box:
+                box[name] = box[name][:limit]
+        return box
+
+    def place(self, c, box, width, height):
+        """Steps for the copies of c in box (from box_layout)."""
+        position = self.positions[self.box]
+        x = box["x"].tolist()
+        y = box["y"].tolist()
+        rowof = box["rowof"].tolist()
+        last_on_row = box["row"].tolist()
+        last_in_box = box["box"].tolist()
+        last_on_sheet = box["sheet"].tolist()
+        self.xmarks.update(x)
+        self.xmarks.update((box["x"] + width).tolist())
+        self.ymarks.update(y)
+        if self.rowy + height + self.spacing > self.nextrowy:
+            self.ymarks.add(self.rowy + height)
+        below = box["y"][box["rowof"] > 0] + height
+        self.ymarks.update(below.tolist())
+        for k in range(len(x)):
+            self.nr = self.nr + 1
+            if rowof[k] > 0:
+                self.is_first_row = False
+            placement = Placement(
+                c,
+                self.nr,
+                self.sheet,
+                self.box,
+                position.x + x[k],
+                position.y + y[k],
+                width,
+                height,
+                self.rotation,
+                self.is_first_col or self.spacing > 0,
+                self.is_first_row or self.spacing > 0,
+            )
+            self.is_first_col = False
+            if c.hasback:
+                placement.backrotation = self.backrotation
+                self.add_back(placement)
+            yield placement
+            if last_on_row[k]:
+                self.is_first_col = True
+                if last_in_box[k]:
+                    self.colx = 0
+                    self.row = self.row + rowof[k] + 1
+                    for step in self.end_box():
+                        yield step
+            c.added_one(last_on_row[k], last_in_box[k], last_on_sheet[k])
+        if x and not last_in_box[-1]:
+            self.row = self.row + rowof[-1]
+            if last_on_row[-1]:
+                self.row = self.row + 1
+                self.colx = 0
+                self.rowy = box["nexty"][-1].item()
+                self.nextrowy = self.rowy
+                self.is_first_row = False
+            else:
+                self.colx = box["nextx"][-1].item()
+                self.rowy = y[-1]
+                self.nextrowy = box["nexty"][-1].item()
+
+
+class SkylinePlanner(LayoutPlanner):
+    """Like LayoutPlanner, but for counters of different sizes. Instead
+    of filling rows, each copy goes where its bottom edge ends up
+    highest in the layout box, anywhere on the skyline (the lowest
+    edge of what is already placed, along the box), and with turn
+    it can also be turned 90 degrees if that fits better. ENDROW
+    continues below everything in the box.
+
+    With keep_order (for bleed) a copy is never put where there are
+    earlier copies to the right of or below it, as it would be drawn
+    on top of them, so that bleed always goes under the next counter
+    like with rows."""
+
+    @staticmethod
+    def turned(rotation, degrees):
+        """rotation turned by degrees, as an angle above -180 and up
+        to 180. Fronts are turned by 90, their backs by -90 to stay
+        behind them."""
+        turned = (rotation + degrees) % 360
+        if turned > 180:
+            turned -= 360
+        return turned
+
+    def __init__(
+        self,
+        positions,
+        spacing,
+        docwidth,
+        rotation,
+        backrotation,
+        measure,
+        logwrite,
+        before_counter=None,
+        turn=False,
+        keep_order=False,
+    ):
+        LayoutPlanner.__init__(
+            self,
+            positions,
+            spacing,
+            docwidth,
+            rotation,
+            backrotation,
+            measure,
+            logwrite,
+            before_counter,
+        )
+        self.turn = turn
+        self.keep_order = keep_order
+        self.new_box()
+
+    def new_box(self):
+        # The skyline is [x, y, width] segments, covering the box from
+        # left to right. Placed copies are also kept by their right
+        # and bottom edges, to find their neighbours.
+        self.set_skyline([[0.0, 0.0, self.positions[self.box].w]])
+        self.rights = {}
+        self.bottoms = {}
+        self.empty = True
+
+    def end_box(self):
+        for step in LayoutPlanner.end_box(self):
+            yield step
+        self.new_box()
+
+    def set_skyline(self, skyline):
+        """Use skyline, and find the deepest y at or after each of its
+        segments (for keep_order)."""
+        self.skyline = skyline
+        self.deepest = [0.0] * (len(skyline) + 1)
+        for i in range(len(skyline) - 1, -1, -1):
+            self.deepest[i] = max(skyline[i][1], self.deepest[i + 1])
+
+    def find(self, width, height):
+        """Lowest bottom edge and x and y (in the box) where something
+        width x height fits on the skyline, or None. The segments under
+        it are a window that only moves right as x does, with the
+        deepest of them first in window."""
+        position = self.positions[self.box]
+        skyline = self.skyline
+        best = None
+        window = deque()
+        j = 0
+        for i, (x, y, w) in enumerate(skyline):
+            if x + width > position.w + BOX_MARGIN:
+                break
+            while window and window[0] < i:
+                window.popleft()
+            j = max(j, i)
+            while j < len(skyline) and skyline[j][0] < x + width:
+                while window and skyline[window[-1]][1] <= skyline[j][1]:
+                    window.pop()
+                window.append(j)
+                j = j + 1
+            if window:
+                y = max(y, skyline[window[0]][1])
+            if y + height > position.h + BOX_MARGIN:
+                continue
+            if self.keep_order and self.deepest[j] > y:
+                continue
+            if best is None or (y + height, x) < best[:2]:
+                best = (y + height, x, y)
+        return best
+
+    def find_spot(self, c):
+        """Where the next copy of c would go in the box, as x, y,
+        rotation, width and height, or None if it does not fit."""
+        rotations = [self.rotation]
+        if self.turn:
+            rotations.append(self.turned(self.rotation, 90))
+        best = None
+        for rotation in rotations:
+            width, height = self.measure(c, rotation)
+            found = self.find(width, height)
+            if found is not None and (best is None or found < best[0]):
+                best = (found, rotation, width, height)
+        if best is None:
+            return None
+        (bottom, x, y), rotation, width, height = best
+        return x, y, rotation, width, height
+
+    def add(self, x, y, width, height):
+        """Raise the skyline to below a copy placed at x, y."""
+        boxwidth = self.skyline[-1][0] + self.skyline[-1][2]
+        right = min(x + width + self.spacing, boxwidth)
+        skyline = []
+        for sx, sy, sw in self.skyline:
+            if sx < x:
+                skyline.append([sx, sy, min(sw, x - sx)])
+            if sx + sw > right:
+                start = max(sx, right)
+                skyline.append([start, sy, sx + sw - start])
+        skyline.append([x, y + height + self.spacing, right - x])
+        skyline.sort()
+        joined = [skyline[0]]
+        for segment in skyline[1:]:
+            if segment[1] == joined[-1][1]:
+                joined[-1][2] += segment[2]
+            else:
+                joined.append(segment)
+        self.set_skyline(joined)
+        edge = round(x + width, 6)
+        self.rights.setdefault(edge, []).append((y, y + height))
+        edge = round(y + height, 6)
+        self.bottoms.setdefault(edge, []).append((x, x + width))
+        self.empty = False
+
+    def touches(self, edges, edge, start, end):
+        """If something placed has an edge at edge, between start and
+        end."""
+        for first, last in edges.get(round(edge, 6), []):
+            if first < end and last > start:
+                return True
+        return False
+
+    def plan(self, counters):
+        for i, c in enumerate(counters):
+            if self.before_counter is not None:
+                self.before_counter(c)
+            while c.can_add_another():
+                self.nr = self.nr + 1
+                self.logwrite(
+                    "packing counter %d (nr %d/%r, c.nr %d)"
+                    " (hasback: %s)\n"
+                    % (i, self.nr, c.repeat.nr, c.repeat.keep_going, c.hasback)
+                )
+                spot = self.find_spot(c)
+                if spot is None and not self.empty:
+                    for step in self.end_box():
+                        yield step
+                    spot = self.find_spot(c)
+                if spot is None:
+                    # Too large for an empty box, so in the corner.
+                    width, height = self.measure(c, self.rotation)
+                    spot = (0.0, 0.0, self.rotation, width, height)
+                x, y, rotation, width, height = spot
+                position = self.positions[self.box]
+                placement = Placement(
+                    c,
+                    self.nr,
+                    self.sheet,
+                    self.box,
+                    position.x + x,
+                    position.y + y,
+                    width,
+                    height,
+                    rotation,
+                    self.spacing > 0
+                    or not self.touches(self.rights, x, y, y + height),
+                    self.spacing > 0
+                    or not self.touches(self.bottoms, y, x, x + width),
+                )
+                if c.hasback:
+                    placement.backrotation = self.backrotation
+                    if rotation != self.rotation:
+                        placement.backrotation = self.turned(
+                            self.backrotation, -90
+                        )
+                    self.add_back(placement)
+                yield placement
+                self.add(x, y, width, height)
+                self.xmarks.update([x, x + width])
+                self.ymarks.update([y, y + height])
+                ending = not c.must_add_another()
+                if c.endrow and ending:
+                    deepest = self.deepest[0]
+                    self.set_skyline(
+                        [[sx, deepest, sw] for sx, sy, sw in self.skyline]
+                    )
+                following = self.find_spot(c)
+                last_in_box = following is None or (c.endbox and ending)
+                last_on_row = last_in_box or following[1] > y
+                last_on_sheet = (
+                    last_in_box and self.box == len(self.positions) - 1
+                )
+                if c.endbox and ending:
+                    for step in self.end_box():
+                        yield step
+                c.added_one(last_on_row, last_in_box, last_on_sheet)
+
+
 class NoSetting:
     def applyto(self, counter):
         pass
@@ -377,6 +1280,906 @@ class Rectangle:
         self.h = h
 
 
+class StyleCache:
+    """Style attributes parsed, edited and written once for each
+    distinct source string, instead of again for every copy of a
+    template. The parsed styles are shared, so they must not be
+    changed."""
+
+    def __init__(self):
+        self.parsed = {}
+        self.replaced = {}
+        self.merged = {}
+
+    def remember(self, table, key, value):
+        if len(table) >= STYLE_CACHE_MAX_ENTRIES:
+            del table[next(iter(table))]
+        table[key] = value
+        return value
+
+    def parse(self, source):
+        if source in self.parsed:
+            return self.parsed[source]
+        return self.remember(
+            self.parsed, source, inkex.Style.parse_str(source)
+        )
+
+    def replace(self, source, pname, value):
+        """source with pname set to value (see stylereplace)."""
+        key = (source, pname, value)
+        if key in self.replaced:
+            return self.replaced[key]
+        return self.remember(
+            self.replaced, key, stylereplace(source, pname, value)
+        )
+
+    def merge(self, source, other):
+        """source with the properties in other added or changed."""
+        key = (source, other)
+        if key in self.merged:
+            return self.merged[key]
+        combined = dict(self.parse(source))
+        combined.update(self.parse(other))
+        return self.remember(self.merged, key, str(inkex.Style(combined)))
+
+
+class TextMarkup:
+    """The *bold*, /italics/ and {image} markup in a text, found in one
+    pass over it, as a tree of the spans setFormattedText makes for
+    it. The nodes are ("text", text), ("image", before, filename, rest)
+    and ("style", before, style, value, tag, inside, rest), where
+    before is a "text" or "image" node.
+
+    Marks that are not paired up, or bold and italics that overlap,
+    leave the text as it is, apart from images."""
+
+    def __init__(self, text):
+        self.text = text
+        self.stars = []
+        self.slashes = []
+        self.images = []
+        opening = None
+        for i, ch in enumerate(text):
+            if ch == "*":
+                self.stars.append(i)
+            elif ch == "/":
+                self.slashes.append(i)
+            elif ch == "{":
+                opening = i
+            elif ch == "}":
+                if opening is not None and i > opening + 1:
+                    self.images.append((opening, i))
+                opening = None
+        self.imagestarts = [start for start, end in self.images]
+        self.tree = self.formatted(0, len(text))
+
+    def first_two(self, marks, start, end):
+        """Where the first two of marks are in text[start:end], as
+        str.find would find them there, -1 if missing."""
+        i = bisect.bisect_left(marks, start)
+        if i == len(marks) or marks[i] >= end:
+            return -1, -1
+        if i + 1 == len(marks) or marks[i + 1] >= end:
+            return marks[i] - start, -1
+        return marks[i] - start, marks[i + 1] - start
+
+    def formatted(self, start, end):
+        first_bold, second_bold = self.first_two(self.stars, start, end)
+        first_italics, second_italics = self.first_two(
+            self.slashes, start, end
+        )
+        skip = (
+            first_italics > first_bold
+            and second_bold > first_italics
+            and second_italics > second_bold
+            or first_bold > first_italics
+            and second_italics > first_bold
+            and second_bold > second_italics
+        )
+        if first_bold >= 0 and second_bold < 0:
+            skip = True
+        if first_italics >= 0 and second_italics < 0:
+            skip = True
+        if (
+            not skip
+            and first_bold >= 0
+            and second_bold > first_bold
+            and (first_italics < 0 or first_bold < first_italics)
+        ):
+            return self.styled(
+                start, first_bold, second_bold, end, "font-weight", "bold", "b"
+            )
+        elif (
+            not skip
+            and first_italics >= 0
+            and second_italics > first_italics
+            and (first_bold < 0 or first_italics < first_bold)
+        ):
+            return self.styled(
+                start,
+                first_italics,
+                second_italics,
+                end,
+                "font-style",
+                "italic",
+                "i",
+            )
+        return self.with_images(start, end)
+
+    def styled(self, start, begin, finish, end, style, value, tag):
+        return (
+            "style",
+            self.with_images(start, start + begin),
+            style,
+            value,
+            tag,
+            self.formatted(start + begin + 1, start + finish),
+            self.formatted(start + finish + 1, end),
+        )
+
+    def with_images(self, start, end):
+        i = bisect.bisect_left(self.imagestarts, start)
+        if i < len(self.images) and self.images[i][1] < end:
+            begin, finish = self.images[i]
+            return (
+                "image",
+                self.text[start:begin],
+                self.text[begin + 1 : finish],
+                self.formatted(finish + 1, end),
+            )
+        return ("text", self.text[start:end])
+
+
+class TemplatePlan:
+    """What generatecounter needs to know about one counter part (a
+    template rectangle and the top level group it is in), worked
+    out once and then used for every counter with that part.
+
+    Elements in a copy of the group are found by their position in
+    group.iter(), which is the same in the copy."""
+
+    TEXTISH_TAGS = [
+        inkex.addNS("text", "svg"),
+        inkex.addNS("flowSpan", "svg"),
+        inkex.addNS("flowRoot", "svg"),
+    ]
+
+    def __init__(self, group, rectname, killrect, rectangle, offset):
+        self.group = group
+        self.x = rectangle.x
+        self.y = rectangle.y
+        self.width = rectangle.w
+        self.height = rectangle.h
+        self.offset = offset
+        nodes = list(group.iter())
+        self.killindex = None
+        if killrect:
+            for i, node in enumerate(nodes):
+                if (
+                    node.tag == inkex.addNS("rect", "svg")
+                    and node.get("id") == rectname
+                ):
+                    self.killindex = i
+                    break
+        self.textish = [
+            i
+            for tag in self.TEXTISH_TAGS
+            for i, node in enumerate(nodes)
+            if node.tag == tag
+        ]
+        self.images = self.indices_of(nodes, inkex.addNS("image", "svg"))
+        self.uses = self.indices_of(nodes, inkex.addNS("use", "svg"))
+        self.percent = [i for i, node in enumerate(nodes) if has_percent(node)]
+        self.ids = [node.get("id") for node in nodes if node.get("id")]
+        self.source = None
+        self.dependencies = {}
+
+    @staticmethod
+    def indices_of(nodes, tag):
+        return [i for i, node in enumerate(nodes) if node.tag == tag]
+
+    def copy(self):
+        """Return a deep copy of the group, and a list of all its
+        nodes, in the same order as group.iter()."""
+        clone = deepcopy(self.group)
+        return clone, list(clone.iter())
+
+    def digest(self):
+        """Hex digest of the group, changed if the template is."""
+        if self.source is None:
+            self.source = etree.tostring(self.group, encoding="unicode")
+        return hashlib.sha1(self.source.encode("utf8")).hexdigest()
+
+    def depends_on(self, name):
+        """Whether a substitution for name (an id glob or a %name%
+        to replace) can change a copy of the group."""
+        if name not in self.dependencies:
+            if self.source is None:
+                self.digest()
+            matcher = glob_matcher([name])
+            self.dependencies[name] = (
+                any(matcher.positions(i) for i in self.ids)
+                or "%%%s%%" % name in self.source
+            )
+        return self.dependencies[name]
+
+
+class DocumentIndex:
+    """The elements in a document by id, and its layers in document
+    order, found in one pass over the document. It is kept up to date
+    with add(), remove() and set_id() as layers and counters are added,
+    so that they can be found without searching the whole document."""
+
+    def __init__(self, root):
+        self.ids = {}
+        self.layers = []
+        # How many times find() did not find anything.
+        self.misses = 0
+        self.add(root)
+
+    def add(self, element):
+        """Add element, and what is in it, that has just been put last
+        in the document."""
+        for e in element.iter(etree.Element):
+            eid = e.get("id")
+            if eid is not None:
+                self.ids.setdefault(eid, []).append(e)
+            if is_layer(e):
+                self.layers.append(e)
+
+    def remove(self, element):
+        for e in element.iter(etree.Element):
+            self.forget_id(e)
+            if is_layer(e):
+                self.layers.remove(e)
+
+    def forget_id(self, element):
+        found = self.ids.get(element.get("id"), [])
+        if element in found:
+            found.remove(element)
+
+    def set_id(self, element, eid):
+        self.forget_id(element)
+        element.set("id", eid)
+        self.ids.setdefault(eid, []).append(element)
+
+    def find(self, eid):
+        """The first element with id eid, or None."""
+        found = self.ids.get(eid)
+        if found:
+            return found[0]
+        self.misses += 1
+        return None
+
+    def find_all(self, eid):
+        return list(self.ids.get(eid, []))
+
+
+class GlobMatcher:
+    """Finds which of a list of globs (as in fnmatch.fnmatchcase)
+    an element id matches. Globs without wildcards are looked up
+    in a dict, globs that are a plain prefix followed by * are
+    looked up in a prefix trie, and other globs are compiled to
+    regular expressions. The results for the latest ids are
+    remembered. Use glob_matcher to share matchers for the same globs."""
+
+    def __init__(self, globs):
+        self.globs = list(globs)
+        self.literals = {}
+        self.prefixes = {}
+        self.patterns = []
+        self.found = {}
+        for position, glob in enumerate(self.globs):
+            if glob is None:
+                continue
+            if not GLOB_WILDCARDS.search(glob):
+                self.literals.setdefault(glob, []).append(position)
+            elif glob.endswith("*") and not GLOB_WILDCARDS.search(glob[:-1]):
+                node = self.prefixes
+                for ch in glob[:-1]:
+                    node = node.setdefault(ch, {})
+                node.setdefault(None, []).append(position)
+            else:
+                self.patterns.append(
+                    (position, re.compile(fnmatch.translate(glob)).match)
+                )
+
+    def positions(self, element_id):
+        """Positions (in the list of globs) of the globs that
+        element_id matches, in order."""
+        if element_id in self.found:
+            return self.found[element_id]
+        found = list(self.literals.get(element_id, []))
+        node = self.prefixes
+        found.extend(node.get(None, []))
+        for ch in element_id:
+            node = node.get(ch)
+            if node is None:
+                break
+            found.extend(node.get(None, []))
+        for position, match in self.patterns:
+            if match(element_id):
+                found.append(position)
+        found.sort()
+        if len(self.found) >= GLOB_MATCHER_MAX_FOUND:
+            del self.found[next(iter(self.found))]
+        self.found[element_id] = found
+        return found
+
+
+class GeometryCache:
+    """Keeps results of queryAll on disk, so that Inkscape does not
+    have to be started again to measure a template that has not
+    changed since the last run.
+
+    Entries are keyed on the content of the SVG file, the document
+    scale, the installed fonts (fontstamp, from font_directories_stamp,
+    taken once per run) and the Inkscape version. Since the extension is run
+    by the Inkscape that it then calls to query the geometry,
+    the version of the bundled inkex library together with the
+    location and timestamp of the Inkscape executable is used as
+    the Inkscape version, to avoid starting Inkscape just to
+    ask for it."""
+
+    def __init__(self, directory, logwrite, fontstamp):
+        self.directory = directory
+        self.logwrite = logwrite
+        self.fontstamp = fontstamp
+        self.hits = 0
+        self.misses = 0
+
+    def key(self, filename, xscale, yscale):
+        h = hashlib.sha1()
+        with open(filename, "rb") as f:
+            for chunk in iter(lambda: f.read(1 << 16), b""):
+                h.update(chunk)
+        h.update(
+            ("\n%r %r\n%s" % (xscale, yscale, inkscape_version_key())).encode(
+                "utf-8"
+            )
+        )
+        h.update(self.fontstamp.encode("utf-8"))
+        return h.hexdigest()
+
+    def entry_filename(self, key):
+        return os.path.join(self.directory, key + ".json")
+
+    def get(self, key):
+        """Return cached geometry (dict of Rectangle) or None."""
+        try:
+            with open(self.entry_filename(key), "rt", encoding="utf-8") as f:
+                data = json.load(f)
+            geometry = {}
+            for element_id, (x, y, w, h) in data.items():
+                geometry[element_id] = Rectangle(x, y, w, h)
+        except (OSError, ValueError, TypeError) as e:
+            self.misses += 1
+            self.logwrite("geometry cache miss %s (%s)\n" % (key, e))
+            return None
+        self.hits += 1
+        self.logwrite("geometry cache hit %s\n" % key)
+        return geometry
+
+    def put(self, key, geometry):
+        data = {}
+        for element_id, r in geometry.items():
+            data[element_id] = [r.x, r.y, r.w, r.h]
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            fd, tmpname = mkstemp(".tmp", "geometry", self.directory, True)
+            with os.fdopen(fd, "wt", encoding="utf-8") as f:
+                json.dump(data, f)
+            os.replace(tmpname, self.entry_filename(key))
+            self.prune()
+        except OSError as e:
+            self.logwrite("Failed to write geometry cache: %s\n" % e)
+
+    def prune(self):
+        entries = [
+            os.path.join(self.directory, name)
+            for name in os.listdir(self.directory)
+            if name.endswith(".json") and name != "stats.json"
+        ]
+        entries.sort(key=os.path.getmtime)
+        for old in entries[:-GEOMETRY_CACHE_MAX_ENTRIES]:
+            os.remove(old)
+
+    def log_statistics(self):
+        """Log hits and misses for this run, and in total for all
+        runs using the same cache directory."""
+        statsfile = os.path.join(self.directory, "stats.json")
+        try:
+            with open(statsfile, "rt", encoding="utf-8") as f:
+                stats = json.load(f)
+        except (OSError, ValueError):
+            stats = {"hits": 0, "misses": 0}
+        stats["hits"] = stats.get("hits", 0) + self.hits
+        stats["misses"] = stats.get("misses", 0) + self.misses
+        self.logwrite(
+            "geometry cache: %d hits, %d misses "
+            "(all runs: %d hits, %d misses)\n"
+            % (self.hits, self.misses, stats["hits"], stats["misses"])
+        )
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            with open(statsfile, "wt", encoding="utf-8") as f:
+                json.dump(stats, f)
+        except OSError as e:
+            self.logwrite("Failed to write geometry cache stats: %s\n" % e)
+
+
+class GeometryUnsupported(Exception):
+    pass
+
+
+class NativeGeometry:
+    """Geometry Rectangle (x, y, w, h) for element ids, computed
+    from the document tree (with inkex shape bounding boxes as basis)
+    instead of by asking Inkscape. Works like the dict returned
+    by queryAll. Rectangles are visual bounding boxes (including
+    stroke), in user units, relative to the top-left of the page,
+    like what Inkscape returns.
+
+    Elements that can not be measured here (text, clipped
+    or filtered objects and so on) are looked up in the result
+    of the fallback function instead, that is only called
+    (once) if needed.
+
+    Only raw attribute values are read. Getting the transform
+    or style of an element through inkex rewrites the attribute,
+    and that would change the templates in the output."""
+
+    def __init__(self, svg, fallback, logwrite):
+        self.fallback = fallback
+        self.fallback_geometry = None
+        self.logwrite = logwrite
+        self.boxes = {}
+        self.elements = {}
+        for element in svg.iter():
+            element_id = element.attrib.get("id")
+            if element_id is not None and element_id not in self.elements:
+                self.elements[element_id] = element
+        self.origin = (0.0, 0.0)
+        viewbox = svg.attrib.get("viewBox")
+        if viewbox:
+            try:
+                values = re.sub(" +|, +|,", " ", viewbox).strip().split(" ")
+                self.origin = (float(values[0]), float(values[1]))
+            except (ValueError, IndexError):
+                pass
+
+    def __getitem__(self, element_id):
+        if element_id not in self.boxes:
+            self.boxes[element_id] = self.measure(element_id)
+        return self.boxes[element_id]
+
+    def measure(self, element_id):
+        element = self.elements.get(element_id)
+        if element is not None:
+            try:
+                box = self.visual_box(
+                    element, raw_composed_transform(element.getparent())
+                )
+            except GeometryUnsupported as e:
+                self.logwrite(
+                    "native geometry not possible for %s: %s\n"
+                    % (element_id, e)
+                )
+            else:
+                if box is not None:
+                    r = Rectangle(
+                        box.left - self.origin[0],
+                        box.top - self.origin[1],
+                        box.width,
+                        box.height,
+                    )
+                    self.logwrite(
+                        "native geometry %s %f,%f %fx%f\n"
+                        % (element_id, r.x, r.y, r.w, r.h)
+                    )
+                    return r
+        if self.fallback_geometry is None:
+            self.logwrite("native geometry falling back on queryAll\n")
+            self.fallback_geometry = self.fallback()
+        return self.fallback_geometry[element_id]
+
+    def visual_box(self, element, transform):
+        """Visual bounding box of element, with transform being
+        the composed transform of its parent. None for elements
+        that are not drawn."""
+        if not isinstance(element, inkex.ShapeElement):
+            return None
+        if raw_style_value(element, "display") == "none":
+            return None
+        if element.attrib.get("class"):
+            raise GeometryUnsupported("class (CSS stylesheet)")
+        for unsupported in ("clip-path", "mask", "filter"):
+            if raw_style_value(element, unsupported, "none") != "none":
+                raise GeometryUnsupported(unsupported)
+        transform = transform @ raw_transform(element)
+        if isinstance(element, (inkex.Group, inkex.Anchor)):
+            box = None
+            for child in element:
+                child_box = self.visual_box(child, transform)
+                if child_box is not None:
+                    box = child_box if box is None else box + child_box
+            return box
+        elif isinstance(element, inkex.Use):
+            target = self.elements.get(
+                (element.attrib.get(inkex.addNS("href", "xlink")) or "")[1:]
+            )
+            if target is None or isinstance(target, inkex.Symbol):
+                raise GeometryUnsupported("clone of %r" % target)
+            transform = transform @ inkex.Transform(
+                translate=(
+                    inkex.units.convert_unit(element.get("x", "0"), "px"),
+                    inkex.units.convert_unit(element.get("y", "0"), "px"),
+                )
+            )
+            return self.visual_box(target, transform)
+        elif isinstance(element, inkex.Image):
+            return element.path.transform(transform).bounding_box()
+        elif isinstance(element, NATIVE_GEOMETRY_SHAPES):
+            for marker in NATIVE_GEOMETRY_MARKERS:
+                if raw_style_value(element, marker, "none", True) != "none":
+                    raise GeometryUnsupported(marker)
+            path = element.path.to_absolute().transform(transform)
+            box = path.bounding_box()
+            stroke = raw_style_value(element, "stroke", "none", True)
+            if box is None or stroke == "none":
+                return box
+            stroke_width = raw_style_value(element, "stroke-width", "1", True)
+            if stroke_width.endswith("%"):
+                raise GeometryUnsupported("stroke-width %s" % stroke_width)
+            matrix = transform.matrix
+            determinant = (
+                matrix[0][0] * matrix[1][1] - matrix[0][1] * matrix[1][0]
+            )
+            scale = abs(determinant) ** 0.5
+            half = inkex.units.convert_unit(stroke_width, "px") * scale / 2.0
+            return inkex.BoundingBox(
+                (box.left - half, box.right + half),
+                (box.top - half, box.bottom + half),
+            )
+        raise GeometryUnsupported(element.tag)
+
+
+class InkscapeShellError(Exception):
+    pass
+
+
+class InkscapeShell:
+    """A long-running "inkscape --shell" process, so that Inkscape
+    does not have to be started again (and load the document
+    again) for every query or export. Each line sent to the
+    shell is a list of Inkscape actions, and the answer is
+    whatever Inkscape printed before showing its prompt again.
+    If Inkscape exits or does not answer in time it is killed,
+    and a new one is started for the next line."""
+
+    PROMPT = b"> "
+
+    def __init__(self, logwrite, command=None, timeout=INKSCAPE_SHELL_TIMEOUT):
+        self.command = command
+        self.logwrite = logwrite
+        self.timeout = timeout
+        self.process = None
+        self.output = None
+        self.reader = None
+
+    def start(self):
+        try:
+            if self.command is None:
+                self.command = [which(INKSCAPE_EXECUTABLE_NAME), "--shell"]
+        except inkex.command.CommandNotFound as e:
+            raise InkscapeShellError(str(e))
+        self.logwrite("starting inkscape shell %r\n" % self.command)
+        try:
+            self.process = subprocess.Popen(
+                self.command,
+                stdin=subprocess.PIPE,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.DEVNULL,
+            )
+        except OSError as e:
+            self.process = None
+            raise InkscapeShellError("failed to start inkscape shell: %s" % e)
+        self.output = queue.Queue()
+        self.reader = threading.Thread(
+            target=read_chunks, args=(self.process.stdout, self.output)
+        )
+        self.reader.daemon = True
+        self.reader.start()
+        self.read_answer()
+
+    def read_answer(self):
+        answer = b""
+        deadline = time.monotonic() + self.timeout
+        while not (answer == self.PROMPT or answer.endswith(b"\n> ")):
+            try:
+                chunk = self.output.get(
+                    timeout=max(deadline - time.monotonic(), 0)
+                )
+            except queue.Empty:
+                self.kill()
+                raise InkscapeShellError(
+                    "inkscape shell did not answer in %d seconds"
+                    % self.timeout
+                )
+            if chunk is None:
+                self.kill()
+                raise InkscapeShellError("inkscape shell exited")
+            answer += chunk
+        return answer[: -len(self.PROMPT)].decode("utf-8", "replace")
+
+    def run(self, actions):
+        """Run actions (a list of strings, like "export-do" or
+        "export-id:someid"), return the output."""
+        line = "; ".join(actions)
+        if ";" in "".join(actions) or "\n" in line:
+            raise InkscapeShellError("can not send to shell: %r" % actions)
+        if self.process is None or self.process.poll() is not None:
+            self.start()
+        self.logwrite("inkscape shell: %s\n" % line)
+        try:
+            self.process.stdin.write((line + "\n").encode("utf-8"))
+            self.process.stdin.flush()
+        except OSError as e:
+            self.kill()
+            raise InkscapeShellError("failed to write to inkscape: %s" % e)
+        return self.read_answer()
+
+    def kill(self):
+        if self.process is not None:
+            self.process.kill()
+            self.close()
+
+    def close(self):
+        if self.process is None:
+            return
+        try:
+            self.process.stdin.write(b"quit\n")
+            self.process.stdin.close()
+        except OSError:
+            pass
+        try:
+            self.process.wait(10)
+        except subprocess.TimeoutExpired:
+            self.process.kill()
+            self.process.wait()
+        self.process = None
+        self.reader.join(10)
+        self.reader = None
+
+
+class InkscapeShellPool:
+    """A number of InkscapeShell, each used by one thread at a time.
+    A job (lines of actions, usually starting with file-open) that
+    fails is run once more from the start, in a restarted shell."""
+
+    def __init__(self, size, logwrite, command=None, timeout=None):
+        if timeout is None:
+            timeout = INKSCAPE_SHELL_TIMEOUT
+        self.logwrite = logwrite
+        self.shells = [
+            InkscapeShell(logwrite, command, timeout) for i in range(size)
+        ]
+        self.idle = queue.Queue()
+        for shell in self.shells:
+            self.idle.put(shell)
+
+    def __len__(self):
+        return len(self.shells)
+
+    def run(self, lines):
+        """Run lines (each a list of actions) in one shell. Returns the
+        output for each line."""
+        shell = self.idle.get()
+        try:
+            try:
+                return [shell.run(actions) for actions in lines]
+            except InkscapeShellError as e:
+                self.logwrite("%s, trying again\n" % e)
+                shell.kill()
+                return [shell.run(actions) for actions in lines]
+        finally:
+            self.idle.put(shell)
+
+    def close(self):
+        for shell in self.shells:
+            shell.close()
+
+
+class ExportScheduler:
+    """Runs export jobs (functions that run Inkscape) in a number of
+    worker threads. Each job waits for its own Inkscape process,
+    so up to that many Inkscape processes run at the same time.
+    With one worker each job runs when it is submitted. A temporary
+    file (snapshot) that jobs use is removed when it has been released
+    and the last job using it is done, or else when all jobs are
+    done."""
+
+    def __init__(self, workers, logwrite):
+        self.logwrite = logwrite
+        self.executor = None
+        if workers > 1:
+            self.executor = ThreadPoolExecutor(workers)
+        self.jobs = []
+        # Snapshot filename: number of jobs (and the one who added it,
+        # until released) still using it.
+        self.snapshots = {}
+        self.lock = threading.Lock()
+        self.started = time.monotonic()
+
+    def add_snapshot(self, filename):
+        with self.lock:
+            self.snapshots[filename] = 1
+
+    def release_snapshot(self, filename):
+        """No more jobs will be submitted using filename."""
+        with self.lock:
+            self.snapshots[filename] -= 1
+            done = self.snapshots[filename] == 0
+            if done:
+                del self.snapshots[filename]
+        if done and os.path.exists(filename):
+            os.remove(filename)
+
+    def submit(self, name, function, *args, snapshots=()):
+        """Run function(*args), that uses the files in snapshots."""
+        with self.lock:
+            for filename in snapshots:
+                self.snapshots[filename] += 1
+        if self.executor is None:
+            self.logwrite(self.run_timed(name, function, args, snapshots))
+        else:
+            self.jobs.append(
+                self.executor.submit(
+                    self.run_timed, name, function, args, snapshots
+                )
+            )
+
+    def run_timed(self, name, function, args, snapshots=()):
+        started = time.monotonic()
+        try:
+            function(*args)
+        finally:
+            for filename in snapshots:
+                self.release_snapshot(filename)
+        return "export job %s: %.2f s\n" % (name, time.monotonic() - started)
+
+    def wait(self):
+        """Wait for all jobs, then raise the first failure (if any)."""
+        failure = None
+        for job in self.jobs:
+            try:
+                self.logwrite(job.result())
+            except Exception as e:
+                self.logwrite("export job failed: %s\n" % e)
+                if failure is None:
+                    failure = e
+        self.jobs = []
+        if self.executor is not None:
+            self.executor.shutdown()
+        for filename in self.snapshots:
+            if os.path.exists(filename):
+                os.remove(filename)
+        self.snapshots = {}
+        self.logwrite(
+            "exports done in %.2f s\n" % (time.monotonic() - self.started)
+        )
+        if failure is not None:
+            raise failure
+
+
+class ExportCache:
+    """Keeps a manifest in each export directory, with a hash of what
+    each exported file was made from (the exported element, the
+    elements it refers to, the export flags, ...). Files whose hash
+    has not changed since the last run are not exported again.
+
+    Files that were exported the same way (same extension and
+    size flags) in an earlier run, but not in this run, are
+    removed when the manifests are saved."""
+
+    def __init__(self, svg, prefix, logwrite, resolve_href=None):
+        self.svg = svg
+        self.prefix = prefix
+        self.logwrite = logwrite
+        self.resolve_href = resolve_href or os.path.abspath
+        self.manifests = {}
+        self.current = {}
+        self.skipped = 0
+        self.changed = 0
+        h = hashlib.sha1()
+        for name, value in sorted(svg.attrib.items()):
+            h.update(("%s=%s\n" % (name, value)).encode("utf-8"))
+        for style in svg.iter(inkex.addNS("style", "svg")):
+            h.update(etree.tostring(style))
+        self.document_digest = h.digest()
+
+    def manifest_filename(self, directory):
+        return os.path.join(directory, self.prefix + EXPORT_MANIFEST_NAME)
+
+    def manifest(self, directory):
+        """Files in directory: {filename: [kind, hash]}."""
+        if directory not in self.manifests:
+            try:
+                with open(
+                    self.manifest_filename(directory), "rt", encoding="utf-8"
+                ) as f:
+                    self.manifests[directory] = json.load(f)
+            except (OSError, ValueError) as e:
+                self.logwrite("no manifest in %s: %s\n" % (directory, e))
+                self.manifests[directory] = {}
+            self.current[directory] = {}
+        return self.manifests[directory]
+
+    def digest(self, element, kind, elements_by_id, context=b""):
+        h = hashlib.sha1(self.document_digest)
+        h.update(kind.encode("utf-8"))
+        h.update(context)
+        for ancestor in element.iterancestors():
+            h.update(
+                (
+                    "%s %s %s\n"
+                    % (
+                        ancestor.tag,
+                        ancestor.attrib.get("transform"),
+                        ancestor.attrib.get("style"),
+                    )
+                ).encode("utf-8")
+            )
+        for e in [element] + find_referenced_elements(
+            [element], self.svg, elements_by_id, element.iterancestors()
+        ):
+            h.update(etree.tostring(e))
+            for image in e.iter(inkex.addNS("image", "svg")):
+                stamp = image_file_stamp(image, self.resolve_href)
+                h.update(stamp.encode("utf-8"))
+        return h.hexdigest()
+
+    def up_to_date(self, filename, kind, digest):
+        """Whether filename was exported from something with the same
+        hash in an earlier run. Either way it is recorded as being
+        exported in this run."""
+        directory, name = os.path.split(filename)
+        manifest = self.manifest(directory)
+        self.current[directory][name] = [kind, digest]
+        if manifest.get(name) == [kind, digest] and os.path.exists(filename):
+            self.skipped += 1
+            return True
+        self.changed += 1
+        return False
+
+    def save(self):
+        """Write the manifests, after removing stale files. Only call
+        this after all exports have been done successfully."""
+        self.logwrite(
+            "export cache: %d files unchanged, %d exported\n"
+            % (self.skipped, self.changed)
+        )
+        for directory, current in self.current.items():
+            kinds = set(kind for kind, digest in current.values())
+            manifest = self.manifests[directory]
+            for name, (kind, digest) in list(manifest.items()):
+                if name in current or kind not in kinds:
+                    continue
+                del manifest[name]
+                filename = os.path.join(directory, name)
+                if os.path.exists(filename):
+                    self.logwrite("removing stale %s\n" % filename)
+                    os.remove(filename)
+            manifest.update(current)
+            try:
+                with open(
+                    self.manifest_filename(directory), "wt", encoding="utf-8"
+                ) as f:
+                    json.dump(manifest, f, indent=0, sort_keys=True)
+            except OSError as e:
+                self.logwrite("Failed to write export manifest: %s\n" % e)
+
+
 class CountersheetEffect(inkex.Effect, SvgOutputMixin):
     def __init__(self):
         inkex.Effect.__init__(self)
@@ -475,6 +2278,9 @@ class CountersheetEffect(inkex.Effect, SvgOutputMixin):
             dest="registrationmarksbothsides",
             default="false",
         )
+        self.arg_parser.add_argument(
+            "-k", "--compoundmarks", dest="compoundmarks", default="false"
+        )
         self.arg_parser.add_argument(
             "-O", "--outlinedist", type=str, dest="outlinedist", default=""
         )
@@ -505,6 +2311,9 @@ class CountersheetEffect(inkex.Effect, SvgOutputMixin):
         self.arg_parser.add_argument(
             "-m", "--textmarkup", dest="textmarkup", default="true"
         )
+        self.arg_parser.add_argument(
+            "-e", "--compactspans", dest="compactspans", default="false"
+        )
         self.arg_parser.add_argument(
             "-B", "--bleed", dest="bleed", default="false"
         )
@@ -523,6 +2332,66 @@ class CountersheetEffect(inkex.Effect, SvgOutputMixin):
         self.arg_parser.add_argument(
             "-Y", "--backoffsety", default="0mm", dest="backoffsety"
         )
+        self.arg_parser.add_argument(
+            "-C", "--geometrycache", default="false", dest="geometrycache"
+        )
+        self.arg_parser.add_argument(
+            "-g", "--nativegeometry", default="false", dest="nativegeometry"
+        )
+        self.arg_parser.add_argument(
+            "-E",
+            "--exportworkers",
+            type=int,
+            dest="exportworkers",
+            default="1",
+        )
+        self.arg_parser.add_argument(
+            "-K", "--exportcache", default="false", dest="exportcache"
+        )
+        self.arg_parser.add_argument(
+            "-M", "--idsnapshots", default="false", dest="idsnapshots"
+        )
+        self.arg_parser.add_argument(
+            "-V", "--countersvgdir", type=str, dest="countersvgdir"
+        )
+        self.arg_parser.add_argument(
+            "-W",
+            "--inkscapeshells",
+            type=int,
+            dest="inkscapeshells",
+            default="0",
+        )
+        self.arg_parser.add_argument(
+            "-U", "--reusecounters", default="false", dest="reusecounters"
+        )
+        self.arg_parser.add_argument(
+            "-A", "--streamcounters", default="false", dest="streamcounters"
+        )
+        self.arg_parser.add_argument(
+            "-J", "--layoutplan", type=str, dest="layoutplan"
+        )
+        self.arg_parser.add_argument(
+            "-T", "--refresh", default="false", dest="refresh"
+        )
+        self.arg_parser.add_argument(
+            "-Q", "--sheetsvgdir", type=str, dest="sheetsvgdir"
+        )
+        self.arg_parser.add_argument(
+            "-c", "--prunedefs", default="false", dest="prunedefs"
+        )
+        self.arg_parser.add_argument(
+            "-H", "--packing", default="rows", dest="packing"
+        )
+        self.arg_parser.add_argument(
+            "-j", "--turncounters", default="false", dest="turncounters"
+        )
+        self.arg_parser.add_argument(
+            "-Z",
+            "--generationworkers",
+            type=int,
+            dest="generationworkers",
+            default="1",
+        )
 
         self.translatere = re.compile("translate[(]([-0-9.]+),([-0-9.]+)[)]")
         self.matrixre = re.compile(
@@ -530,6 +2399,21 @@ class CountersheetEffect(inkex.Effect, SvgOutputMixin):
         )
         self.placeholders = {}
         self.nr_styles_added = 0
+        self.markup = {}
+        self.markupfragments = {}
+        self.styles = StyleCache()
+        self.shells = None
+        self.exportcache = None
+        self.exportpass = None
+        self.templateplans = {}
+        self.useoffsets = {}
+        self.faces = {}
+        self.oldcounters = {}
+        self.oldfaces = set()
+        self.pregenerated = {}
+        self.exportplan = []
+        self.inkscapeversion = None
+        self.fontstamp = None
 
     def logwrite(self, msg):
         logfile = self.options.logfile
@@ -542,21 +2426,22 @@ class CountersheetEffect(inkex.Effect, SvgOutputMixin):
                 self.log.write(msg.encode("utf8"))
 
     def replaceattrs(self, elements, attrs):
+        matcher = glob_matcher(attrs)
+        attrlist = list(attrs.values())
         for n in elements:
             id = n.get("id")
             if not id:
                 continue
-            for glob, attr in attrs.items():
-                if fnmatch.fnmatchcase(id, glob):
-                    for a, v in attr.items():
-                        if a.startswith("style:"):
-                            pname = a[6:]
-                            a = "style"
-                            v = stylereplace(n.get(a), pname, v)
-                        if ":" in a:
-                            [ns, tag] = a.split(":")
-                            a = inkex.addNS(tag, ns)
-                        n.set(a, v)
+            for position in matcher.positions(id):
+                for a, v in attrlist[position].items():
+                    if a.startswith("style:"):
+                        pname = a[6:]
+                        a = "style"
+                        v = self.styles.replace(n.get(a), pname, v)
+                    if ":" in a:
+                        [ns, tag] = a.split(":")
+                        a = inkex.addNS(tag, ns)
+                    n.set(a, v)
 
     def translate_element(self, element, dx, dy, append=False):
         self.logwrite("translate_element %f,%f\n" % (dx, dy))
@@ -591,23 +2476,28 @@ class CountersheetEffect(inkex.Effect, SvgOutputMixin):
 
     def translate_use_element(self, use, old_ref, new_ref):
         self.logwrite("translate_use_element %s %s\n" % (old_ref, new_ref))
-        old_elements = self.document.xpath(
-            "//*[@id='%s']" % old_ref, namespaces=NSS)
-        if len(old_elements) < 1:
+        if (old_ref, new_ref) not in self.useoffsets:
+            self.useoffsets[(old_ref, new_ref)] = self.find_use_offset(
+                old_ref, new_ref
+            )
+        dx, dy = self.useoffsets[(old_ref, new_ref)]
+        self.translate_element(use, dx, dy, True)
+
+    def find_use_offset(self, old_ref, new_ref):
+        """How far to move a clone of old_ref that is changed to be
+        a clone of new_ref, for the clone to have the same center."""
+        old_element = self.index.find(old_ref)
+        if old_element is None:
             sys.exit("Failed to find old clone target: %s" % old_ref)
-        old_element = old_elements[0]
-        new_elements = self.document.xpath(
-            "//*[@id='%s']" % new_ref, namespaces=NSS
-        )
-        if len(new_elements) < 1:
+        new_element = self.index.find(new_ref)
+        if new_element is None:
             sys.exit("Failed to find new clone target: %s" % new_ref)
-        new_element = new_elements[0]
         (old_x, old_y) = self.find_reasonable_center_xy(old_element)
         (new_x, new_y) = self.find_reasonable_center_xy(new_element)
         self.logwrite(
             " use data: old %f,%f   new %f,%f\n" % (old_x, old_y, new_x, new_y)
         )
-        self.translate_element(use, old_x - new_x, old_y - new_y, True)
+        return (old_x - new_x, old_y - new_y)
 
     def find_reasonable_center_xy(self, element):
         rect = self.geometry[element.get("id")]
@@ -620,13 +2510,9 @@ class CountersheetEffect(inkex.Effect, SvgOutputMixin):
                 style = c.get("style")
                 if style is not None:
                     self.logwrite(" found flowPara style: " + style)
-                    element_style = element.get("style")
-                    if element_style:
-                        combstyle = dict(inkex.Style.parse_str(element_style))
-                    else:
-                        combstyle = {}
-                    combstyle.update(inkex.Style.parse_str(style))
-                    element.set("style", str(inkex.Style(combstyle)))
+                    element.set(
+                        "style", self.styles.merge(element.get("style"), style)
+                    )
                     break
                 else:
                     self.logwrite(" found flowPara without style")
@@ -640,7 +2526,7 @@ class CountersheetEffect(inkex.Effect, SvgOutputMixin):
                 line,
                 "flowSpan",
                 added_style,
-                inkex.Style.parse_str(element.get("style")),
+                self.styles.parse(element.get("style")),
             )
             element.append(para)
 
@@ -656,7 +2542,7 @@ class CountersheetEffect(inkex.Effect, SvgOutputMixin):
             joined_lines,
             "tspan",
             added_style,
-            inkex.Style.parse_str(element.get("style")),
+            self.styles.parse(element.get("style")),
         )
         element.append(tspan)
 
@@ -675,212 +2561,129 @@ class CountersheetEffect(inkex.Effect, SvgOutputMixin):
         if not self.textmarkup:
             element.text = text
             return
-
-        first_bold = text.find("*")
-        first_italics = text.find("/")
-        second_bold = text.find("*", first_bold + 1)
-        second_italics = text.find("/", first_italics + 1)
-
-        self.logwrite(
-            "first_bold: %d, first_italics: %d, "
-            "second_bold: %d, second_italics: %d\n"
-            % (first_bold, first_italics, second_bold, second_italics)
-        )
-
-        skip = False
-
-        if (
-            first_italics > first_bold
-            and second_bold > first_italics
-            and second_italics > second_bold
-            or first_bold > first_italics
-            and second_italics > first_bold
-            and second_bold > second_italics
-        ):
-            self.logwrite(
-                "Bad nesting bold/italics (skip format): %s\n" % text
-            )
-            skip = True
-
-        if first_bold >= 0 and second_bold < 0:
-            self.logwrite("Single bold-mark (*) (skip format): %s\n" % text)
-            skip = True
-
-        if first_italics >= 0 and second_italics < 0:
-            self.logwrite("Single italics-mark (/) (skip format): %s\n" % text)
-            skip = True
-
-        if (
-            not skip
-            and first_bold >= 0
-            and second_bold > first_bold
-            and (first_italics < 0 or first_bold < first_italics)
-        ):
-            self.formatTextPart(
-                element,
-                name,
-                text,
-                spantag,
-                first_bold,
-                second_bold,
-                "font-weight",
-                "bold",
-                added_style,
-                "b",
-                styles,
-            )
-        elif (
-            not skip
-            and first_italics >= 0
-            and second_italics > first_italics
-            and (first_bold < 0 or first_italics < first_bold)
-        ):
-            self.formatTextPart(
-                element,
-                name,
-                text,
-                spantag,
-                first_italics,
-                second_italics,
-                "font-style",
-                "italic",
-                added_style,
-                "i",
-                styles,
-            )
-        else:
-            self.formatTextImages(
-                element, name, text, spantag, added_style, styles
-            )
-
-    def formatTextImages(
-        self, element, name, text, spantag, added_style, styles
-    ):
-        m = re.search(r"[{][^{}]+[}]", text)
-        if m:
-            self.logwrite("Inline image: %s\n" % m.group(0))
-            self.insertImagePlaceholder(
-                element,
-                name,
-                text,
-                spantag,
-                m.start(),
-                m.end() - 1,
-                added_style,
-                styles,
-            )
-        else:
+        if not MARKUP_MARKS.search(text):
             element.text = text
+            return
+        if text in self.markup:
+            tree = self.markup[text]
+        else:
+            tree = TextMarkup(text).tree
+            if tree[0] == "text":
+                element.text = text
+                return
+            if len(self.markup) >= MARKUP_CACHE_MAX_ENTRIES:
+                del self.markup[next(iter(self.markup))]
+            self.markup[text] = tree
+        key = (text, spantag, tuple(styles.items()))
+        if key not in self.markupfragments:
+            fragment = etree.Element("fragment")
+            spans = []
+            self.make_markup_spans(tree, fragment, spantag, styles, spans)
+            if self.compactspans:
+                keep = set(span for span, p, t, f in spans if f is not None)
+                compact_spans(fragment, effective_style({}, styles), keep)
+                spans = [
+                    (span, span.getparent(), tag, filename)
+                    for span, parent, tag, filename in spans
+                    if span.getparent() is not None
+                ]
+            if len(self.markupfragments) >= MARKUP_CACHE_MAX_ENTRIES:
+                del self.markupfragments[next(iter(self.markupfragments))]
+            self.markupfragments[key] = (fragment, spans)
+        fragment, spans = self.markupfragments[key]
+        copy = deepcopy(fragment)
+        copies = dict(zip(fragment.iter(), copy.iter()))
+        copies[fragment] = element
+        element.text = copy.text
+        for child in list(copy):
+            element.append(child)
+        for span, parent, tag, filename in spans:
+            span = copies[span]
+            if filename is not None:
+                if "image" in added_style:
+                    nr = added_style["image"] + 1
+                else:
+                    nr = 1
+                number = len(self.placeholders)
+                spanid = "%s-%d-cs-image-%s" % (name, number, nr)
+                span.set("id", spanid)
+                self.logwrite(
+                    "inline image placeholder: %s %s\n" % (spanid, filename)
+                )
+                self.placeholders[spanid] = {
+                    "parent": copies[parent],
+                    "span": span,
+                    "filename": filename,
+                }
+            else:
+                if tag in added_style:
+                    nr = added_style[tag] + 1
+                else:
+                    nr = 1
+                added_style[tag] = nr
+                self.nr_styles_added += 1
+                span.set(
+                    "id",
+                    "%s-%d-cs-%s-%s" % (name, self.nr_styles_added, tag, nr),
+                )
 
-    def insertImagePlaceholder(
-        self,
-        element,
-        name,
-        text,
-        spantag,
-        begin_index,
-        end_index,
-        added_style,
-        styles,
-    ):
-        filename = text[begin_index + 1 : end_index]
-        if spantag != "tspan":
-            sys.exit(
-                "Failed to insert inlined image %s "
-                "in a %s element (size: %d%%). Unfortunately only "
-                "one-line text elements can have inlined "
-                "images for boring technical reasons. "
-                "Perhaps in a future version of Inkscape "
-                "it will be possible to add support for "
-                "inlined images in (flowing) multi-line "
-                "text elements."
-                % (
-                    filename,
-                    spantag,
-                    self.options.inlineimagesizepercent,
-                    self.options.inlineimageplaceholder,
+    def make_markup_spans(self, tree, element, spantag, styles, spans):
+        """Make the spans for a TextMarkup tree in element, without
+        ids. The spans that get ids are added to spans in the order
+        their ids are given out, with the element they are in, their
+        style tag and, for inline images, the file name."""
+        if tree[0] == "text":
+            element.text = tree[1]
+        elif tree[0] == "image":
+            kind, before, filename, rest = tree
+            if spantag != "tspan":
+                sys.exit(
+                    "Failed to insert inlined image %s "
+                    "in a %s element (size: %d%%). Unfortunately only "
+                    "one-line text elements can have inlined "
+                    "images for boring technical reasons. "
+                    "Perhaps in a future version of Inkscape "
+                    "it will be possible to add support for "
+                    "inlined images in (flowing) multi-line "
+                    "text elements."
+                    % (
+                        filename,
+                        spantag,
+                        self.options.inlineimagesizepercent,
+                    )
                 )
+            self.logwrite("Inline image: {%s}\n" % filename)
+            span = etree.Element(inkex.addNS(spantag, "svg"))
+            span.set("id", "")
+            span.text = self.options.inlineimageplaceholder
+            span.set(
+                "style",
+                "font-size: %d%%;fill-opacity:0;"
+                "font-style:normal;font-weight:normal;"
+                "font-variant:normal;font-family:sans-serif;"
+                % self.options.inlineimagesizepercent,
             )
-        span = etree.Element(inkex.addNS(spantag, "svg"))
-        if "image" in added_style:
-            nr = added_style["image"] + 1
-        else:
-            nr = 1
-        spanid = "%s-%d-cs-image-%s" % (name, len(self.placeholders), nr)
-        span.set("id", spanid)
-        span.text = self.options.inlineimageplaceholder
-        span.set(
-            "style",
-            "font-size: %d%%;fill-opacity:0;"
-            "font-style:normal;font-weight:normal;"
-            "font-variant:normal;font-family:sans-serif;"
-            % self.options.inlineimagesizepercent,
-        )
-
-        self.logwrite("inline image placeholder: %s %s\n" % (spanid, filename))
-
-        self.placeholders[spanid] = {
-            "parent": element,
-            "span": span,
-            "filename": filename,
-        }
-
-        restspan = etree.Element(inkex.addNS(spantag, "svg"))
-        resttext = text[end_index + 1 :]
-        self.setFormattedText(
-            restspan, name, resttext, spantag, added_style, styles
-        )
-        element.text = text[:begin_index]
-        element.append(span)
-        element.append(restspan)
-
-    def formatTextPart(
-        self,
-        element,
-        name,
-        text,
-        spantag,
-        begin_index,
-        end_index,
-        style,
-        style_value,
-        added_style,
-        style_tag,
-        styles,
-    ):
-        if style_tag in added_style:
-            nr = added_style[style_tag] + 1
+            spans.append((span, element, None, filename))
+            restspan = etree.Element(inkex.addNS(spantag, "svg"))
+            self.make_markup_spans(rest, restspan, spantag, styles, spans)
+            element.text = before
+            element.append(span)
+            element.append(restspan)
         else:
-            nr = 1
-        added_style[style_tag] = nr
-        self.nr_styles_added += 1
-
-        stylespan = etree.Element(inkex.addNS(spantag, "svg"))
-        combinedStyles = dict(styles)
-        combinedStyles[style] = style_value
-        stylespan.set("style", str(inkex.Style(combinedStyles)))
-
-        spanid = "%s-%d-cs-%s-%s" % (name, self.nr_styles_added, style_tag, nr)
-        self.logwrite("setting %s style id %s" % (style_value, spanid))
-        stylespan.set("id", spanid)
-        self.setFormattedText(
-            stylespan,
-            name,
-            text[begin_index + 1 : end_index],
-            spantag,
-            added_style,
-            styles,
-        )
-        restspan = etree.Element(inkex.addNS(spantag, "svg"))
-        restspan.set("style", str(inkex.Style(styles)))
-        self.setFormattedText(
-            restspan, name, text[end_index + 1 :], spantag, added_style, styles
-        )
-        self.formatTextImages(
-            element, name, text[:begin_index], spantag, added_style, styles
-        )
-        element.append(stylespan)
-        element.append(restspan)
+            kind, before, style, value, tag, inside, rest = tree
+            stylespan = etree.Element(inkex.addNS(spantag, "svg"))
+            combinedStyles = dict(styles)
+            combinedStyles[style] = value
+            stylespan.set("style", str(inkex.Style(combinedStyles)))
+            stylespan.set("id", "")
+            spans.append((stylespan, element, tag, None))
+            self.make_markup_spans(inside, stylespan, spantag, styles, spans)
+            restspan = etree.Element(inkex.addNS(spantag, "svg"))
+            restspan.set("style", str(inkex.Style(styles)))
+            self.make_markup_spans(rest, restspan, spantag, styles, spans)
+            self.make_markup_spans(before, element, spantag, styles, spans)
+            element.append(stylespan)
+            element.append(restspan)
 
     def setFirstTextChild(self, element, name, text):
         """Find the first child of a text element that already has
@@ -911,7 +2714,7 @@ class CountersheetEffect(inkex.Effect, SvgOutputMixin):
                 text,
                 "tspan",
                 {},
-                inkex.Style.parse_str(element.get("style")),
+                self.styles.parse(element.get("style")),
             )
             return True
         elif (
@@ -934,7 +2737,7 @@ class CountersheetEffect(inkex.Effect, SvgOutputMixin):
                 text,
                 "flowSpan",
                 {},
-                inkex.Style.parse_str(element.get("style")),
+                self.styles.parse(element.get("style")),
             )
             return True
         replaced = False
@@ -980,15 +2783,42 @@ class CountersheetEffect(inkex.Effect, SvgOutputMixin):
         layer.set(inkex.addNS("groupmode", "inkscape"), "layer")
         return layer
 
-    def generatecounter(self, c, rects, layer, colx, rowy, rotate):
-        oldcs = self.document.xpath("//svg:g[@id='%s']" % c.id, namespaces=NSS)
+    def generatecounter(
+        self, c, rects, layer, colx, rowy, rotate, pregenerated=None
+    ):
+        if self.refresh:
+            slot = "%s:%f,%f" % (layer.get("id"), colx, rowy)
+            signature = self.refresh_signature(c, rects, rotate)
+            old = self.oldcounters.pop(slot, None)
+            if old is not None and old.get(CS_SIGNATURE) == signature:
+                self.logwrite("keeping counter at %s\n" % slot)
+                for use in old.iter(inkex.addNS("use", "svg")):
+                    href = use.get(inkex.addNS("href", "xlink")) or ""
+                    self.defsregistry.ref(href[1:])
+                c.elements.append(old)
+                if c.id != None and len(c.id):
+                    self.exportids.append(c.id)
+                layer.append(old)
+                return self.counter_size(c, rects, rotate)
+        tags = [inkex.addNS("g", "svg")]
+        if self.reusecounters:
+            tags.append(inkex.addNS("use", "svg"))
+        oldcs = [e for e in self.index.find_all(c.id) if e.tag in tags]
         if len(oldcs):
             self.logwrite(
                 "Found existing %d old counters for %s" % (len(oldcs), c.id)
             )
             for oldc in oldcs:
-                oldc.set("id", "")
-        clonegroup = etree.Element(inkex.addNS("g", "svg"))
+                self.index.set_id(oldc, "")
+        if pregenerated is not None:
+            clonegroup = etree.fromstring(pregenerated[0])
+            elements = list(clonegroup.iter())
+            for n in pregenerated[1]:
+                elements[n].text = ""
+        elif self.reusecounters:
+            clonegroup = self.counter_face(c, rects)
+        else:
+            clonegroup = etree.Element(inkex.addNS("g", "svg"))
         c.elements.append(clonegroup)
         if c.id != None and len(c.id):
             clonegroup.set("id", c.id)
@@ -997,53 +2827,150 @@ class CountersheetEffect(inkex.Effect, SvgOutputMixin):
             "adding counter with %d parts at %d,%d\n"
             % (len(c.parts), colx, rowy)
         )
+        if pregenerated is not None:
+            self.logwrite(pregenerated[2])
+        elif not self.reusecounters:
+            self.addcounterparts(c, rects, clonegroup)
+        if self.refresh:
+            clonegroup.set(CS_SLOT, slot)
+            clonegroup.set(CS_SIGNATURE, signature)
+        self.translate_element(clonegroup, colx, rowy)
+        self.rotate_element(clonegroup, rotate, c.width, c.height)
+        layer.append(clonegroup)
+        # this is not ideal, but works for the inx enum
+        if rotate == 90 or rotate == -90:
+            return [c.height, c.width]
+        else:
+            return [c.width, c.height]
+
+    def refresh_signature(self, c, rects, rotate):
+        """Digest of everything that decides how counter c looks when
+        generated: its data, its templates and the options used."""
+        plans = [self.template_plan(p, rects) for p in c.parts if len(p)]
+        digest = hashlib.sha1()
+        for plan in plans:
+            digest.update(plan.digest().encode("ascii"))
+        signature = (counter_signature(c, plans), rotate)
+        digest.update(
+            repr((signature, self.generation_options())).encode("utf8")
+        )
+        return digest.hexdigest()
+
+    def generation_options(self):
+        """The options that change what generated counters look like
+        (other than how they are laid out)."""
+        options = tuple(
+            getattr(self.options, name)
+            for name in (
+                "textmarkup",
+                "compactspans",
+                "inlineimagesizepercent",
+                "inlineimageplaceholder",
+                "inlineimageoffset",
+                "reusecounters",
+                "bleed",
+            )
+        )
+        return options + (self.imagedir,)
+
+    def take_old_layers(self, svg, suffix):
+        """Remove the countersheet layers made by an earlier run from
+        svg, and return the counters in them that were generated in
+        refresh mode, by slot."""
+        if len(suffix) > 0:
+            suffix = "_" + suffix
+        layerid = re.compile(
+            "cs_layer%s_[0-9]{4}(_back)?$" % re.escape(suffix)
+        )
+        oldcounters = {}
+        for layer in svg.xpath(
+            "//svg:g[@inkscape:groupmode='layer']", namespaces=NSS
+        ):
+            if not layerid.match(layer.get("id") or ""):
+                continue
+            self.logwrite("refreshing layer %s\n" % layer.get("id"))
+            for element in layer:
+                slot = element.get(CS_SLOT)
+                if slot is not None:
+                    oldcounters[slot] = element
+            layer.getparent().remove(layer)
+        return oldcounters
+
+    def counter_size(self, c, rects, rotate):
+        """Width and height that generatecounter will return for c,
+        worked out from the template rectangles."""
+        for p in c.parts:
+            if len(p) > 0:
+                plan = self.template_plan(p, rects)
+                c.width = max(c.width, plan.width)
+                c.height = max(c.height, plan.height)
+        if rotate == 90 or rotate == -90:
+            return [c.height, c.width]
+        else:
+            return [c.width, c.height]
+
+    def counter_face(self, c, rects):
+        """Return a use element for counter c, referring to a group
+        in defs with its parts that is shared by all counters that
+        would get the same parts. Counters with inline images can
+        not be shared, as the images are added after the layout, so
+        for them a group with the parts is returned instead."""
+        plans = [self.template_plan(p, rects) for p in c.parts if len(p)]
+        for plan in plans:
+            c.width = max(c.width, plan.width)
+            c.height = max(c.height, plan.height)
+        signature = counter_signature(c, plans)
+        if signature not in self.faces or self.faces[signature] is None:
+            digest = hashlib.sha1(
+                repr((signature, self.generation_options())).encode("utf8")
+            )
+            for plan in plans:
+                digest.update(plan.digest().encode("ascii"))
+            faceid = "counterface_" + digest.hexdigest()[:16]
+            found = self.defsregistry.get(faceid)
+            if self.refresh and found is not None and is_group(found):
+                # Made by an earlier run, from the same templates.
+                self.faces[signature] = faceid
+            else:
+                nrplaceholders = len(self.placeholders)
+                face = etree.Element(inkex.addNS("g", "svg"))
+                self.addcounterparts(c, rects, face)
+                if len(self.placeholders) > nrplaceholders:
+                    self.faces[signature] = None
+                    return face
+                face.set("id", faceid)
+                self.defsregistry.add(face)
+                self.faces[signature] = faceid
+        else:
+            self.logwrite("reusing %s\n" % self.faces[signature])
+        use = etree.Element(inkex.addNS("use", "svg"))
+        use.set(inkex.addNS("href", "xlink"), "#" + self.faces[signature])
+        self.defsregistry.ref(self.faces[signature])
+        return use
+
+    def addcounterparts(self, c, rects, clonegroup):
         for p in c.parts:
             if len(p) == 0:
                 continue
-            rectname = p
-            killrect = False
-            if rectname[0] == "@":
-                killrect = True
-                rectname = rectname[1:]
-            if rectname not in rects:
-                sys.exit(
-                    "Unable to find rectangle with id '%s' "
-                    "that was specified in the CSV data file." % rectname
-                )
-            rect = rects[rectname]
-            group = find_top_level_group_for(rect)
-            if group is None:
-                self.logwrite("rect not in group '%s'.\n" % rectname)
-                sys.exit(
-                    "Rectangle '%s' not in a group. Can not be template."
-                    % rectname
-                )
-            source_layer = get_layer(rect)
-            x = self.geometry[rectname].x
-            y = self.geometry[rectname].y
-            width = self.geometry[rectname].w
-            height = self.geometry[rectname].h
-            c.width = max(c.width, width)
-            c.height = max(c.height, height)
-            clone = deepcopy(group)
-            if killrect:
-                for r in clone.xpath("//svg:rect", namespaces=NSS):
-                    if r.get("id") == rectname:
-                        r.getparent().remove(r)
-                        break
-            textishnodes = []
-            textishnodes.extend(clone.xpath("//svg:text", namespaces=NSS))
-            textishnodes.extend(clone.xpath("//svg:flowSpan", namespaces=NSS))
-            textishnodes.extend(clone.xpath("//svg:flowRoot", namespaces=NSS))
-            for t in textishnodes:
+            plan = self.template_plan(p, rects)
+            c.width = max(c.width, plan.width)
+            c.height = max(c.height, plan.height)
+            clone, nodes = plan.copy()
+            if plan.killindex is not None:
+                r = nodes[plan.killindex]
+                r.getparent().remove(r)
+            for t in [nodes[i] for i in plan.textish]:
                 self.substitute_text(c, t, t.get("id"))
 
-            for i in clone.xpath("//svg:image", namespaces=NSS):
+            matcher = glob_matcher(c.subst)
+            substs = list(c.subst.items())
+            for i in [nodes[i] for i in plan.images]:
                 imageid = i.get("id")
                 if not imageid:
                     continue
-                for glob, image in c.subst.items():
-                    if fnmatch.fnmatchcase(imageid, glob):
+                matching = set(matcher.positions(imageid))
+                for position, (glob, image) in enumerate(substs):
+                    if position in matching:
                         if len(image) > 0:
                             href = self.make_image_href(image)
                             i.set(inkex.addNS("absref", "sodipodi"), href)
@@ -1066,23 +2993,26 @@ class CountersheetEffect(inkex.Effect, SvgOutputMixin):
                             href.replace("%%%s%%" % glob, image),
                         )
 
-            for u in clone.xpath("//svg:use", namespaces=NSS):
+            for u in [nodes[i] for i in plan.uses]:
                 useid = u.get("id")
                 if not useid:
                     continue
-                for glob, new_ref in c.subst.items():
-                    if fnmatch.fnmatchcase(useid, glob):
-                        if new_ref != None and len(new_ref) > 0:
-                            xlink_attribute = inkex.addNS("href", "xlink")
-                            old_ref = u.get(xlink_attribute)[1:]
-                            u.set(xlink_attribute, "#" + new_ref)
-                            self.translate_use_element(u, old_ref, new_ref)
-                        else:
-                            u.getparent().remove(u)
+                for position in matcher.positions(useid):
+                    new_ref = substs[position][1]
+                    if new_ref != None and len(new_ref) > 0:
+                        xlink_attribute = inkex.addNS("href", "xlink")
+                        old_ref = u.get(xlink_attribute)[1:]
+                        u.set(xlink_attribute, "#" + new_ref)
+                        self.translate_use_element(u, old_ref, new_ref)
+                    else:
+                        u.getparent().remove(u)
 
-            for name, value in c.subst.items():
-                if is_valid_name_to_replace(name):
-                    string_replace_xml_text(clone, "%%%s%%" % name, value)
+            # Only the texts that were substituted and what had a %
+            # in the template can have something to replace.
+            elements = [nodes[i] for i in plan.percent]
+            for i in plan.textish:
+                elements.extend(nodes[i].iter())
+            replace_xml_text(elements, c.subst)
 
             if len(c.excludeids):
                 excludeelements = []
@@ -1095,57 +3025,70 @@ class CountersheetEffect(inkex.Effect, SvgOutputMixin):
                     if eeparent is not None:
                         ee.getparent().remove(ee)
             self.replaceattrs(clone.iterdescendants(), c.attrs)
-            converter = DocumentTopLeftCoordinateConverter(source_layer)
-            (
-                source_layer_adjusted_x,
-                source_layer_adjusted_y,
-            ) = converter.SVG_to_dtl((-x, -y))
-            self.translate_element(
-                clone, source_layer_adjusted_x, source_layer_adjusted_y
-            )
+            self.translate_element(clone, plan.offset[0], plan.offset[1])
             self.logwrite("cloning %s\n" % clone.get("id"))
             clonegroup.append(clone)
-        self.translate_element(clonegroup, colx, rowy)
-        self.rotate_element(clonegroup, rotate, c.width, c.height)
-        layer.append(clonegroup)
-        # this is not ideal, but works for the inx enum
-        if rotate == 90 or rotate == -90:
-            return [c.height, c.width]
-        else:
-            return [c.width, c.height]
+
+    def template_plan(self, part, rects):
+        """The TemplatePlan for a counter part (name of a template
+        rectangle, with @ first to remove the rectangle)."""
+        if part in self.templateplans:
+            return self.templateplans[part]
+        rectname = part
+        killrect = False
+        if rectname[0] == "@":
+            killrect = True
+            rectname = rectname[1:]
+        if rectname not in rects:
+            sys.exit(
+                "Unable to find rectangle with id '%s' "
+                "that was specified in the CSV data file." % rectname
+            )
+        rect = rects[rectname]
+        group = find_top_level_group_for(rect)
+        if group is None:
+            self.logwrite("rect not in group '%s'.\n" % rectname)
+            sys.exit(
+                "Rectangle '%s' not in a group. Can not be template."
+                % rectname
+            )
+        source_layer = get_layer(rect)
+        rectangle = self.geometry[rectname]
+        converter = DocumentTopLeftCoordinateConverter(source_layer)
+        offset = converter.SVG_to_dtl((-rectangle.x, -rectangle.y))
+        plan = TemplatePlan(group, rectname, killrect, rectangle, offset)
+        self.templateplans[part] = plan
+        return plan
 
     def substitute_text(self, c, t, textid):
-        for glob, subst in c.subst.items():
-            if glob is None:
-                continue
+        substs = list(c.subst.values())
+        for position in glob_matcher(c.subst).positions(textid):
+            subst = substs[position]
             if subst is None:
                 subst = ""
-            if fnmatch.fnmatchcase(textid, glob):
-                if subst.find("\\n") >= 0:
+            if subst.find("\\n") >= 0:
+                if t.tag == inkex.addNS("flowRoot", "svg"):
+                    self.setMultilineFlowRoot(t, textid, subst.split("\\n"))
+                if t.tag == inkex.addNS("text", "svg"):
+                    self.setMultilineText(t, textid, subst.split("\\n"))
+            else:
+                if not self.setFirstTextChild(t, textid, subst):
+                    # Could not find anything to replace, so just delete
+                    # everything and set the text for all the text element.
+                    self.deleteTextChildren(t)
+                    childtype = "tspan"
                     if t.tag == inkex.addNS("flowRoot", "svg"):
-                        self.setMultilineFlowRoot(
-                            t, textid, subst.split("\\n")
-                        )
-                    if t.tag == inkex.addNS("text", "svg"):
-                        self.setMultilineText(t, textid, subst.split("\\n"))
-                else:
-                    if not self.setFirstTextChild(t, textid, subst):
-                        # Could not find anything to replace, so just delete
-                        # everything and set the text for all the text element.
-                        self.deleteTextChildren(t)
-                        childtype = "tspan"
-                        if t.tag == inkex.addNS("flowRoot", "svg"):
-                            childtype = "flowSpan"
-                        self.setFormattedText(
-                            t,
-                            textid,
-                            subst,
-                            childtype,
-                            {},
-                            inkex.Style.parse_str(t.get("style")),
-                        )
-                if c.id:
-                    t.set("id", textid + "_" + c.id)
+                        childtype = "flowSpan"
+                    self.setFormattedText(
+                        t,
+                        textid,
+                        subst,
+                        childtype,
+                        {},
+                        self.styles.parse(t.get("style")),
+                    )
+            if c.id:
+                t.set("id", textid + "_" + c.id)
 
     def find_layer(self, svg, layer_name, suffix):
         """Find a layer with given label in the SVG.
@@ -1157,16 +3100,15 @@ class CountersheetEffect(inkex.Effect, SvgOutputMixin):
 
         base_layer = None
 
-        for g in svg.xpath("//svg:g", namespaces=NSS):
-            if g.get(inkex.addNS("groupmode", "inkscape")) == "layer":
-                lname = g.get(inkex.addNS("label", "inkscape"))
-                if (
-                    lname == layer_name + "_" + suffix
-                    or lname == layer_name + " " + suffix
-                ):
-                    return g
-                if lname == layer_name:
-                    base_layer = g
+        for g in self.index.layers:
+            lname = g.get(inkex.addNS("label", "inkscape"))
+            if (
+                lname == layer_name + "_" + suffix
+                or lname == layer_name + " " + suffix
+            ):
+                return g
+            if lname == layer_name:
+                base_layer = g
 
         return base_layer
 
@@ -1190,12 +3132,169 @@ class CountersheetEffect(inkex.Effect, SvgOutputMixin):
             return res
         return False
 
-    def addbacks(self, layer, bstack, backxs, backys, docwidth, rects):
-        self.logwrite("addbacks %d\n" % len(bstack))
-        for c, x, y in zip(bstack, backxs, backys):
+    def write_layout_plan(
+        self, filename, planner, counters, docwidth, docheight, hasback
+    ):
+        """Write where all the counters would go to filename, as JSON,
+        with how much of each sheet is used and what there would be
+        to export. Nothing is added to the document."""
+        steps = planner.plan(counters)
+        placements = [p for p in steps if isinstance(p, Placement)]
+        nrsheets = planner.sheet
+        if not placements or placements[-1].sheet < planner.sheet:
+            nrsheets -= 1
+        boxarea = sum(p.w * p.h for p in planner.positions)
+        sheets = []
+        for nr in range(1, nrsheets + 1):
+            onsheet = [p for p in placements if p.sheet == nr]
+            used = sum(p.width * p.height for p in onsheet)
+            sheets.append(
+                {
+                    "sheet": nr,
+                    "counters": len(onsheet),
+                    "utilization": used / boxarea if boxarea > 0 else 0,
+                }
+            )
+        ids = set()
+        for p in placements:
+            if p.counter.id:
+                ids.add(p.counter.id)
+            if p.backx is not None and p.counter.back.id:
+                ids.add(p.counter.back.id)
+        layers = nrsheets
+        if hasback and not self.oneside:
+            layers *= 2
+        inches = self.svg.unittouu("1in")
+        sheetdpi = self.options.bitmapsheetsdpi
+        bitmapdir = self.options.bitmapdir
+        exports = {
+            "idbitmaps": 0,
+            "idbitmappixels": 0,
+            "sheetbitmaps": 0,
+            "sheetbitmappixels": 0,
+            "pdfs": layers if self.options.pdfdir else 0,
+            "countersvgs": len(ids) if self.options.countersvgdir else 0,
+        }
+        if bitmapdir and self.options.bitmapwidth > 0:
+            exports["idbitmaps"] = len(ids)
+            exports["idbitmappixels"] = (
+                len(ids) * self.options.bitmapwidth * self.options.bitmapheight
+            )
+        if bitmapdir and sheetdpi > 0:
+            exports["sheetbitmaps"] = layers
+            exports["sheetbitmappixels"] = int(
+                layers
+                * (docwidth / inches * sheetdpi)
+                * (docheight / inches * sheetdpi)
+            )
+        plan = {
+            "sheets": sheets,
+            "counters": [p.asdict() for p in placements],
+            "exports": exports,
+        }
+        with open(filename, "w") as f:
+            json.dump(plan, f, indent=1)
+        self.logwrite(
+            "wrote layout plan for %d counters on %d sheets to %s\n"
+            % (len(placements), nrsheets, filename)
+        )
+
+    def pregenerate(self, steps, lastbacks, rects):
+        """Generate the counters in steps (and the backs in lastbacks,
+        of the last sheet) in worker processes, with a shard of whole
+        sheets for each, for generatecounter to use instead of doing
+        it again. The results are used in the same order as without
+        workers, so the document comes out the same. Counters with
+        text markup or inline images are numbered by the order they
+        are generated in, so those are left to generatecounter."""
+        if "fork" not in multiprocessing.get_all_start_methods():
+            self.logwrite("no fork, generating counters in one process\n")
+            return
+        # Forking while other threads run could leave locks that they
+        # hold locked for good in the workers. The shells start again
+        # when they are needed.
+        if self.shells is not None:
+            self.shells.close()
+        if threading.active_count() > 1:
+            self.logwrite("threads running, generating in one process\n")
+            return
+        global PREGENERATE
+        placements = [s for s in steps if isinstance(s, Placement)]
+        indexes = dict((p, i) for i, p in enumerate(placements))
+        sheets = []
+        lastnr = {}
+        for step in steps + [LayoutSheet(None, lastbacks)]:
+            if isinstance(step, Placement):
+                if not sheets or sheets[-1][0] != step.sheet:
+                    sheets.append((step.sheet, []))
+                sheets[-1][1].append((indexes[step], False, step.nr))
+                lastnr[step.counter] = step.nr
+            elif isinstance(step, LayoutSheet) and sheets:
+                # Backs get the autonumber of the last copy before them.
+                sheets[-1][1].extend(
+                    (indexes[p], True, lastnr[p.counter]) for p in step.backs
+                )
+        workers = min(self.options.generationworkers, len(sheets))
+        if workers < 2:
+            return
+        shards = [[] for n in range(workers)]
+        for n, (sheet, jobs) in enumerate(sheets):
+            shards[n * workers // len(sheets)].extend(jobs)
+        self.logwrite(
+            "generating %d sheets in %d processes\n" % (len(sheets), workers)
+        )
+        if self.log:
+            self.log.flush()
+        PREGENERATE = (self, placements, rects)
+        try:
+            with multiprocessing.get_context("fork").Pool(workers) as pool:
+                results = pool.map(pregenerate_shard, shards)
+        finally:
+            PREGENERATE = None
+        for shard, generated in zip(shards, results):
+            for (index, back, nr), result in zip(shard, generated):
+                if result is not None:
+                    self.pregenerated[(placements[index], back)] = result
+
+    def pregenerate_counter(self, placement, back, nr, rects):
+        """Parts of the counter (or its back) at placement, as
+        generatecounter would make them: serialized, what elements
+        have empty text, and what was logged. None if that changed
+        the numbering of later counters, looked for an element that
+        an earlier counter could have added, or failed (so that
+        generatecounter fails the same way, in the main process)."""
+        c = placement.counter.back if back else placement.counter
+        c.addsubst("autonumber", str(nr))
+        numbering = (self.nr_styles_added, len(self.placeholders))
+        misses = self.index.misses
+        if self.log:
+            self.log = io.StringIO()
+        group = etree.Element(inkex.addNS("g", "svg"))
+        try:
+            self.addcounterparts(c, rects, group)
+        except (SystemExit, Exception):
+            return None
+        if numbering != (self.nr_styles_added, len(self.placeholders)):
+            return None
+        if misses != self.index.misses:
+            return None
+        # Empty text would be parsed back as no text at all.
+        empty = [n for n, e in enumerate(group.iter()) if e.text == ""]
+        log = self.log.getvalue() if self.log else ""
+        return etree.tostring(group), empty, log
+
+    def addbacks(self, layer, placements, rects):
+        self.logwrite("addbacks %d\n" % len(placements))
+        for placement in placements:
             self.logwrite("   adding back\n")
             self.generatecounter(
-                c.back, rects, layer, docwidth - x, y, self.options.rotatebacks
+                placement.counter.back,
+                rects,
+                layer,
+                placement.backx,
+                placement.backy,
+                placement.backrotation,
+                self.pregenerated.pop((placement, True), None),
             )
 
     # Looked a bit at code in Inkscape text_merge.py for this idea.
@@ -1212,7 +3311,7 @@ class CountersheetEffect(inkex.Effect, SvgOutputMixin):
         tmpfilefile = os.fdopen(tmpfile[0], "w")
         tmpfilefile.write(filecontents)
         tmpfilefile.close()
-        out = inkscape(tmpfile[1], "--query-all")
+        out = self.inkscape_query_all(tmpfile[1])
         reader = csv.reader(out.splitlines())
         for line in reader:
             if len(line) == 5:
@@ -1231,6 +3330,130 @@ class CountersheetEffect(inkex.Effect, SvgOutputMixin):
         os.remove(tmpfile[1])
         return geometry
 
+    def inkscape_query_all(self, filename):
+        if self.shells is not None:
+            try:
+                return self.shells.run(
+                    [["file-open:%s" % filename, "query-all", "file-close"]]
+                )[0]
+            except InkscapeShellError as e:
+                self.logwrite("%s, running inkscape --query-all\n" % e)
+        return inkscape(filename, "--query-all")
+
+    def query_template_geometry(self, filename):
+        """Same as queryAll, but using the geometry cache (unless
+        disabled) to not have to run Inkscape again for a template
+        file that has already been measured."""
+        if self.options.geometrycache != "true":
+            return self.queryAll(filename)
+        if self.fontstamp is None:
+            self.fontstamp = font_directories_stamp()
+        cache = GeometryCache(
+            GEOMETRY_CACHE_DIR, self.logwrite, self.fontstamp
+        )
+        key = cache.key(filename, self.xscale, self.yscale)
+        geometry = cache.get(key)
+        if geometry is None:
+            geometry = self.queryAll(filename)
+            cache.put(key, geometry)
+        cache.log_statistics()
+        return geometry
+
+    def queryIds(self, filename, ids):
+        """Return geometry Rectangle for each of the given element ids,
+        as dict. Only asks Inkscape about those ids, unless there
+        are too many of them to put on the command line (or
+        Inkscape answers something unexpected), then does queryAll."""
+        joined = ",".join(ids)
+        if len(ids) == 0 or "," in "".join(ids) or len(joined) > 7000:
+            return self.queryAll(filename)
+        try:
+            out = inkscape(
+                filename, "--query-id=%s" % joined, "-X", "-Y", "-W", "-H"
+            )
+        except inkex.command.ProgramRunError as e:
+            self.logwrite("--query-id failed: %s\n" % e)
+            return self.queryAll(filename)
+        lines = [line for line in out.splitlines() if len(line.strip())]
+        values = [line.split(",") for line in lines[-4:]]
+        if len(values) != 4 or any(len(v) != len(ids) for v in values):
+            self.logwrite("Unexpected --query-id result:\n%s\n" % out)
+            return self.queryAll(filename)
+        geometry = {}
+        for i, element_id in enumerate(ids):
+            try:
+                r = Rectangle(
+                    float(values[0][i]) / self.xscale,
+                    float(values[1][i]) / self.yscale,
+                    float(values[2][i]) / self.xscale,
+                    float(values[3][i]) / self.yscale,
+                )
+            except ValueError:
+                continue
+            self.logwrite(
+                " %s %f,%f %fx%f\n" % (element_id, r.x, r.y, r.w, r.h)
+            )
+            geometry[element_id] = r
+        return geometry
+
+    def query_placeholders(self):
+        """Geometry for the inline image placeholders. Only the
+        generated counters that have placeholders in them (and
+        whatever they refer to) are written to the temporary
+        file that Inkscape is asked about."""
+        svg = self.document.getroot()
+        layers = []
+        groups = {}
+        ids = []
+        for spanid, info in self.placeholders.items():
+            group = find_top_level_group_for(info["parent"])
+            if group is None:
+                continue
+            ids.append(spanid)
+            layer = group.getparent()
+            if layer not in groups:
+                layers.append(layer)
+                groups[layer] = []
+            if group not in groups[layer]:
+                groups[layer].append(group)
+        if not ids:
+            return {}
+        root = make_minimal_svg(
+            svg, [g for layer in layers for g in groups[layer]]
+        )
+        tmpfile = mkstemp(".svg")
+        with os.fdopen(tmpfile[0], "wb") as f:
+            etree.ElementTree(root).write(
+                f, xml_declaration=True, encoding="utf-8"
+            )
+        self.logwrite(
+            "Placeholders replace temporary file: %s (%d counters)\n"
+            % (tmpfile[1], sum(len(g) for g in groups.values()))
+        )
+        geometry = self.queryIds(tmpfile[1], ids)
+        os.remove(tmpfile[1])
+        return geometry
+
+    def write_counter_svg(self, element_id, filename, elements_by_id):
+        """Write a standalone SVG with only the element with the given
+        id (usually a counter), the elements it refers to, and links
+        to image files made absolute, so that the file can be
+        moved."""
+        root = make_minimal_svg(
+            self.document.getroot(),
+            [elements_by_id[element_id]],
+            elements_by_id,
+        )
+        for image in root.iter(inkex.addNS("image", "svg")):
+            for name in HREF_ATTRIBUTES:
+                href = image.attrib.get(name)
+                if href and not re.match("(data|file|https?):|#", href):
+                    image.set(name, self.absolute_href(href, os.getcwd()))
+        with open(filename, "wb") as f:
+            etree.ElementTree(root).write(
+                f, xml_declaration=True, encoding="utf-8"
+            )
+
     def make_temporary_svg(self, exportdir=None):
         """Renders SVG DOM as it currently looks like
         in the extension with modifications made (or not)
@@ -1256,31 +3479,302 @@ class CountersheetEffect(inkex.Effect, SvgOutputMixin):
         # this is an ugly workaround for
         # https://bugs.launchpad.net/inkscape/+bug/1714365
         noidexportworkaround=False,
+        snapshot=None,
     ):
-        tmpfilename = self.make_temporary_svg(exportdir)
+        """Adds the exports to the export plan (see flush_exports),
+        or, if snapshot is given, schedules them at once, using the
+        temporary SVG it returns. With the export cache, only files
+        that have changed since the last export are exported."""
+        ids = [id for id in ids if self.index.find(id) is not None]
+        if self.exportcache is not None:
+            ids = self.find_changed_exports(
+                ids, size_flags, exportdir, extension, noidexportworkaround
+            )
+        if not ids:
+            return
+        request = (ids, size_flags, exportdir, extension, noidexportworkaround)
+        if snapshot is None:
+            self.exportplan.append(request)
+        else:
+            self.schedule_exports(snapshot(), [request])
+
+    def flush_exports(self):
+        """Write one temporary SVG of the document as it is now, and
+        schedule all exports planned since the last flush using it."""
+        if self.exportplan:
+            plan = self.exportplan
+            self.exportplan = []
+            self.schedule_exports(self.make_temporary_svg(plan[0][2]), plan)
+
+    def schedule_exports(self, tmpfilename, plan):
+        self.exports.add_snapshot(tmpfilename)
         self.logwrite("export to tmpfilename: %s\n" % tmpfilename)
-        self.logwrite(" ids to export: %r\n" % ids)
-        for id in ids:
-            if (
-                len(self.document.xpath("//*[@id='%s']" % id, namespaces=NSS))
-                == 0
-            ):
+        for ids, size_flags, exportdir, extension, page in plan:
+            self.logwrite(" ids to export: %r\n" % ids)
+            if self.shells is not None and not page:
+                batches = [(self.export_ids, ids)]
+            elif self.batch_exports_supported():
+                n = max(min(self.options.exportworkers, len(ids)), 1)
+                batches = [(self.export_batch, ids[i::n]) for i in range(n)]
+            else:
+                for id in ids:
+                    self.schedule_single_export(
+                        tmpfilename, id, size_flags, exportdir, extension, page
+                    )
                 continue
-            if noidexportworkaround:
-                idflag = []
+            for function, batch in batches:
+                self.exports.submit(
+                    "%d %s files in %s" % (len(batch), extension, exportdir),
+                    function,
+                    tmpfilename,
+                    batch,
+                    size_flags,
+                    exportdir,
+                    extension,
+                    page,
+                    snapshots=[tmpfilename],
+                )
+        self.exports.release_snapshot(tmpfilename)
+
+    def schedule_single_export(
+        self, tmpfilename, id, size_flags, exportdir, extension, page
+    ):
+        """Schedule running Inkscape to export only id. A page is
+        exported without giving the id to Inkscape, because of
+        https://bugs.launchpad.net/inkscape/+bug/1714365, so the
+        temporary SVG must only show that page."""
+        if page:
+            idflag = []
+        else:
+            idflag = ["-i", id]
+        outputfilename = self.getbitmapfilename(id, exportdir, extension)
+        args = ["-j"] + idflag + ["-o", outputfilename] + size_flags
+        self.exports.submit(
+            outputfilename,
+            inkscape,
+            tmpfilename,
+            *args,
+            snapshots=[tmpfilename]
+        )
+
+    def batch_exports_supported(self):
+        """Whether the Inkscape used is new enough (1.1 or later) to
+        export many files in one run, using actions."""
+        if self.inkscapeversion is None:
+            self.inkscapeversion = inkscape_version()
+            self.logwrite("Inkscape version: %r\n" % (self.inkscapeversion,))
+        return self.inkscapeversion >= (1, 1)
+
+    def export_actions(self, id, size_flags, exportdir, extension, page):
+        """Inkscape actions to export one id (to the filename given by
+        getbitmapfilename). Export settings stay between exports
+        in the same Inkscape, so all sizes are set, even if only to
+        0 (not set). A page (PDF) is exported without giving the id
+        to Inkscape, like in schedule_single_export, so the SVG must
+        only show that page."""
+        actions = [
+            "export-filename:%s"
+            % self.getbitmapfilename(id, exportdir, extension)
+        ]
+        if page:
+            actions.append("export-area-page")
+        else:
+            actions += ["export-id:%s" % id, "export-id-only"]
+        sizes = dict(zip(size_flags[::2], size_flags[1::2]))
+        for flag, action in sorted(INKSCAPE_SIZE_ACTIONS.items()):
+            actions.append("%s:%s" % (action, sizes.get(flag, 0)))
+        actions.append("export-do")
+        return actions
+
+    def export_batch(
+        self, filename, ids, size_flags, exportdir, extension, page
+    ):
+        """Export ids using one Inkscape, that is given all the export
+        actions on stdin (as in --shell, to not be limited by the
+        length of the command line)."""
+        actions = []
+        for id in ids:
+            actions += self.export_actions(
+                id, size_flags, exportdir, extension, page
+            )
+        if ";" not in "".join(actions) and "\n" not in "".join(actions):
+            inkscape(filename, "--shell", stdin="; ".join(actions) + "\n")
+            return
+        self.logwrite("can not export %r using actions\n" % ids)
+        for id in ids:
+            if page:
+                args = ["-j"]
             else:
-                idflag = ["-i", id]
-            args = (
-                ["-j"]
-                + idflag
-                + [
-                    "-o",
-                    self.getbitmapfilename(id, exportdir, extension),  # FIXME
-                ]
-                + size_flags
+                args = ["-j", "-i", id]
+            outputfilename = self.getbitmapfilename(id, exportdir, extension)
+            inkscape(filename, *(args + ["-o", outputfilename] + size_flags))
+
+    def find_changed_exports(
+        self, ids, size_flags, exportdir, extension, page
+    ):
+        """The ids that the export cache does not have up to date
+        files for. Exporting a page (for PDF) also depends on
+        everything else on the page except other cs_layers."""
+        kind = " ".join([extension] + [str(f) for f in size_flags])
+        elements_by_id, context = self.export_pass_context(page)
+        changed = []
+        for id in ids:
+            filename = self.getbitmapfilename(id, exportdir, extension)
+            digest = self.exportcache.digest(
+                elements_by_id[id], kind, elements_by_id, context
+            )
+            if self.exportcache.up_to_date(filename, kind, digest):
+                self.logwrite("  %s is up to date\n" % filename)
+            else:
+                changed.append(id)
+        return changed
+
+    def export_pass_context(self, page):
+        """The elements by id, and what else is on the page (or
+        nothing if not page), for find_changed_exports. Found once
+        for all exports until self.exportpass is reset."""
+        if self.exportpass is None:
+            self.exportpass = (
+                index_elements_by_id(self.document.getroot()),
+                None,
+            )
+        elements_by_id, pagecontext = self.exportpass
+        if not page:
+            return elements_by_id, b""
+        if pagecontext is None:
+            svg = self.document.getroot()
+            pagecontext = b"".join(
+                etree.tostring(e)
+                for e in svg
+                if e.tag != inkex.addNS("defs", "svg")
+                and e.attrib.get("id") not in self.cslayers
+            )
+            self.exportpass = (elements_by_id, pagecontext)
+        return elements_by_id, pagecontext
+
+    def export_counter_snapshots(self, ids, size_flags, exportdir, extension):
+        """Like export_using_inkscape, but each id is exported from its
+        own small temporary SVG (see write_counter_svg), instead
+        of from the whole document."""
+        elements_by_id = index_elements_by_id(self.document.getroot())
+        ids = [id for id in ids if id in elements_by_id]
+        if self.exportcache is not None:
+            ids = self.find_changed_exports(
+                ids, size_flags, exportdir, extension, False
+            )
+        snapshots = []
+        for id in ids:
+            fd, filename = mkstemp(
+                ".svg", "tmp", os.path.abspath(exportdir), True
+            )
+            os.close(fd)
+            self.write_counter_svg(id, filename, elements_by_id)
+            self.exports.add_snapshot(filename)
+            snapshots.append((id, filename))
+        use_actions = len(ids) > 0 and self.batch_exports_supported()
+        n = max(min(self.options.exportworkers, len(ids)), 1)
+        if self.shells is not None:
+            n = max(min(len(self.shells), len(ids)), n)
+        for i in range(n):
+            batch = snapshots[i::n]
+            if batch:
+                self.exports.submit(
+                    "%d %s files from counter snapshots"
+                    % (len(batch), extension),
+                    self.export_snapshots,
+                    batch,
+                    size_flags,
+                    exportdir,
+                    extension,
+                    use_actions,
+                    snapshots=[filename for id, filename in batch],
+                )
+        for id, filename in snapshots:
+            self.exports.release_snapshot(filename)
+
+    def export_snapshots(
+        self, snapshots, size_flags, exportdir, extension, use_actions
+    ):
+        """Export each (id, filename) in snapshots from that file,
+        using the Inkscape shells, or one Inkscape that is given
+        actions to open each file in turn (if use_actions), or one
+        Inkscape for each file."""
+        lines = [
+            ["file-open:%s" % filename]
+            + self.export_actions(id, size_flags, exportdir, extension, False)
+            + ["file-close"]
+            for id, filename in snapshots
+        ]
+        joined = "".join(a for actions in lines for a in actions)
+        if self.shells is not None:
+            try:
+                self.shells.run(lines)
+                return
+            except InkscapeShellError as e:
+                self.logwrite("%s, running inkscape for each file\n" % e)
+        elif use_actions and ";" not in joined and "\n" not in joined:
+            inkscape(
+                snapshots[0][1],
+                "--shell",
+                stdin="".join("; ".join(actions) + "\n" for actions in lines),
+            )
+            return
+        for id, filename in snapshots:
+            inkscape(
+                filename,
+                "-j",
+                "-i",
+                id,
+                "-o",
+                self.getbitmapfilename(id, exportdir, extension),
+                *size_flags
             )
-            inkscape(tmpfilename, *args)
-        os.remove(tmpfilename)
+
+    def export_ids(
+        self, filename, ids, size_flags, exportdir, extension, page=False
+    ):
+        """Export ids using the Inkscape shells, or by running Inkscape
+        for each id if the shells do not work."""
+        try:
+            self.export_using_shells(
+                filename, ids, size_flags, exportdir, extension
+            )
+        except InkscapeShellError as e:
+            self.logwrite("%s, running inkscape for each id\n" % e)
+            for id in ids:
+                inkscape(
+                    filename,
+                    "-j",
+                    "-i",
+                    id,
+                    "-o",
+                    self.getbitmapfilename(id, exportdir, extension),
+                    *size_flags
+                )
+
+    def export_using_shells(
+        self, filename, ids, size_flags, exportdir, extension
+    ):
+        """Same as the loop in export_using_inkscape, but with the ids
+        shared between the Inkscape shells, that each only has to
+        load the document once."""
+
+        def export_ids(chunk):
+            lines = [["file-open:%s" % filename]]
+            for id in chunk:
+                lines.append(
+                    self.export_actions(
+                        id, size_flags, exportdir, extension, False
+                    )
+                )
+            lines.append(["file-close"])
+            self.shells.run(lines)
+
+        chunks = [ids[i :: len(self.shells)] for i in range(len(self.shells))]
+        chunks = [chunk for chunk in chunks if chunk]
+        if chunks:
+            with ThreadPoolExecutor(len(chunks)) as executor:
+                list(executor.map(export_ids, chunks))
 
     def getbitmapfilename(self, id, directory, extension):
         return (
@@ -1300,22 +3794,42 @@ class CountersheetEffect(inkex.Effect, SvgOutputMixin):
             "set_style_on_elements %r %s=%s\n" % (element_ids, part, value)
         )
         for element_id in element_ids:
-            matching_elements = self.document.xpath(
-                "//*[@id='%s']" % element_id, namespaces=NSS
-            )
-            if not matching_elements:
+            element = self.index.find(element_id)
+            if element is None:
                 return
-            self.set_style(matching_elements[0], part, value)
+            self.set_style(element, part, value)
 
     def set_style(self, element, part, value):
         oldstyle = element.get("style") or ""
-        newstyle = stylereplace(oldstyle, part, value)
+        newstyle = self.styles.replace(oldstyle, part, value)
         element.set("style", newstyle)
         self.logwrite(
             "set_style %s: '%s' -> '%s'\n"
             % (element.get("id"), oldstyle, newstyle)
         )
 
+    def make_layer_snapshot(self, layer_id, exportdir):
+        """Temporary SVG (see make_temporary_svg) with only layer_id of
+        the cs_layers visible. The document is left as it was."""
+        saved = []
+        for element_id in self.cslayers:
+            element = self.index.find(element_id)
+            if element is None:
+                continue
+            saved.append((element, element.get("style")))
+            if element_id == layer_id:
+                self.set_style(element, "display", None)
+            else:
+                self.set_style(element, "display", "none")
+        try:
+            return self.make_temporary_svg(exportdir)
+        finally:
+            for element, style in saved:
+                if style is None:
+                    del element.attrib["style"]
+                else:
+                    element.set("style", style)
+
     def exportSheetPDFs(self):
         self.logwrite(
             "exportSheetPDFs %s %d\n"
@@ -1324,15 +3838,18 @@ class CountersheetEffect(inkex.Effect, SvgOutputMixin):
         if self.options.pdfdir and len(self.cslayers) > 0:
             for layer in self.cslayers:
                 self.logwrite("  export PDF layer\n")
-                self.hidelayers(self.cslayers)
-                self.showlayers([layer])
+                snapshot = lambda: self.make_layer_snapshot(
+                    layer, self.options.pdfdir
+                )
                 self.export_using_inkscape(
                     [layer],
                     ["-d", PDF_DPI],
                     self.options.pdfdir,
                     "pdf",
                     True,
+                    snapshot,
                 )
+        self.flush_exports()
         self.showlayers(self.cslayers)
 
     def exportSheetBitmaps(self):
@@ -1359,22 +3876,48 @@ class CountersheetEffect(inkex.Effect, SvgOutputMixin):
         ):
             if self.bleed:
                 self.bleedmaker.hideall()
-            self.export_using_inkscape(
-                self.exportids,
-                [
-                    "-w",
-                    self.options.bitmapwidth,
-                    "-h",
-                    self.options.bitmapheight,
-                ],
-                self.options.bitmapdir,
-                "png",
-            )
+            size_flags = [
+                "-w",
+                self.options.bitmapwidth,
+                "-h",
+                self.options.bitmapheight,
+            ]
+            if self.options.idsnapshots == "true":
+                self.export_counter_snapshots(
+                    self.exportids, size_flags, self.options.bitmapdir, "png"
+                )
+            else:
+                self.export_using_inkscape(
+                    self.exportids, size_flags, self.options.bitmapdir, "png"
+                )
+            if self.bleed or type(self).post != CountersheetEffect.post:
+                # The sheets are exported from the document as it
+                # looks after post(), and with bleed, so can not
+                # share the temporary SVG with the ID bitmaps.
+                self.flush_exports()
             if self.bleed:
                 self.bleedmaker.showall()
             return True
         return False
 
+    def exportCounterSVGs(self):
+        if len(self.exportids) > 0 and self.options.countersvgdir:
+            os.makedirs(self.options.countersvgdir, exist_ok=True)
+            if self.bleed:
+                self.bleedmaker.hideall()
+            elements_by_id = index_elements_by_id(self.document.getroot())
+            for id in self.exportids:
+                if id in elements_by_id:
+                    self.write_counter_svg(
+                        id,
+                        self.getbitmapfilename(
+                            id, self.options.countersvgdir, "svg"
+                        ),
+                        elements_by_id,
+                    )
+            if self.bleed:
+                self.bleedmaker.showall()
+
     def create_line(self, x1, y1, x2, y2, style):
         line = etree.Element("line")
         line.set("x1", str(x1))
@@ -1394,11 +3937,9 @@ class CountersheetEffect(inkex.Effect, SvgOutputMixin):
         )
 
     def find_style(self, styleid, failback):
-        style_elements = self.document.xpath(
-            "//*[@id='%s']" % styleid, namespaces=NSS
-        )
-        if len(style_elements) > 0:
-            style = style_elements[0].get("style")
+        style_element = self.index.find(styleid)
+        if style_element is not None:
+            style = style_element.get("style")
             if style is not None and len(style) > 0:
                 return style
         return failback
@@ -1407,7 +3948,29 @@ class CountersheetEffect(inkex.Effect, SvgOutputMixin):
         return self.find_style("cs_regstyle", DEFAULT_REGISTRATION_MARK_STYLE)
 
     def add_registration_line(self, x1, y1, x2, y2, layer):
-        layer.append(self.create_registrationline(x1, y1, x2, y2))
+        if self.compoundmarks:
+            self.add_mark(
+                layer, x1, y1, x2, y2, self.find_registration_line_style()
+            )
+        else:
+            layer.append(self.create_registrationline(x1, y1, x2, y2))
+
+    def add_mark(self, layer, x1, y1, x2, y2, style):
+        """Add a line to the path with that style in layer."""
+        key = (id(layer), style)
+        if key not in self.markpaths:
+            path = etree.Element("path")
+            path.set("style", style)
+            path.set("stroke-width", str(PS * 0.5))
+            layer.append(path)
+            self.markpaths[key] = MarkPath(path)
+        self.markpaths[key].add(x1, y1, x2, y2)
+
+    def finish_marks(self):
+        """Draw the lines added with add_mark since the last time."""
+        for markpath in self.markpaths.values():
+            markpath.update()
+        self.markpaths = {}
 
     def add_registration_line_both_sides(
         self, x1, y1, x2, y2, layer, backlayer, docwidth
@@ -1501,7 +4064,7 @@ class CountersheetEffect(inkex.Effect, SvgOutputMixin):
     def find_foldingline_style(self):
         return self.find_style("cs_foldstyle", DEFAULT_FOLDING_LINE_STYLE)
 
-    def create_foldingline(self, docwidth, docheight):
+    def foldingline_ends(self, docwidth, docheight):
         margin = max(
             self.registrationmarkslen + self.registrationmarksdist,
             self.outlinedist,
@@ -1511,19 +4074,27 @@ class CountersheetEffect(inkex.Effect, SvgOutputMixin):
         x2 = docwidth / 2
         y2 = docheight - margin
         self.logwrite("create_foldingline %f, %f, %f, %f\n" % (x1, y1, x2, y2))
+        return x1, y1, x2, y2
+
+    def create_foldingline(self, docwidth, docheight):
+        x1, y1, x2, y2 = self.foldingline_ends(docwidth, docheight)
         return self.create_line(x1, y1, x2, y2, self.find_foldingline_style())
 
     def add_foldingline(self, layer, docwidth, docheight):
-        layer.append(self.create_foldingline(docwidth, docheight))
+        if self.compoundmarks:
+            x1, y1, x2, y2 = self.foldingline_ends(docwidth, docheight)
+            self.add_mark(layer, x1, y1, x2, y2, self.find_foldingline_style())
+        else:
+            layer.append(self.create_foldingline(docwidth, docheight))
 
     def add_outlinemarks(self, layer, x1, y1, x2, y2):
         self.logwrite(
             "Outline rectangle around %f,%f %f,%f\n" % (x1, y1, x2, y2)
         )
-        layer.append(self.create_registrationline(x1, y1, x2, y1))
-        layer.append(self.create_registrationline(x1, y1, x1, y2))
-        layer.append(self.create_registrationline(x1, y2, x2, y2))
-        layer.append(self.create_registrationline(x2, y1, x2, y2))
+        self.add_registration_line(x1, y1, x2, y1, layer)
+        self.add_registration_line(x1, y1, x1, y2, layer)
+        self.add_registration_line(x1, y2, x2, y2, layer)
+        self.add_registration_line(x2, y1, x2, y2, layer)
 
     def from_len_arg(self, argvalue, name, allow_negative=False):
         if argvalue is None or len(argvalue) == 0:
@@ -1604,6 +4175,8 @@ class CountersheetEffect(inkex.Effect, SvgOutputMixin):
     def effect(self):
         global PS
 
+        GLOB_MATCHERS.clear()
+
         # Get script "--suffix" option value.
         suffix = self.options.suffix
 
@@ -1614,7 +4187,10 @@ class CountersheetEffect(inkex.Effect, SvgOutputMixin):
         self.bitmapname = self.options.bitmapname
 
         self.textmarkup = self.options.textmarkup == "true"
+        self.compactspans = self.options.compactspans == "true"
         self.bleed = self.options.bleed == "true"
+        self.reusecounters = self.options.reusecounters == "true"
+        self.refresh = self.options.refresh == "true"
         self.onlyone = self.options.onlyone == "true"
         self.oneside = self.options.oneside == "true"
         self.foldingline = self.options.foldingline == "true"
@@ -1642,6 +4218,8 @@ class CountersheetEffect(inkex.Effect, SvgOutputMixin):
         self.registrationmarksbothsides = (
             self.options.registrationmarksbothsides == "true"
         )
+        self.compoundmarks = self.options.compoundmarks == "true"
+        self.markpaths = {}
 
         self.logwrite(
             "full registration marks: %r\n" % self.fullregistrationmarks
@@ -1657,8 +4235,10 @@ class CountersheetEffect(inkex.Effect, SvgOutputMixin):
             self.defs = etree.Element(inkex.addNS("defs", "svg"))
             svg.append(self.defs)
 
+        self.defsregistry = DefsRegistry(self.defs)
+
         if self.bleed:
-            self.bleedmaker = BleedMaker(svg, self.defs)
+            self.bleedmaker = BleedMaker(self.defsregistry)
 
         self.registrationmarkslen = self.from_len_arg(
             self.options.registrationmarkslen, "registration marks length"
@@ -1694,12 +4274,43 @@ class CountersheetEffect(inkex.Effect, SvgOutputMixin):
         # to what "1px" always was in earlier Inkscape versions
         PS = self.svg.unittouu("%fin" % (1.0 / 90))
 
+        if self.refresh and not self.options.layoutplan:
+            # Before looking up templates, as the old counters may
+            # have copies of the template rectangles in them.
+            self.oldcounters = self.take_old_layers(svg, suffix)
+            # Faces that are not used by any counter when done are
+            # removed.
+            for element in self.defs:
+                if (element.get("id") or "").startswith("counterface_"):
+                    self.defsregistry.adopt(element)
+                    self.oldfaces.add(element.get("id"))
+
+        self.index = DocumentIndex(self.document.getroot())
+
         rects = {}
         for r in doc.xpath("//svg:rect", namespaces=NSS):
             rects[r.get("id")] = r
 
-        self.logwrite("queryAll for: %s\n" % sys.argv[-1])
-        self.geometry = self.queryAll(os.path.abspath(sys.argv[-1]))
+        if self.options.inkscapeshells > 0:
+            self.shells = InkscapeShellPool(
+                self.options.inkscapeshells, self.logwrite
+            )
+
+        self.exports = ExportScheduler(
+            self.options.exportworkers, self.logwrite
+        )
+
+        templatefile = os.path.abspath(sys.argv[-1])
+        if self.options.nativegeometry == "true":
+            self.logwrite("native geometry for: %s\n" % templatefile)
+            self.geometry = NativeGeometry(
+                self.svg,
+                lambda: self.query_template_geometry(templatefile),
+                self.logwrite,
+            )
+        else:
+            self.logwrite("queryAll for: %s\n" % templatefile)
+            self.geometry = self.query_template_geometry(templatefile)
 
         self.logwrite("Using data file %s.\n" % os.path.abspath(datafile))
 
@@ -1726,29 +4337,32 @@ class CountersheetEffect(inkex.Effect, SvgOutputMixin):
         parser = CSVCounterDefinitionParser(
             self.logwrite,
             rects,
-            self.defs,
+            self.defsregistry,
             os.path.dirname(datafile),
             self.onlyone,
         )
-        parser.parse(reader)
-        csv_file.close()
-        counters = parser.counters
-        hasback = parser.hasback
+        # Unless post() needs all the counters, they can be laid out
+        # while the data file is read, and forgotten after each sheet.
+        streaming = (
+            self.options.streamcounters == "true"
+            and type(self).post == CountersheetEffect.post
+        )
+        if streaming:
+            # Backs need a back layer from the first sheet, so read
+            # the file once first to find out if there are any.
+            for c in parser.iterparse(reader):
+                pass
+            csv_file.seek(0)
+            reader = csv.reader(csv_file, csv_dialect)
+            counters = parser.iterparse(reader)
+        else:
+            parser.parse(reader)
+            csv_file.close()
+            counters = parser.counters
 
         frontlayers = []
         backlayers = []
 
-        # Create a new layer.
-        layer = self.addLayer(svg, suffix, 1)
-
-        backlayer = None
-
-        if hasback:
-            if self.oneside:
-                backlayer = layer
-            else:
-                backlayer = self.create_backlayer(svg, suffix, 1)
-
         docwidth = self.getViewBoxWidth(svg)
         docheight = self.getViewBoxHeight(svg)
 
@@ -1782,183 +4396,234 @@ class CountersheetEffect(inkex.Effect, SvgOutputMixin):
                 "layout position %d: %f %f %f %f\n" % (n, p.x, p.y, p.w, p.h)
             )
 
-        row = 0
-        col = 0
-        colx = 0
-        rowy = 0
-        nextrowy = 0
-        box = 0
-        nr = 0
-        csn = 1
-
-        xregistrationmarks = set([0])
-        yregistrationmarks = set([0])
+        measure = lambda c, rotate: self.counter_size(c, rects, rotate)
+        if self.options.packing == "skyline":
+            planner = SkylinePlanner(
+                positions,
+                self.spacing,
+                docwidth,
+                self.options.rotatefronts,
+                self.options.rotatebacks,
+                measure,
+                self.logwrite,
+                self.before_counter,
+                self.options.turncounters == "true",
+                self.bleed,
+            )
+        else:
+            if self.options.packing == "rowsarray":
+                if numpy is None:
+                    sys.exit(
+                        "Rows (NumPy) packing needs NumPy, which could "
+                        "not be imported. Install NumPy or use Rows "
+                        "packing instead."
+                    )
+                rowsplanner = ArrayLayoutPlanner
+            else:
+                rowsplanner = LayoutPlanner
+            planner = rowsplanner(
+                positions,
+                self.spacing,
+                docwidth,
+                self.options.rotatefronts,
+                self.options.rotatebacks,
+                measure,
+                self.logwrite,
+                self.before_counter,
+            )
 
-        is_first_col = True
-        is_first_row = True
+        if self.options.layoutplan:
+            self.write_layout_plan(
+                self.options.layoutplan,
+                planner,
+                counters,
+                docwidth,
+                docheight,
+                parser.hasback,
+            )
+            if streaming:
+                csv_file.close()
+            if self.shells is not None:
+                self.shells.close()
+            if self.log:
+                self.log.close()
+            return
 
-        bstack = []
-        backxs = []
-        backys = []
+        frontbackground = self.find_layer(svg, "cs_background_front", suffix)
+        backbackground = self.find_layer(svg, "cs_background_back", suffix)
 
-        for i, c in enumerate(counters):
-            self.before_counter(c)
-            while c.can_add_another():
-                last_on_row = False
-                last_in_box = False
-                last_on_sheet = False
-                nr = nr + 1
-                self.logwrite(
-                    "laying out counter %d (nr %d/%r, c.nr %d)"
-                    " (hasback: %s)\n"
-                    % (i, nr, c.repeat.nr, c.repeat.keep_going, c.hasback)
+        # Unless post() needs all the counters, each sheet can be
+        # written to its own file, and dropped, when it is full.
+        # Except when something on it has to wait for the end:
+        # inline images, or backgrounds with the number of sheets.
+        sheetsvgdir = None
+        if (
+            self.options.sheetsvgdir
+            and type(self).post == CountersheetEffect.post
+        ):
+            sheetsvgdir = self.options.sheetsvgdir
+            if self.options.countersvgdir or (
+                self.options.bitmapdir
+                and self.options.bitmapwidth > 0
+                and self.options.bitmapheight > 0
+            ):
+                sys.exit(
+                    "Can not export counters by id when the sheets are "
+                    "written to separate files. Set the ID bitmap width "
+                    "to 0 and remove the counter SVG output directory."
                 )
-                c.addsubst("autonumber", str(nr))
+            os.makedirs(sheetsvgdir, exist_ok=True)
+        waitforall = any(
+            b is not None and "%SHEETS%" in "".join(b.itertext())
+            for b in (frontbackground, backbackground)
+        )
+        persheet = streaming or sheetsvgdir is not None
+        nrplaceholders = 0
+
+        # Create a new layer.
+        layer = self.addLayer(svg, suffix, 1)
+
+        backlayer = None
+
+        if parser.hasback:
+            if self.oneside:
+                backlayer = layer
+            else:
+                backlayer = self.create_backlayer(svg, suffix, 1)
+
+        csn = 1
+        sheetcounters = []
+
+        steps = planner.plan(counters)
+        if (
+            self.options.generationworkers > 1
+            and not streaming
+            and not self.reusecounters
+            and type(self).before_counter == CountersheetEffect.before_counter
+        ):
+            steps = list(steps)
+            self.pregenerate(steps, planner.backs, rects)
+
+        for step in steps:
+            if isinstance(step, Placement):
+                c = step.counter
+                if persheet and (
+                    not sheetcounters or sheetcounters[-1] is not c
+                ):
+                    sheetcounters.append(c)
+                c.addsubst("autonumber", str(step.nr))
                 if c.hasback:
-                    c.back.addsubst("autonumber", str(nr))
-                xregistrationmarks.add(colx)
-                yregistrationmarks.add(rowy)
+                    c.back.addsubst("autonumber", str(step.nr))
                 self.logwrite("   adding front\n")
                 width, height = self.generatecounter(
                     c,
                     rects,
                     layer,
-                    positions[box].x + colx,
-                    positions[box].y + rowy,
-                    self.options.rotatefronts,
+                    step.x,
+                    step.y,
+                    step.rotation,
+                    self.pregenerated.pop((step, False), None),
                 )
                 self.logwrite(
                     "generated counter size: %fx%f\n" % (width, height)
                 )
-                c.bleed_left.append(is_first_col or self.spacing > 0)
-                is_first_col = False
-                c.bleed_up.append(is_first_row or self.spacing > 0)
-                if c.hasback:
-                    bstack.append(c)
-                    backxs.append(positions[box].x + colx + width)
-                    backys.append(positions[box].y + rowy)
-                col = col + 1
-                xregistrationmarks.add(colx + width)
-                colx = colx + width + self.spacing
-                if rowy + height + self.spacing > nextrowy:
-                    nextrowy = rowy + height + self.spacing
-                    yregistrationmarks.add(rowy + height)
+                c.bleed_left.append(step.bleed_left)
+                c.bleed_up.append(step.bleed_up)
+            elif isinstance(step, LayoutBox):
+                self.addregistrationmarks(
+                    step.xmarks,
+                    step.ymarks,
+                    step.position,
+                    layer,
+                    backlayer,
+                    docwidth,
+                )
+            else:
+                csn = step.number + 1
+                if parser.hasback:
+                    self.addbacks(backlayer, step.backs, rects)
+                    if not self.oneside:
+                        svg.append(backlayer)
+                        self.index.add(backlayer)
+                        backlayers.append((backlayer, csn - 1))
+                        self.cslayers.append(backlayer.get("id"))
+                        backlayer = self.create_backlayer(svg, suffix, csn)
+                    if self.foldingline:
+                        self.add_foldingline(layer, docwidth, docheight)
+                self.finish_marks()
+                if persheet and self.bleed:
+                    self.bleedmaker.add_bleed_to(sheetcounters)
+                svg.append(layer)
+                self.index.add(layer)
+                frontlayers.append((layer, csn - 1))
+                self.cslayers.append(layer.get("id"))
                 if (
-                    colx + width > positions[box].w + BOX_MARGIN
-                    or (c.endbox and not c.must_add_another())
-                    or (c.endrow and not c.must_add_another())
+                    sheetsvgdir is not None
+                    and not waitforall
+                    and len(self.placeholders) == nrplaceholders
                 ):
-                    last_on_row = True
-                    col = 0
-                    colx = 0
-                    row = row + 1
-                    rowy = nextrowy
-                    nextrowy = rowy
-                    self.logwrite("new row %d (y=%f)\n" % (row, rowy))
-                    is_first_col = True
-                    is_first_row = False
-                    if (
-                        nextrowy + height > positions[box].h + BOX_MARGIN
-                        or c.endbox
-                    ):
-                        last_in_box = True
-                        self.addregistrationmarks(
-                            xregistrationmarks,
-                            yregistrationmarks,
-                            positions[box],
-                            layer,
-                            backlayer,
-                            docwidth,
-                        )
-                        xregistrationmarks = set([0])
-                        yregistrationmarks = set([0])
-                        box = box + 1
-                        self.logwrite(
-                            " now at box %d of %d\n" % (box, len(positions))
-                        )
-                        self.logwrite(
-                            " i: %d    len(counters): %d\n"
-                            % (i, len(counters))
-                        )
-                        row = 0
-                        rowy = 0
-                        nextrowy = 0
-                        is_first_row = True
-                        if box == len(positions) and i < len(counters):
-                            last_on_sheet = True
-                            csn = csn + 1
-                            if hasback:
-                                self.addbacks(
-                                    backlayer,
-                                    bstack,
-                                    backxs,
-                                    backys,
-                                    docwidth,
-                                    rects,
-                                )
-                                bstack = []
-                                backxs = []
-                                backys = []
-                                if not self.oneside:
-                                    svg.append(backlayer)
-                                    backlayers.append((backlayer, csn - 1))
-                                    self.cslayers.append(backlayer.get("id"))
-                                    backlayer = self.create_backlayer(
-                                        svg, suffix, csn
-                                    )
-                                if self.foldingline:
-                                    self.add_foldingline(
-                                        layer, docwidth, docheight
-                                    )
-                            svg.append(layer)
-                            frontlayers.append((layer, csn - 1))
-                            self.cslayers.append(layer.get("id"))
-                            layer = self.addLayer(svg, suffix, csn)
-                            box = 0
-                            if self.oneside:
-                                backlayer = layer
-                c.added_one(last_on_row, last_in_box, last_on_sheet)
-
-        if (
-            len(xregistrationmarks) > 1 or len(yregistrationmarks) > 1
-        ) and len(layer.getchildren()):
+                    # The number of sheets is not needed (or known) yet.
+                    self.write_sheet_files(
+                        svg, frontlayers, frontbackground, None, csn - 1
+                    )
+                    self.write_sheet_files(
+                        svg, backlayers, backbackground, None, csn - 1
+                    )
+                    self.forget_counters(sheetcounters)
+                nrplaceholders = len(self.placeholders)
+                sheetcounters = []
+                layer = self.addLayer(svg, suffix, csn)
+                if self.oneside:
+                    backlayer = layer
+
+        hasmarks = len(planner.xmarks) > 1 or len(planner.ymarks) > 1
+        if hasmarks and len(layer.getchildren()):
             self.addregistrationmarks(
-                xregistrationmarks,
-                yregistrationmarks,
-                positions[box],
+                planner.xmarks,
+                planner.ymarks,
+                positions[planner.box],
                 layer,
                 backlayer,
                 docwidth,
             )
 
-        if hasback:
-            self.addbacks(backlayer, bstack, backxs, backys, docwidth, rects)
+        if streaming:
+            csv_file.close()
+            counters = sheetcounters
+
+        if parser.hasback:
+            self.addbacks(backlayer, planner.backs, rects)
 
         if self.foldingline:
             self.add_foldingline(layer, docwidth, docheight)
 
+        self.finish_marks()
+
         if self.bleed:
-            self.logwrite(" add_bleed_to %d\n" % len(counters))
-            self.bleedmaker.add_bleed_to(counters)
+            bleedcounters = sheetcounters if persheet else counters
+            self.logwrite(" add_bleed_to %d\n" % len(bleedcounters))
+            self.bleedmaker.add_bleed_to(bleedcounters)
 
-        if not self.oneside and hasback and len(backlayer.getchildren()):
+        if (
+            not self.oneside
+            and parser.hasback
+            and len(backlayer.getchildren())
+        ):
             svg.append(backlayer)
+            self.index.add(backlayer)
             backlayers.append((backlayer, csn))
             self.cslayers.append(backlayer.get("id"))
 
         if len(layer.getchildren()):
             svg.append(layer)
+            self.index.add(layer)
             frontlayers.append((layer, csn))
             self.cslayers.append(layer.get("id"))
 
         nrsheets = max(len(frontlayers), len(backlayers))
 
         if len(self.placeholders) > 0:
-            tmpfile = self.make_temporary_svg()
-            self.logwrite(
-                "Placeholders replace temporary file: %s\n" % tmpfile
-            )
-            geometry = self.queryAll(tmpfile)
+            geometry = self.query_placeholders()
             for spanid, info in self.placeholders.items():
                 if not spanid in geometry:
                     self.logwrite("Could not query location for %s." % spanid)
@@ -1983,7 +4648,7 @@ class CountersheetEffect(inkex.Effect, SvgOutputMixin):
                 image.set("width", str(position.w))
                 image.set("height", str(position.h - dim_diff))
                 group = find_top_level_group_for(info["parent"])
-                transform = group.get("transform")
+                transform = group.attrib.get("transform")
                 translate = self.translatere.match(transform)
                 if translate:
                     dx -= float(translate.group(1))
@@ -1997,21 +4662,42 @@ class CountersheetEffect(inkex.Effect, SvgOutputMixin):
 
         self.logwrite("nrsheets: %d\n" % nrsheets)
         self.logwrite("layers in self.cslayers: %d\n" % len(self.cslayers))
-        self.add_layer_backgrounds(
-            frontlayers,
-            self.find_layer(svg, "cs_background_front", suffix),
-            nrsheets,
-        )
-        self.add_layer_backgrounds(
-            backlayers,
-            self.find_layer(svg, "cs_background_back", suffix),
-            nrsheets,
-        )
-
+        if sheetsvgdir is not None:
+            self.write_sheet_files(svg, frontlayers, frontbackground, nrsheets)
+            self.write_sheet_files(svg, backlayers, backbackground, nrsheets)
+        else:
+            self.add_layer_backgrounds(frontlayers, frontbackground, nrsheets)
+            self.add_layer_backgrounds(backlayers, backbackground, nrsheets)
+
+        if self.options.exportcache == "true":
+            self.exportcache = ExportCache(
+                self.document.getroot(),
+                self.bitmapname,
+                self.logwrite,
+                lambda href: self.absolute_href(href, os.getcwd()),
+            )
         exportedbitmaps = self.exportIDBitmaps()
-        self.post(counters)
+        self.exportCounterSVGs()
+        if not streaming:
+            self.post(counters)
+            if type(self).post != CountersheetEffect.post:
+                # post() may have changed anything in the document.
+                self.index = DocumentIndex(self.document.getroot())
+                self.exportpass = None
         self.exportSheetBitmaps()
         self.exportSheetPDFs()
+        self.exports.wait()
+        if self.exportcache is not None:
+            self.exportcache.save()
+        if self.shells is not None:
+            self.shells.close()
+
+        if self.oldfaces:
+            for eid in self.defsregistry.prune(self.oldfaces):
+                self.logwrite("removed unused old %s\n" % eid)
+        if self.options.prunedefs == "true":
+            for eid in self.defsregistry.prune():
+                self.logwrite("removed unused %s\n" % eid)
 
         if self.log:
             self.log.close()
@@ -2022,12 +4708,91 @@ class CountersheetEffect(inkex.Effect, SvgOutputMixin):
         for target, nr in layers:
             self.logwrite("  add layer background %d\n" % nr)
             background = deepcopy(sheet_template)
-            string_replace_xml_text(background, "%SHEET%", str(nr))
-            string_replace_xml_text(background, "%SHEETS%", str(nrsheets))
+            replace_xml_text(
+                background.iter(), {"SHEET": str(nr), "SHEETS": str(nrsheets)}
+            )
             del background.attrib[inkex.addNS("groupmode", "inkscape")]
             del background.attrib[inkex.addNS("label", "inkscape")]
             self.set_style(background, "display", None)
             target.insert(0, background)
+            self.index.add(background)
+
+    def write_sheet_files(
+        self, svg, layers, sheet_template, nrsheets, sheet=None
+    ):
+        """Write each of layers (with sheet numbers) that is not
+        written yet, or only those of the given sheet, to its own SVG
+        file in the sheet SVG directory, with its background, and put
+        a layer with only an image of that file in its place, both in
+        svg and in layers."""
+        for i, (layer, nr) in enumerate(layers):
+            if layer.get(CS_SHEETFILE) is not None:
+                continue
+            if sheet is not None and nr != sheet:
+                continue
+            self.add_layer_backgrounds([(layer, nr)], sheet_template, nrsheets)
+            filename = os.path.abspath(
+                os.path.join(
+                    self.options.sheetsvgdir, "%s.svg" % layer.get("id")
+                )
+            )
+            self.write_sheet_svg(svg, layer, filename)
+            self.logwrite("wrote sheet %d to %s\n" % (nr, filename))
+            index = etree.Element(inkex.addNS("g", "svg"))
+            for name in (
+                "id",
+                inkex.addNS("label", "inkscape"),
+                inkex.addNS("groupmode", "inkscape"),
+            ):
+                index.set(name, layer.get(name))
+            index.set(CS_SHEETFILE, filename)
+            image = etree.SubElement(index, inkex.addNS("image", "svg"))
+            image.set(inkex.addNS("href", "xlink"), filename)
+            image.set("x", "0")
+            image.set("y", "0")
+            image.set("width", str(self.getViewBoxWidth(svg)))
+            image.set("height", str(self.getViewBoxHeight(svg)))
+            svg.replace(layer, index)
+            self.index.remove(layer)
+            self.index.add(index)
+            layers[i] = (index, nr)
+
+    def write_sheet_svg(self, svg, layer, filename):
+        """Write layer to filename as a standalone SVG, with the same
+        attributes and style sheets as svg, and what it refers to in
+        defs. The elements are written as they are in the document,
+        one at a time, without copying them first."""
+        for image in layer.iter(inkex.addNS("image", "svg")):
+            for name in HREF_ATTRIBUTES:
+                href = image.attrib.get(name)
+                if href and not re.match("(data|file|https?):|#", href):
+                    image.set(name, self.absolute_href(href, os.getcwd()))
+        referenced = find_referenced_elements([layer], svg)
+        with etree.xmlfile(filename, encoding="utf-8") as xf:
+            xf.write_declaration()
+            with xf.element(svg.tag, dict(svg.attrib), nsmap=svg.nsmap):
+                with xf.element(inkex.addNS("defs", "svg")):
+                    for element in referenced:
+                        xf.write(element, with_tail=False)
+                for style in svg.iter(inkex.addNS("style", "svg")):
+                    xf.write(style, with_tail=False)
+                xf.write(layer, with_tail=False)
+
+    def forget_counters(self, counters):
+        """Let go of the elements generated so far for counters, once
+        they have been written to sheet files."""
+        for c in counters:
+            sides = [c, c.back] if c.hasback else [c]
+            for side in sides:
+                if self.bleed:
+                    self.bleedmaker.forget(side.elements)
+                for element in side.elements:
+                    href = element.get(inkex.addNS("href", "xlink"))
+                    if href is not None:
+                        self.defsregistry.unref(href[1:])
+                del side.elements[:]
+            del c.bleed_left[:]
+            del c.bleed_up[:]
 
     def create_backlayer(self, svg, suffix, csn):
         backlayer = self.addLayer(svg, suffix, csn, "back")
@@ -2068,6 +4833,18 @@ class CSVCounterDefinitionParser:
         for row in reader:
             factory = self.parse_row(row, factory)
 
+    def iterparse(self, reader):
+        """Like parse, but yields the counters instead of keeping them
+        in self.counters. A counter is yielded when the row after it
+        has been read, as an ENDBOX or ENDROW row changes it."""
+        factory = None
+        for row in reader:
+            factory = self.parse_row(row, factory)
+            while len(self.counters) > 1:
+                yield self.counters.pop(0)
+        while len(self.counters) > 0:
+            yield self.counters.pop(0)
+
     def parse_row(self, row, factory):
         if self.is_counterrow(factory, row):
             return self.parse_counter_row(row, factory)
@@ -2382,13 +5159,10 @@ class AttributeLayout:
         setting.set(CounterAttribute(self.aid, aname, value))
 
     def color_lookup(self, color):
-        found_id = self.defs.xpath("*[@id='%s']" % color, namespaces=NSS)
-        found_href = self.defs.xpath(
-            "*[@xlink:href='#%s']" % color, namespaces=NSS
-        )
-        if len(found_href) > 0:
-            return make_def_ref(found_href[0].get("id"))
-        elif len(found_id) > 0:
+        found_href = self.defs.linking_to(color)
+        if found_href is not None:
+            return make_def_ref(found_href.get("id"))
+        elif self.defs.get(color) is not None:
             return make_def_ref(color)
         else:
             return color
@@ -2519,15 +5293,212 @@ def is_valid_name_to_replace(s):
     return bool(validreplacenamere.match(s))
 
 
-def string_replace_xml_text(element, pattern, value):
-    """Find all text in XML element and its children
-    and replace %name% with value."""
-    if value is None:
+def counter_signature(counter, plans):
+    """Everything that decides how the parts of counter look when
+    made from plans (the TemplatePlans of its parts), as a tuple.
+    Substitutions that can not change any of the parts are left out,
+    so for instance autonumber only makes counters different when a
+    template uses it."""
+    values = [v for v in counter.subst.values() if v]
+    for attr in counter.attrs.values():
+        values.extend(attr.values())
+    substs = tuple(
+        (name, value)
+        for name, value in counter.subst.items()
+        if name is not None
+        and (
+            any(plan.depends_on(name) for plan in plans)
+            or any("%%%s%%" % name in v for v in values)
+        )
+    )
+    attrs = tuple(
+        (glob, tuple(attr.items())) for glob, attr in counter.attrs.items()
+    )
+    return (
+        counter.id,
+        tuple(counter.parts),
+        substs,
+        attrs,
+        tuple(counter.includeids),
+        tuple(counter.excludeids),
+    )
+
+
+def has_percent(element):
+    """True if element has a % in its text, tail or attributes (other
+    than id), so that it could have a %name% to replace."""
+    if "%" in (element.text or "") or "%" in (element.tail or ""):
+        return True
+    if isinstance(element.tag, str):
+        for name, value in element.attrib.items():
+            if "%" in value and name != "id":
+                return True
+    return False
+
+
+substitution_patterns = {}
+
+
+def substitution_pattern(names):
+    """A regular expression matching %name% for all of names that are
+    valid names to replace, or None if there are none."""
+    key = tuple(names)
+    if key not in substitution_patterns:
+        valid = [re.escape(n) for n in names if is_valid_name_to_replace(n)]
+        if valid:
+            pattern = re.compile("%%(%s)%%" % "|".join(valid))
+        else:
+            pattern = None
+        substitution_patterns[key] = pattern
+    return substitution_patterns[key]
+
+
+def replace_xml_text(elements, values):
+    """Replace %name% with values[name] (unless that is None) in the
+    text, tail and attributes (other than id) of each of elements, in
+    one pass over them. The names are replaced in the order of values,
+    so a value with a %name% in it has that replaced too if name comes
+    later. Ids are left alone as other substitutions find elements by
+    them."""
+    pattern = substitution_pattern(values)
+    if pattern is None:
+        return
+    replacements = [
+        ("%%%s%%" % name, value)
+        for name, value in values.items()
+        if value is not None and is_valid_name_to_replace(name)
+    ]
+
+    def replace(text):
+        if "%" not in text or not pattern.search(text):
+            return text
+        for token, value in replacements:
+            if token in text:
+                text = text.replace(token, value)
+        return text
+
+    done = set()
+    for element in elements:
+        if element in done:
+            continue
+        done.add(element)
+        if element.text:
+            element.text = replace(element.text)
+        if element.tail:
+            element.tail = replace(element.tail)
+        if isinstance(element.tag, str):
+            for name, old in element.attrib.items():
+                if name != "id":
+                    new = replace(old)
+                    if new != old:
+                        element.set(name, new)
+
+
+def join_spans(spans):
+    """Sorted (start, end) spans, with overlapping or touching spans
+    joined into one."""
+    joined = []
+    for start, end in sorted(spans):
+        if joined and start <= joined[-1][1]:
+            joined[-1] = (joined[-1][0], max(joined[-1][1], end))
+        else:
+            joined.append((start, end))
+    return joined
+
+
+def effective_style(inherited, style):
+    """The properties a span with style has when it is in something
+    with the inherited properties."""
+    effective = dict(inherited)
+    for name, value in style.items():
+        if name == "font":
+            for other in list(effective):
+                if other.startswith("font-"):
+                    del effective[other]
+        effective[name] = value
+    return effective
+
+
+def is_relative_style_value(value):
+    """True if value depends on what the parent has, so that it means
+    something else when repeated in a child."""
+    value = value.strip().lower()
+    return (
+        "%" in value
+        or value.endswith("em")
+        or value.endswith("ex")
+        or value in ("bolder", "lighter", "larger", "smaller", "currentcolor")
+    )
+
+
+def add_span_text(parent, index, text):
+    """Add text to parent where a child at index would start."""
+    if not text:
         return
-    if element.text:
-        element.text = element.text.replace(pattern, value)
-    for c in element.getchildren():
-        string_replace_xml_text(c, pattern, value)
+    if index == 0:
+        parent.text = (parent.text or "") + text
+    else:
+        parent[index - 1].tail = (parent[index - 1].tail or "") + text
+
+
+def compact_spans(element, inherited, keep):
+    """Make the spans in element fewer and shorter without changing
+    what they look like: properties they would inherit anyway are left
+    out, spans without style are replaced by their contents, empty
+    spans removed and neighbours with the same style joined. The spans
+    in keep (and their ids) are left as they are."""
+    i = 0
+    while i < len(element):
+        child = element[i]
+        if child in keep:
+            i += 1
+            continue
+        style = inkex.Style(child.get("style", ""))
+        if "font" not in style:
+            for name, value in list(style.items()):
+                if (
+                    name in INHERITED_TEXT_STYLE
+                    and inherited.get(name) == value
+                    and not is_relative_style_value(value)
+                ):
+                    del style[name]
+        if style:
+            child.set("style", str(style))
+            i += 1
+            continue
+        grandchildren = list(child)
+        element.remove(child)
+        add_span_text(element, i, child.text)
+        for n, grandchild in enumerate(grandchildren):
+            element.insert(i + n, grandchild)
+        add_span_text(element, i + len(grandchildren), child.tail)
+    i = 0
+    while i < len(element):
+        child = element[i]
+        following = child.getnext()
+        if child in keep:
+            i += 1
+        elif not child.text and len(child) == 0:
+            element.remove(child)
+            add_span_text(element, i, child.tail)
+        elif (
+            following is not None
+            and following not in keep
+            and not child.tail
+            and following.tag == child.tag
+            and following.get("style") == child.get("style")
+        ):
+            add_span_text(child, len(child), following.text)
+            for grandchild in list(following):
+                child.append(grandchild)
+            child.tail = following.tail
+            element.remove(following)
+        else:
+            i += 1
+    for child in element:
+        if child not in keep:
+            style = inkex.Style(child.get("style", ""))
+            compact_spans(child, effective_style(inherited, style), keep)
 
 
 def find_file(filename, extra_paths=None):
@@ -2558,6 +5529,214 @@ def get_search_paths(filename, extra_paths=None):
     ]
 
 
+NATIVE_GEOMETRY_SHAPES = (
+    inkex.PathElement,
+    inkex.Rectangle,
+    inkex.Circle,
+    inkex.Ellipse,
+    inkex.Line,
+    inkex.Polyline,
+    inkex.Polygon,
+)
+
+NATIVE_GEOMETRY_MARKERS = (
+    "marker",
+    "marker-start",
+    "marker-mid",
+    "marker-end",
+)
+
+
+def raw_transform(element):
+    """Transform of element, from the attribute value without
+    going through inkex (that would rewrite the attribute)."""
+    return inkex.Transform(element.attrib.get("transform"))
+
+
+def raw_composed_transform(element):
+    """All transforms from the root down to (and including) element,
+    like composed_transform in inkex but without rewriting
+    any attributes."""
+    transform = inkex.Transform()
+    while isinstance(element, etree.ElementBase):
+        transform = raw_transform(element) @ transform
+        element = element.getparent()
+    return transform
+
+
+def raw_style_value(element, name, default=None, inherited=False):
+    """Value of style property name for element, from the style
+    attribute or a presentation attribute. Looks at parents too
+    for inherited properties. Does not know about CSS stylesheets."""
+    while isinstance(element, etree.ElementBase):
+        value = inkex.Style(element.attrib.get("style", "")).get(name)
+        if value is None:
+            value = element.attrib.get(name)
+        if value is not None and value != "inherit":
+            return value.strip()
+        if not inherited:
+            break
+        element = element.getparent()
+    return default
+
+
+def read_chunks(stream, chunks):
+    """Put everything read from stream in the queue chunks, then None."""
+    with stream:
+        for chunk in iter(lambda: os.read(stream.fileno(), 1 << 16), b""):
+            chunks.put(chunk)
+    chunks.put(None)
+
+
+def inkscape_version():
+    """Version of Inkscape as a tuple, like (1, 2), or () if unknown."""
+    try:
+        out = inkex.command.call(INKSCAPE_EXECUTABLE_NAME, "--version")
+    except (
+        inkex.command.CommandNotFound,
+        inkex.command.ProgramRunError,
+        OSError,
+    ):
+        return ()
+    match = re.search(r"Inkscape (\d+)\.(\d+)", out)
+    if match is None:
+        return ()
+    return (int(match.group(1)), int(match.group(2)))
+
+
+def inkscape_version_key():
+    """Something that changes when Inkscape is upgraded, without
+    having to run Inkscape to find out."""
+    try:
+        executable = which(INKSCAPE_EXECUTABLE_NAME)
+        stat = os.stat(executable)
+        executable = "%s %d %d" % (executable, stat.st_size, stat.st_mtime)
+    except (OSError, IOError):
+        executable = INKSCAPE_EXECUTABLE_NAME
+    return "%s %s" % (getattr(inkex, "__version__", ""), executable)
+
+
+def font_directories_stamp():
+    """Something that changes when fonts are installed or removed: the
+    modification times of FONT_DIRECTORIES and the directories in
+    them."""
+    stamps = []
+    for top in FONT_DIRECTORIES:
+        for directory, subdirectories, files in os.walk(top):
+            try:
+                stamps.append(
+                    "%s %d" % (directory, os.stat(directory).st_mtime_ns)
+                )
+            except OSError:
+                pass
+    return "\n".join(stamps)
+
+
+urlrefre = re.compile(r"url\(\s*['\"]?#([^)'\"]+)['\"]?\s*\)")
+
+HREF_ATTRIBUTES = (inkex.addNS("href", "xlink"), "href")
+
+
+def referenced_ids(element, descendants=True):
+    """Ids referenced (url(#id) or href="#id") from element
+    or any of its descendants."""
+    ids = []
+    for e in element.iter() if descendants else [element]:
+        for name, value in e.attrib.items():
+            if name in HREF_ATTRIBUTES and value.startswith("#"):
+                ids.append(value[1:])
+            elif "url(" in value:
+                ids.extend(urlrefre.findall(value))
+    return ids
+
+
+def index_elements_by_id(svg):
+    """The first element in svg with each id, as dict."""
+    elements_by_id = {}
+    for e in svg.iter():
+        elements_by_id.setdefault(e.attrib.get("id"), e)
+    return elements_by_id
+
+
+def find_referenced_elements(roots, svg, elements_by_id=None, ancestors=()):
+    """Elements (outside of roots) that any of roots refers
+    to, directly or indirectly, for instance gradients, clip paths,
+    or the originals of clones. In the order they are found.
+    References from the attributes of ancestors (but not their
+    other children) are also followed. elements_by_id (first
+    element in svg with each id) is made from svg unless given."""
+    found = []
+    pending = [i for a in ancestors for i in referenced_ids(a, False)]
+    pending += [i for root in roots for i in referenced_ids(root)]
+    if not pending:
+        return found
+    inside = set()
+    for root in roots:
+        inside.update(root.iter())
+    if elements_by_id is None:
+        elements_by_id = index_elements_by_id(svg)
+    for ref in pending:
+        element = elements_by_id.get(ref)
+        if element is None or element in inside:
+            continue
+        found.append(element)
+        inside.update(element.iter())
+        pending.extend(referenced_ids(element))
+    return found
+
+
+def image_file_stamp(image, resolve_href=os.path.abspath):
+    """Size and modification time of the file an image element links
+    to (with resolve_href making a relative link absolute), or empty
+    if it is embedded or can not be found."""
+    href = ""
+    for name in HREF_ATTRIBUTES:
+        href = image.attrib.get(name, "")
+        if href:
+            break
+    if href.startswith("file://"):
+        href = href[len("file://") :]
+    elif not href or re.match("(data|https?):|#", href):
+        return ""
+    try:
+        href = resolve_href(href)
+        st = os.stat(href)
+    except (OSError, ValueError, inkex.utils.AbortExtension):
+        return ""
+    return "%s %d %d" % (href, st.st_size, st.st_mtime_ns)
+
+
+def make_minimal_svg(svg, elements, elements_by_id=None):
+    """A new SVG root with the same attributes and style sheets as svg,
+    but only deep copies of elements (inside copies, without other
+    children, of their ancestors), and the elements they refer to
+    (in defs)."""
+    root = etree.Element(svg.tag, nsmap=svg.nsmap)
+    for name, value in svg.attrib.items():
+        root.set(name, value)
+    defs = etree.SubElement(root, inkex.addNS("defs", "svg"))
+    for style in svg.iter(inkex.addNS("style", "svg")):
+        root.append(deepcopy(style))
+    copies = {svg: root}
+    ancestors = []
+    for element in elements:
+        for ancestor in reversed(list(element.iterancestors())):
+            if ancestor not in copies:
+                copy = etree.SubElement(
+                    copies[ancestor.getparent()], ancestor.tag
+                )
+                for name, value in ancestor.attrib.items():
+                    copy.set(name, value)
+                copies[ancestor] = copy
+                ancestors.append(ancestor)
+        copies[element.getparent()].append(deepcopy(element))
+    for element in find_referenced_elements(
+        elements, svg, elements_by_id, ancestors
+    ):
+        defs.append(deepcopy(element))
+    return root
+
+
 def make_def_ref(color):
     return "url(#%s)" % color
 
@@ -18,6 +18,16 @@ import countersheetstyletest
 import countertest
 import csvcounterdefinitionparsertest
 import csvcounterfactorytest
+import geometrycachetest
+import nativegeometrytest
+import referencestest
+import inkscapeshelltest
+import exportschedulertest
+import exportcachetest
+import exportplantest
+import templateplantest
+import globmatchertest
+import layoutplannertest
 
 #FIXME it is a bit silly to manually list all tests like this
 
@@ -30,10 +40,31 @@ tests = (countersheetstest.CountersheetsTest,
          countersheetstest.LayerTranslationTest,
          countersheetstest.ParseLengthTest,
          countersheetstest.DocumentTopLeftCoordinateConverterTest,
+         countersheetstest.MarkPathTest,
+         countersheetstest.DefsRegistryTest,
+         countersheetstest.DocumentIndexTest,
+         countersheetstest.RefreshSignatureTest,
+         countersheetstest.TextMarkupTest,
+         countersheetstest.SetFormattedTextTest,
+         countersheetstest.ReplaceXmlTextTest,
+         countersheetstest.CompactSpansTest,
          countertest.SingleCounterTest,
          csvcounterdefinitionparsertest.CSVCounterDefinitionParserTest,
          csvcounterfactorytest.CSVCounterFactoryTest,
          countersheetstyletest.CountersheetStyleTest,
+         countersheetstyletest.StyleCacheTest,
+         geometrycachetest.GeometryCacheTest,
+         nativegeometrytest.NativeGeometryTest,
+         referencestest.ReferencesTest,
+         inkscapeshelltest.InkscapeShellTest,
+         exportschedulertest.ExportSchedulerTest,
+         exportcachetest.ExportCacheTest,
+         exportplantest.ExportPlanTest,
+         templateplantest.TemplatePlanTest,
+         globmatchertest.GlobMatcherTest,
+         layoutplannertest.LayoutPlannerTest,
+         layoutplannertest.SkylinePlannerTest,
+         layoutplannertest.ArrayLayoutPlannerTest,
          )
 
 if __name__ == '__main__':
@@ -270,5 +270,245 @@ class ParseLengthTest(unittest.TestCase):
     def test_0(self):
         self.check_parse("0", 0.0)
 
+class MarkPathTest(unittest.TestCase):
+    def setUp(self):
+        self.path = countersheet.etree.Element("path")
+        self.marks = countersheet.MarkPath(self.path)
+
+    def test_same_line_once(self):
+        self.marks.add(0, 0, 0, 10)
+        self.marks.add(0, 10, 0, 0)
+        self.marks.update()
+        self.assertEqual("M 0,0 0,10", self.path.get("d"))
+
+    def test_join_overlapping_lines(self):
+        self.marks.add(5, 0, 5, 10)
+        self.marks.add(5, 10, 5, 15)
+        self.marks.add(5, 12, 5, 20)
+        self.marks.add(5, 30, 5, 40)
+        self.marks.add(20, 2, 0, 2)
+        self.marks.add(1, 1, 2, 2)
+        self.assertEqual([(1, 1, 2, 2), (5, 0, 5, 20), (5, 30, 5, 40),
+                          (0, 2, 20, 2)],
+                         self.marks.strokes())
+
+DEFS = """<defs xmlns="http://www.w3.org/2000/svg"
+    xmlns:xlink="http://www.w3.org/1999/xlink">
+  <linearGradient id="red"/>
+  <linearGradient id="redlink" xlink:href="#red"/>
+  <linearGradient id="blue"/>
+</defs>"""
+
+class DefsRegistryTest(unittest.TestCase):
+    def setUp(self):
+        self.defs = countersheet.etree.fromstring(DEFS)
+        self.registry = countersheet.DefsRegistry(self.defs)
+
+    def test_color_lookup(self):
+        layout = countersheet.AttributeLayout("r[style:fill]", {},
+                                              self.registry)
+        self.assertEqual("url(#redlink)", layout.color_lookup("red"))
+        self.assertEqual("url(#blue)", layout.color_lookup("blue"))
+        self.assertEqual("green", layout.color_lookup("green"))
+
+    def test_prune_unused(self):
+        for eid in ["a", "b"]:
+            element = countersheet.etree.Element("clipPath")
+            element.set("id", eid)
+            self.registry.add(element)
+        self.registry.ref("a")
+        self.registry.ref("b")
+        self.registry.ref("red")
+        self.registry.unref("b")
+        self.assertEqual(["b"], self.registry.prune())
+        self.assertEqual(["red", "redlink", "blue", "a"],
+                         [e.get("id") for e in self.defs])
+        self.assertEqual(None, self.registry.get("b"))
+        self.assertEqual([], self.registry.prune())
+
+    def test_prune_adopted(self):
+        self.registry.adopt(self.registry.get("red"))
+        self.registry.adopt(self.registry.get("blue"))
+        self.registry.ref("blue")
+        self.assertEqual([], self.registry.prune(["a"]))
+        self.assertEqual(["red"], self.registry.prune(["red", "blue"]))
+        self.assertEqual(["redlink", "blue"],
+                         [e.get("id") for e in self.defs])
+
+DOCUMENT = """<svg xmlns="http://www.w3.org/2000/svg"
+    xmlns:inkscape="http://www.inkscape.org/namespaces/inkscape">
+  <g id="l1" inkscape:groupmode="layer" inkscape:label="cs_layout">
+    <rect id="a"/>
+  </g>
+  <g id="l2" inkscape:groupmode="layer" inkscape:label="cs_layout x">
+    <rect id="a"/>
+  </g>
+</svg>"""
+
+class DocumentIndexTest(unittest.TestCase):
+    def setUp(self):
+        self.svg = countersheet.etree.fromstring(DOCUMENT)
+        self.index = countersheet.DocumentIndex(self.svg)
+
+    def test_first_with_id(self):
+        self.assertEqual(self.svg[0][0], self.index.find("a"))
+        self.assertEqual(2, len(self.index.find_all("a")))
+        self.assertEqual(None, self.index.find("b"))
+        self.assertEqual(1, self.index.misses)
+
+    def test_add_and_remove(self):
+        layer = self.svg[0]
+        self.svg.remove(layer)
+        self.index.remove(layer)
+        self.assertEqual(self.svg[0][0], self.index.find("a"))
+        self.assertEqual(None, self.index.find("l1"))
+        self.svg.append(layer)
+        self.index.add(layer)
+        self.assertEqual([self.svg[0], layer], self.index.layers)
+
+    def test_set_id(self):
+        rect = self.svg[0][0]
+        self.index.set_id(rect, "")
+        self.assertEqual("", rect.get("id"))
+        self.assertEqual([self.svg[1][0]], self.index.find_all("a"))
+
+class RefreshSignatureTest(unittest.TestCase):
+    def signature(self, *args):
+        effect = countersheet.CountersheetEffect()
+        effect.options = effect.arg_parser.parse_args(list(args))
+        effect.imagedir = "images"
+        counter = countersheet.Counter(countersheet.Repeat(1))
+        counter.addsubst("side", "a")
+        return effect.refresh_signature(counter, {}, 0)
+
+    def test_bleed_toggled(self):
+        self.assertEqual(self.signature("-B", "true"),
+                         self.signature("-B", "true"))
+        self.assertNotEqual(self.signature("-B", "true"),
+                            self.signature("-B", "false"))
+
+    def test_text_markup_toggled(self):
+        self.assertNotEqual(self.signature("-m", "true"),
+                            self.signature("-m", "false"))
+
+class TextMarkupTest(unittest.TestCase):
+    def tree(self, text):
+        return countersheet.TextMarkup(text).tree
+
+    def test_plain(self):
+        self.assertEqual(("text", "a b"), self.tree("a b"))
+
+    def test_bold_and_italics(self):
+        self.assertEqual(
+            ("style", ("text", "a "), "font-weight", "bold", "b",
+             ("text", "b"),
+             ("style", ("text", " "), "font-style", "italic", "i",
+              ("text", "c"), ("text", ""))),
+            self.tree("a *b* /c/"))
+
+    def test_unpaired_or_overlapping_marks(self):
+        self.assertEqual(("text", "a *b"), self.tree("a *b"))
+        self.assertEqual(("text", "*a /b* c/"), self.tree("*a /b* c/"))
+
+    def test_image(self):
+        self.assertEqual(
+            ("style", ("image", "a ", "x.png", ("text", " ")),
+             "font-weight", "bold", "b", ("text", "b"), ("text", "")),
+            self.tree("a {x.png} *b*"))
+        self.assertEqual(("text", "{} {a{"), self.tree("{} {a{"))
+
+class SetFormattedTextTest(unittest.TestCase):
+    def setUp(self):
+        self.effect = countersheet.CountersheetEffect()
+        self.effect.options = self.effect.arg_parser.parse_args([])
+        self.effect.textmarkup = True
+        self.effect.compactspans = False
+
+    def set_text(self, text):
+        element = countersheet.etree.Element(inkex.addNS("text", "svg"))
+        self.effect.setFormattedText(
+            element, "t", text, "tspan", {}, {})
+        return element
+
+    def test_plain_text_not_cached(self):
+        self.assertEqual("a b", self.set_text("a b").text)
+        self.assertEqual("a *b", self.set_text("a *b").text)
+        self.assertEqual({}, self.effect.markup)
+        self.assertEqual({}, self.effect.markupfragments)
+
+    def test_markup_cached(self):
+        element = self.set_text("a *b*")
+        self.assertEqual("a ", element.text)
+        self.assertEqual("b", element[0].text)
+        self.assertEqual(["a *b*"], list(self.effect.markup))
+        self.assertEqual(1, len(self.effect.markupfragments))
+
+    def test_cache_bounded(self):
+        for i in range(countersheet.MARKUP_CACHE_MAX_ENTRIES + 10):
+            self.set_text("*%d*" % i)
+        self.assertEqual(countersheet.MARKUP_CACHE_MAX_ENTRIES,
+                         len(self.effect.markup))
+        self.assertEqual(countersheet.MARKUP_CACHE_MAX_ENTRIES,
+                         len(self.effect.markupfragments))
+        self.assertNotIn("*0*", self.effect.markup)
+        self.assertIn("*%d*" % countersheet.MARKUP_CACHE_MAX_ENTRIES,
+                      self.effect.markup)
+
+class CompactSpansTest(unittest.TestCase):
+    def compact(self, xml, inherited, keep=()):
+        element = countersheet.etree.fromstring(xml)
+        keep = set(e for e in element.iter() if e.get("id") in keep)
+        countersheet.compact_spans(element, inherited, keep)
+        return countersheet.etree.tostring(element)
+
+    def test_inherited_style_left_out(self):
+        self.assertEqual(
+            b'<t>a <s style="font-weight:bold">b</s> c</t>',
+            self.compact('<t>a <s style="fill:red;font-weight:bold">b</s>'
+                         '<s style="fill:red"> c</s></t>',
+                         {"fill": "red"}))
+
+    def test_relative_values_kept(self):
+        self.assertEqual(
+            b'<t><s style="font-size:200%">a</s></t>',
+            self.compact('<t><s style="font-size:200%">a</s></t>',
+                         {"font-size": "200%"}))
+
+    def test_neighbours_joined_and_empty_removed(self):
+        self.assertEqual(
+            b'<t><s style="font-style:italic">ab</s>c</t>',
+            self.compact('<t><s style="font-style:italic">a</s>'
+                         '<s style="font-style:italic">b</s>'
+                         '<s style="font-style:italic"/>c</t>', {}))
+
+    def test_kept_spans(self):
+        self.assertEqual(
+            b'<t>a<s id="x" style="fill:red"/><s id="y">b</s></t>',
+            self.compact('<t>a<s id="x" style="fill:red"/><s id="y">b</s>'
+                         '</t>', {"fill": "red"}, ["x", "y"]))
+
+class ReplaceXmlTextTest(unittest.TestCase):
+    def test_text_tail_and_attributes(self):
+        g = countersheet.etree.fromstring(
+            '<g id="%a%" title="%b%-%a%"><t>%a% %c% %a</t>%b%%a%</g>')
+        countersheet.replace_xml_text(g.iter(), {"a": "1", "b": "2",
+                                                 "c": None, "d e": "3"})
+        self.assertEqual(
+            b'<g id="%a%" title="2-1"><t>1 %c% %a</t>21</g>',
+            countersheet.etree.tostring(g))
+
+    def test_later_names_in_values(self):
+        t = countersheet.etree.fromstring('<t>No. %number% %a%</t>')
+        countersheet.replace_xml_text(
+            [t], {"a": "%number%", "number": "%autonumber%",
+                  "autonumber": "7"})
+        self.assertEqual("No. 7 7", t.text)
+
+    def test_has_percent(self):
+        self.assertFalse(countersheet.has_percent(
+            countersheet.etree.fromstring('<t id="%a%">a</t>')))
+        self.assertTrue(countersheet.has_percent(
+            countersheet.etree.fromstring('<t style="a:100%">a</t>')))
+
 if __name__ == '__main__':
     unittest.main()
@@ -39,6 +39,38 @@ class CountersheetStyleTest(unittest.TestCase):
         self.assertEqual("a:x;a-b:2;",
                          countersheet.stylereplace(oldv, 'a', 'x'))
 
+class StyleCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.styles = countersheet.StyleCache()
+
+    def test_parse_once(self):
+        style = self.styles.parse("a:1;b:2")
+        self.assertEqual("2", style["b"])
+        self.assertTrue(style is self.styles.parse("a:1;b:2"))
+        self.assertEqual(0, len(self.styles.parse(None)))
+
+    def test_replace(self):
+        self.assertEqual("a:1;b:x;",
+                         self.styles.replace("a:1;b:2;", 'b', 'x'))
+        self.assertEqual("a:1;b:x;",
+                         self.styles.replace("a:1;b:2;", 'b', 'x'))
+        self.assertEqual("b:x;", self.styles.replace(None, 'b', 'x'))
+
+    def test_merge(self):
+        self.assertEqual("a:1;b:x;c:3",
+                         self.styles.merge("a:1;b:2", "b:x;c:3"))
+        self.assertEqual("c:3", self.styles.merge(None, "c:3"))
+
+    def test_bounded(self):
+        for i in range(countersheet.STYLE_CACHE_MAX_ENTRIES + 10):
+            self.styles.merge("a:%d" % i, "b:1")
+        self.assertEqual(countersheet.STYLE_CACHE_MAX_ENTRIES,
+                         len(self.styles.parsed))
+        self.assertEqual(countersheet.STYLE_CACHE_MAX_ENTRIES,
+                         len(self.styles.merged))
+        self.assertNotIn(("a:0", "b:1"), self.styles.merged)
+        self.assertEqual("a:0;b:1", self.styles.merge("a:0", "b:1"))
+
 if __name__ == '__main__':
     unittest.main()
 
@@ -136,6 +136,27 @@ class CSVCounterDefinitionParserTest(unittest.TestCase):
         counter = self.assert_get_counter(counters, 0)
         self.assertEqual({'e':'v'}, counter.subst)
 
+    def test_iterparse(self):
+        rows = [['', 'a'], ['1', 'x'], ['2', 'y'], ['ENDBOX'], ['3', 'z']]
+        counters = self.parser.iterparse(iter(rows))
+        first = next(counters)
+        self.assertEqual('x', first.subst['a'])
+        self.assertEqual(1, len(self.parser.counters))
+        second = next(counters)
+        self.assertEqual('y', second.subst['a'])
+        self.assertTrue(second.endbox)
+        third = next(counters)
+        self.assertEqual('z', third.subst['a'])
+        self.assertFalse(third.endbox)
+        self.assertEqual([], list(counters))
+        self.assertEqual([], self.parser.counters)
+
+    def test_iterparse_endrow_after_last(self):
+        counters = list(self.parser.iterparse([['', 'a'], ['1', 'x'],
+                                               ['ENDROW']]))
+        self.assertEqual(1, len(counters))
+        self.assertTrue(counters[0].endrow)
+
     def parse_to_counters(self, reader):
         self.parser.parse(reader)
         return self.parser.counters
@@ -2,9 +2,11 @@ class DummyDefs(object):
     def __init__(self):
         pass
 
-    def xpath(self, path, namespaces):
-        return []
+    def get(self, eid):
+        return None
 
-    def append(self, element):
-        pass
+    def linking_to(self, eid):
+        return None
 
+    def add(self, element):
+        pass
@@ -0,0 +1,122 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from lxml import etree
+import countersheet
+
+SVG = """<svg xmlns="http://www.w3.org/2000/svg">
+  <defs><linearGradient id="gradient"/></defs>
+  <g id="layer">
+    <rect id="a" style="fill:url(#gradient)"/>
+    <rect id="b"/>
+  </g>
+</svg>"""
+
+def dummy_logwrite(msg):
+    pass
+
+class ExportCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.svg = etree.fromstring(SVG)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def cache(self):
+        return countersheet.ExportCache(self.svg, "x", dummy_logwrite)
+
+    def element(self, element_id):
+        return self.svg.xpath("//*[@id='%s']" % element_id)[0]
+
+    def export(self, cache, element_id, kind="png"):
+        filename = os.path.join(self.directory, element_id + ".png")
+        digest = cache.digest(self.element(element_id), kind, None)
+        if cache.up_to_date(filename, kind, digest):
+            return False
+        with open(filename, "w") as f:
+            f.write(digest)
+        return True
+
+    def test_unchanged_not_exported_again(self):
+        cache = self.cache()
+        self.assertTrue(self.export(cache, "a"))
+        cache.save()
+        self.assertTrue(os.path.exists(os.path.join(
+            self.directory, "x" + countersheet.EXPORT_MANIFEST_NAME)))
+        cache = self.cache()
+        self.assertFalse(self.export(cache, "a"))
+        self.assertTrue(self.export(cache, "a", "png -w 10"))
+
+    def test_referenced_element_changed(self):
+        cache = self.cache()
+        self.export(cache, "a")
+        self.export(cache, "b")
+        cache.save()
+        self.element("gradient").set("x1", "1")
+        cache = self.cache()
+        self.assertTrue(self.export(cache, "a"))
+        self.assertFalse(self.export(cache, "b"))
+
+    def test_missing_file_exported(self):
+        cache = self.cache()
+        self.export(cache, "a")
+        cache.save()
+        os.remove(os.path.join(self.directory, "a.png"))
+        self.assertTrue(self.export(self.cache(), "a"))
+
+    def test_stale_files_removed(self):
+        cache = self.cache()
+        self.export(cache, "a")
+        self.export(cache, "b")
+        cache.save()
+        cache = self.cache()
+        self.export(cache, "a")
+        cache.save()
+        self.assertTrue(os.path.exists(os.path.join(self.directory, "a.png")))
+        self.assertFalse(os.path.exists(os.path.join(self.directory,
+                                                     "b.png")))
+
+    def test_other_kinds_not_stale(self):
+        cache = self.cache()
+        self.export(cache, "b", "pdf")
+        cache.save()
+        cache = self.cache()
+        self.export(cache, "a")
+        cache.save()
+        self.assertTrue(os.path.exists(os.path.join(self.directory,
+                                                    "b.png")))
+
+    def test_relative_image_resolved(self):
+        image = etree.SubElement(self.element("layer"),
+                                 "{http://www.w3.org/2000/svg}image",
+                                 id="i", href="i.png")
+        filename = os.path.join(self.directory, "i.png")
+        with open(filename, "w") as f:
+            f.write("1")
+        resolve = lambda href: os.path.join(self.directory, href)
+        cache = countersheet.ExportCache(self.svg, "x", dummy_logwrite,
+                                         resolve)
+        before = cache.digest(image, "png", None)
+        with open(filename, "w") as f:
+            f.write("22")
+        self.assertNotEqual(before, cache.digest(image, "png", None))
+
+    def test_xlink_href_preferred(self):
+        image = etree.SubElement(
+            self.element("layer"), "{http://www.w3.org/2000/svg}image",
+            {"{http://www.w3.org/1999/xlink}href": "i.png",
+             "href": "missing.png"})
+        with open(os.path.join(self.directory, "i.png"), "w") as f:
+            f.write("1")
+        resolve = lambda href: os.path.join(self.directory, href)
+        self.assertTrue(countersheet.image_file_stamp(image, resolve)
+                        .startswith(os.path.join(self.directory, "i.png")))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,52 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import os
+import unittest
+
+import inkex
+import countersheet
+
+class ExportPlanTest(unittest.TestCase):
+    def setUp(self):
+        self.effect = countersheet.CountersheetEffect()
+        self.effect.bitmapname = "x_"
+
+    def test_export_actions(self):
+        actions = self.effect.export_actions(
+            "c1", ["-w", 56, "-h", 40], "out", "png", False)
+        self.assertEqual([
+            "export-filename:%s" % os.path.abspath("out/x_c1.png"),
+            "export-id:c1",
+            "export-id-only",
+            "export-dpi:0",
+            "export-height:40",
+            "export-width:56",
+            "export-do"], actions)
+
+    def test_export_page_actions(self):
+        actions = self.effect.export_actions(
+            "cs_layer_0001", ["-d", 300], "pdf", "pdf", True)
+        self.assertTrue("export-area-page" in actions)
+        self.assertTrue("export-dpi:300" in actions)
+        self.assertTrue("export-width:0" in actions)
+        self.assertFalse("export-id-only" in actions)
+        self.assertFalse("export-id:cs_layer_0001" in actions)
+
+    def check_version(self, output, expected):
+        original = inkex.command.call
+        inkex.command.call = lambda *args: output
+        try:
+            self.assertEqual(expected, countersheet.inkscape_version())
+        finally:
+            inkex.command.call = original
+
+    def test_inkscape_version(self):
+        self.check_version("Inkscape 1.2.2 (b0a8486541, 2022-12-01)\n",
+                           (1, 2))
+        self.check_version("Inkscape 0.92.4 (5da689c313, 2019-01-14)",
+                           (0, 92))
+        self.check_version("something else", ())
+
+if __name__ == '__main__':
+    unittest.main()
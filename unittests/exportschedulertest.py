@@ -0,0 +1,70 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import os
+import tempfile
+import threading
+import unittest
+
+import countersheet
+
+class ExportSchedulerTest(unittest.TestCase):
+    def setUp(self):
+        self.log = []
+        self.done = []
+
+    def job(self, name):
+        self.done.append(name)
+
+    def failing_job(self):
+        raise RuntimeError("inkscape failed")
+
+    def test_one_worker_runs_jobs_at_once(self):
+        scheduler = countersheet.ExportScheduler(1, self.log.append)
+        scheduler.submit("a", self.job, "a")
+        self.assertEqual(["a"], self.done)
+        self.assertTrue(self.log[0].startswith("export job a: "))
+        scheduler.wait()
+
+    def test_parallel(self):
+        barrier = threading.Barrier(3, timeout=5)
+        scheduler = countersheet.ExportScheduler(3, self.log.append)
+        for name in "abc":
+            scheduler.submit(name, lambda n: (barrier.wait(),
+                                              self.job(n)), name)
+        scheduler.wait()
+        self.assertEqual(["a", "b", "c"], sorted(self.done))
+        self.assertEqual(4, len(self.log))
+
+    def test_failure_raised_after_all_jobs(self):
+        scheduler = countersheet.ExportScheduler(2, self.log.append)
+        scheduler.submit("fails", self.failing_job)
+        scheduler.submit("b", self.job, "b")
+        self.assertRaises(RuntimeError, scheduler.wait)
+        self.assertEqual(["b"], self.done)
+
+    def test_snapshots_removed(self):
+        fd, filename = tempfile.mkstemp(".svg")
+        os.close(fd)
+        scheduler = countersheet.ExportScheduler(2, self.log.append)
+        scheduler.add_snapshot(filename)
+        scheduler.submit("a", self.job, "a")
+        self.assertTrue(os.path.exists(filename))
+        scheduler.wait()
+        self.assertFalse(os.path.exists(filename))
+
+    def test_snapshot_removed_after_last_job(self):
+        fd, filename = tempfile.mkstemp(".svg")
+        os.close(fd)
+        scheduler = countersheet.ExportScheduler(1, self.log.append)
+        scheduler.add_snapshot(filename)
+        scheduler.submit("a", self.job, "a", snapshots=[filename])
+        self.assertTrue(os.path.exists(filename))
+        scheduler.submit("b", self.job, "b", snapshots=[filename])
+        scheduler.release_snapshot(filename)
+        self.assertFalse(os.path.exists(filename))
+        self.assertEqual(["a", "b"], self.done)
+        scheduler.wait()
+
+if __name__ == '__main__':
+    unittest.main()
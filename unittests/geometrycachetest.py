@@ -0,0 +1,81 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import countersheet
+
+def dummy_logwrite(msg):
+    pass
+
+class GeometryCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.cache = countersheet.GeometryCache(
+            os.path.join(self.directory, "cache"), dummy_logwrite, "")
+        self.svgfile = os.path.join(self.directory, "template.svg")
+        self.write_svg('<svg id="a"/>')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def write_svg(self, content):
+        with open(self.svgfile, "w") as f:
+            f.write(content)
+
+    def test_miss(self):
+        key = self.cache.key(self.svgfile, 1.0, 1.0)
+        self.assertEqual(None, self.cache.get(key))
+        self.assertEqual(0, self.cache.hits)
+        self.assertEqual(1, self.cache.misses)
+
+    def test_put_get(self):
+        key = self.cache.key(self.svgfile, 1.0, 1.0)
+        self.cache.put(key, {'r' : countersheet.Rectangle(1, 2, 3, 4)})
+        geometry = self.cache.get(key)
+        self.assertEqual(1, self.cache.hits)
+        r = geometry['r']
+        self.assertEqual((1, 2, 3, 4), (r.x, r.y, r.w, r.h))
+
+    def test_key_changes_with_content(self):
+        key = self.cache.key(self.svgfile, 1.0, 1.0)
+        self.write_svg('<svg id="b"/>')
+        self.assertNotEqual(key, self.cache.key(self.svgfile, 1.0, 1.0))
+
+    def test_key_changes_with_scale(self):
+        key = self.cache.key(self.svgfile, 1.0, 1.0)
+        self.assertNotEqual(key, self.cache.key(self.svgfile, 1.0, 2.0))
+
+    def font_cache(self):
+        return countersheet.GeometryCache(
+            os.path.join(self.directory, "cache"), dummy_logwrite,
+            countersheet.font_directories_stamp())
+
+    def test_key_changes_with_fonts(self):
+        fonts = os.path.join(self.directory, "fonts")
+        os.mkdir(fonts)
+        original = countersheet.FONT_DIRECTORIES
+        countersheet.FONT_DIRECTORIES = [fonts]
+        try:
+            cache = self.font_cache()
+            key = cache.key(self.svgfile, 1.0, 1.0)
+            os.mkdir(os.path.join(fonts, "new"))
+            os.utime(fonts, ns=(0, 0))
+            self.assertEqual(key, cache.key(self.svgfile, 1.0, 1.0))
+            self.assertNotEqual(
+                key, self.font_cache().key(self.svgfile, 1.0, 1.0))
+        finally:
+            countersheet.FONT_DIRECTORIES = original
+
+    def test_statistics(self):
+        key = self.cache.key(self.svgfile, 1.0, 1.0)
+        self.cache.get(key)
+        self.cache.log_statistics()
+        self.assertTrue(os.path.isfile(
+            os.path.join(self.directory, "cache", "stats.json")))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,60 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import fnmatch
+import unittest
+
+import countersheet
+
+GLOBS = ["name", "na*", "*", "n?me", "[nm]ame", "name", "x*", None, "*me"]
+
+IDS = ["name", "nam", "n", "", "mame", "xname", "x", "ame", "[name"]
+
+class GlobMatcherTest(unittest.TestCase):
+    def setUp(self):
+        self.matcher = countersheet.GlobMatcher(GLOBS)
+
+    def test_same_as_fnmatch(self):
+        for eid in IDS:
+            expected = [position for position, glob in enumerate(GLOBS)
+                        if glob is not None
+                        and fnmatch.fnmatchcase(eid, glob)]
+            self.assertEqual(expected, self.matcher.positions(eid), eid)
+
+    def test_literal(self):
+        self.assertEqual([0, 1, 2, 3, 4, 5, 8],
+                         self.matcher.positions("name"))
+
+    def test_prefix(self):
+        self.assertEqual([2, 6], self.matcher.positions("xyz"))
+
+    def test_no_globs(self):
+        self.assertEqual([], countersheet.GlobMatcher([]).positions("a"))
+
+    def test_remembered(self):
+        self.assertIs(self.matcher.positions("nam"),
+                      self.matcher.positions("nam"))
+
+    def test_shared(self):
+        self.assertIs(countersheet.glob_matcher(["a*", "b"]),
+                      countersheet.glob_matcher(("a*", "b")))
+        self.assertIsNot(countersheet.glob_matcher(["a*", "b"]),
+                         countersheet.glob_matcher(["b", "a*"]))
+
+    def test_bounded(self):
+        for n in range(countersheet.GLOB_MATCHER_MAX_FOUND + 10):
+            self.matcher.positions("id%d" % n)
+        self.assertEqual(countersheet.GLOB_MATCHER_MAX_FOUND,
+                         len(self.matcher.found))
+        for n in range(countersheet.GLOB_MATCHERS_MAX_ENTRIES + 10):
+            countersheet.glob_matcher(["g%d" % n])
+        self.assertEqual(countersheet.GLOB_MATCHERS_MAX_ENTRIES,
+                         len(countersheet.GLOB_MATCHERS))
+
+    def test_dict_keys(self):
+        matcher = countersheet.glob_matcher({"t*": 1, "u": 2})
+        self.assertEqual([0], matcher.positions("t1"))
+        self.assertEqual([1], matcher.positions("u"))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,86 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+import countersheet
+
+FAKE_SHELL = """
+import os, sys, time
+sys.stdout.write("Fake shell.\\n> ")
+sys.stdout.flush()
+for line in sys.stdin:
+    line = line.strip()
+    if line == "quit":
+        break
+    elif line == "hang":
+        time.sleep(60)
+    elif line == "crash":
+        sys.exit(1)
+    elif line.startswith("crashonce:"):
+        marker = line[len("crashonce:"):]
+        if not os.path.exists(marker):
+            open(marker, "w").close()
+            sys.exit(1)
+    else:
+        sys.stdout.write(line.upper() + "\\n")
+    sys.stdout.write("> ")
+    sys.stdout.flush()
+"""
+
+def dummy_logwrite(msg):
+    pass
+
+class InkscapeShellTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        script = os.path.join(self.directory, "fakeshell.py")
+        with open(script, "w") as f:
+            f.write(FAKE_SHELL)
+        self.command = [sys.executable, script]
+        self.shell = countersheet.InkscapeShell(
+            dummy_logwrite, self.command, 5)
+
+    def tearDown(self):
+        self.shell.close()
+        shutil.rmtree(self.directory)
+
+    def test_run(self):
+        self.assertEqual("A; B:C\n", self.shell.run(["a", "b:c"]))
+        self.assertEqual("D\n", self.shell.run(["d"]))
+
+    def test_crash_restarts(self):
+        self.assertRaises(countersheet.InkscapeShellError,
+                          self.shell.run, ["crash"])
+        self.assertEqual("A\n", self.shell.run(["a"]))
+
+    def test_timeout(self):
+        self.shell.timeout = 0.5
+        self.shell.start()
+        self.assertRaises(countersheet.InkscapeShellError,
+                          self.shell.run, ["hang"])
+        self.assertEqual(None, self.shell.process)
+
+    def test_no_separators_in_actions(self):
+        self.assertRaises(countersheet.InkscapeShellError,
+                          self.shell.run, ["export-filename:a;b.png"])
+
+    def test_pool_retries_once(self):
+        pool = countersheet.InkscapeShellPool(
+            2, dummy_logwrite, self.command, 5)
+        marker = os.path.join(self.directory, "crashed")
+        try:
+            self.assertEqual(["", "A\n"],
+                             pool.run([["crashonce:" + marker], ["a"]]))
+            self.assertRaises(countersheet.InkscapeShellError,
+                              pool.run, [["crash"]])
+            self.assertEqual(["B\n"], pool.run([["b"]]))
+        finally:
+            pool.close()
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,224 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import unittest
+from random import Random
+
+import countersheet
+
+def dummy_logwrite(msg):
+    pass
+
+def measure(counter, rotation):
+    return [40, 30]
+
+class LayoutPlannerTest(unittest.TestCase):
+    def setUp(self):
+        self.positions = [countersheet.Rectangle(10, 20, 100, 70),
+                          countersheet.Rectangle(10, 100, 100, 70)]
+        self.planner = countersheet.LayoutPlanner(
+            self.positions, 0, 200, 0, 0, measure, dummy_logwrite)
+
+    def counter(self, repeat):
+        return countersheet.Counter(repeat)
+
+    def plan(self, counters):
+        return list(self.planner.plan(counters))
+
+    def placements(self, steps):
+        return [s for s in steps if isinstance(s, countersheet.Placement)]
+
+    def test_fill_row_then_next_row(self):
+        steps = self.plan([self.counter(countersheet.RepeatExact(3))])
+        placements = self.placements(steps)
+        self.assertEqual([(10, 20), (50, 20), (10, 50)],
+                         [(p.x, p.y) for p in placements])
+        self.assertEqual([1, 2, 3], [p.nr for p in placements])
+        self.assertEqual([True, False, True],
+                         [p.bleed_left for p in placements])
+        self.assertEqual([True, True, False],
+                         [p.bleed_up for p in placements])
+
+    def test_boxes_and_sheets(self):
+        steps = self.plan([self.counter(countersheet.RepeatExact(9))])
+        kinds = [type(s).__name__ for s in steps]
+        self.assertEqual(["Placement"] * 4 + ["LayoutBox"]
+                         + ["Placement"] * 4 + ["LayoutBox", "LayoutSheet"]
+                         + ["Placement"], kinds)
+        box = steps[4]
+        self.assertEqual(set([0, 40, 80]), box.xmarks)
+        self.assertEqual(set([0, 30, 60]), box.ymarks)
+        self.assertEqual(2, self.planner.sheet)
+        self.assertEqual(0, self.planner.box)
+        self.assertEqual((2, 0), (steps[-1].sheet, steps[-1].box))
+
+    def test_endbox(self):
+        first = self.counter(countersheet.RepeatExact(1))
+        first.endbox = True
+        steps = self.plan([first, self.counter(countersheet.RepeatExact(1))])
+        self.assertTrue(isinstance(steps[1], countersheet.LayoutBox))
+        self.assertEqual(1, steps[2].box)
+        self.assertEqual(100, steps[2].y)
+
+    def test_fill_row(self):
+        counter = self.counter(countersheet.RepeatMinFillRow(1))
+        placements = self.placements(self.plan([counter]))
+        self.assertEqual(2, len(placements))
+
+    def test_backs(self):
+        counter = self.counter(countersheet.RepeatExact(2))
+        counter.doublesided()
+        counter.hasback = True
+        steps = self.plan([counter])
+        self.assertEqual([200 - 50, 200 - 90],
+                         [p.backx for p in self.planner.backs])
+        self.assertEqual({"id": None, "x": 150, "y": 20, "w": 40, "h": 30,
+                          "rotation": 0},
+                         steps[0].asdict()["back"])
+
+def measure_size(counter, rotation):
+    if rotation in (90, -90):
+        return [counter.height, counter.width]
+    return [counter.width, counter.height]
+
+class SkylinePlannerTest(unittest.TestCase):
+    def planner(self, turn=False, keep_order=False):
+        return countersheet.SkylinePlanner(
+            [countersheet.Rectangle(10, 20, 100, 70)], 0, 200, 0, 0,
+            measure_size, dummy_logwrite, None, turn, keep_order)
+
+    def counter(self, nr, width, height):
+        counter = countersheet.Counter(countersheet.RepeatExact(nr))
+        counter.width = width
+        counter.height = height
+        return counter
+
+    def placements(self, planner, counters):
+        return [s for s in planner.plan(counters)
+                if isinstance(s, countersheet.Placement)]
+
+    def spots(self, placements):
+        return [(p.x - 10, p.y - 20) for p in placements]
+
+    def test_fills_below_short_counters(self):
+        planner = self.planner()
+        placements = self.placements(planner, [
+            self.counter(1, 40, 40), self.counter(4, 30, 20)])
+        self.assertEqual([(0, 0), (40, 0), (70, 0), (40, 20), (70, 20)],
+                         self.spots(placements))
+        self.assertEqual([True, False, False, False, False],
+                         [p.bleed_left for p in placements])
+        self.assertEqual([True, True, True, False, False],
+                         [p.bleed_up for p in placements])
+        self.assertEqual(set([0, 40, 70, 100]), planner.xmarks)
+        self.assertEqual(set([0, 20, 40]), planner.ymarks)
+
+    def test_keep_order(self):
+        counters = lambda: [self.counter(1, 40, 20), self.counter(1, 40, 40),
+                            self.counter(1, 40, 20)]
+        placements = self.placements(self.planner(), counters())
+        self.assertEqual([(0, 0), (40, 0), (0, 20)], self.spots(placements))
+        placements = self.placements(self.planner(keep_order=True),
+                                     counters())
+        self.assertEqual([(0, 0), (40, 0), (40, 40)], self.spots(placements))
+
+    def test_turn(self):
+        counter = self.counter(3, 60, 30)
+        counter.doublesided()
+        counter.hasback = True
+        counter.back.width = 60
+        counter.back.height = 30
+        placements = self.placements(self.planner(turn=True), [counter])
+        self.assertEqual([(0, 0), (0, 30), (60, 0)], self.spots(placements))
+        self.assertEqual([0, 0, 90], [p.rotation for p in placements])
+        self.assertEqual([0, 0, -90], [p.backrotation for p in placements])
+        self.assertEqual((200 - 100, 30, 60),
+                         (placements[2].backx, placements[2].backwidth,
+                          placements[2].backheight))
+
+    def test_turned(self):
+        turned = countersheet.SkylinePlanner.turned
+        self.assertEqual([90, 180, -90, 0],
+                         [turned(r, 90) for r in [0, 90, 180, -90]])
+        self.assertEqual([-90, 0, 90, 180],
+                         [turned(r, -90) for r in [0, 90, 180, -90]])
+        self.assertEqual([135, -135, 0, 180],
+                         [turned(r, 90) for r in [45, 135, 270, -270]])
+
+    def test_next_box_and_sheet(self):
+        planner = self.planner()
+        steps = list(planner.plan([self.counter(3, 60, 60)]))
+        kinds = [type(s).__name__ for s in steps]
+        self.assertEqual(["Placement", "LayoutBox", "LayoutSheet",
+                          "Placement", "LayoutBox", "LayoutSheet",
+                          "Placement"], kinds)
+        self.assertEqual(3, planner.sheet)
+
+    def test_endrow(self):
+        first = self.counter(1, 30, 40)
+        first.endrow = True
+        placements = self.placements(self.planner(), [
+            first, self.counter(1, 30, 20)])
+        self.assertEqual([(0, 0), (0, 40)], self.spots(placements))
+
+    def test_fill_row(self):
+        counter = countersheet.Counter(countersheet.RepeatMinFillRow(1))
+        counter.width = 30
+        counter.height = 20
+        placements = self.placements(self.planner(), [counter])
+        self.assertEqual(3, len(placements))
+
+REPEATS = [countersheet.RepeatExact, countersheet.RepeatMinFillRow,
+           countersheet.RepeatMinFillBox, countersheet.RepeatMinFillSheet]
+
+class ArrayLayoutPlannerTest(unittest.TestCase):
+    def plan(self, planner_class, spacing, sizes):
+        random = Random(str(sizes))
+        positions = [countersheet.Rectangle(10, 20, 100.3, 70.1),
+                     countersheet.Rectangle(120, 20, 61.7, 90)]
+        planner = planner_class(
+            positions, spacing, 200, 0, 0, measure_size, dummy_logwrite)
+        counters = []
+        for i in range(30):
+            counter = countersheet.Counter(
+                random.choice(REPEATS)(random.randint(0, 12)))
+            counter.width, counter.height = random.choice(sizes)
+            counter.endrow = random.random() < 0.1
+            counter.hasback = random.random() < 0.3
+            if counter.hasback:
+                counter.doublesided()
+                counter.back.width = counter.width
+                counter.back.height = counter.height
+            counters.append(counter)
+        steps = []
+        for s in planner.plan(counters):
+            if isinstance(s, countersheet.Placement):
+                steps.append((s.nr, s.sheet, s.box, s.x, s.y, s.width,
+                              s.height, s.bleed_left, s.bleed_up, s.backx))
+            elif isinstance(s, countersheet.LayoutBox):
+                steps.append((s.sheet, s.box, sorted(s.xmarks),
+                              sorted(s.ymarks)))
+            else:
+                steps.append((s.number, len(s.backs)))
+        steps.append((planner.sheet, planner.box, planner.colx,
+                      planner.rowy, planner.nextrowy,
+                      sorted(planner.xmarks), sorted(planner.ymarks)))
+        return steps
+
+    def assertSamePlan(self, spacing, sizes):
+        self.assertEqual(
+            self.plan(countersheet.LayoutPlanner, spacing, sizes),
+            self.plan(countersheet.ArrayLayoutPlanner, spacing, sizes))
+
+    def test_same_size(self):
+        self.assertSamePlan(0, [(20, 15)])
+
+    def test_same_size_spacing(self):
+        self.assertSamePlan(1.1, [(17.3, 13.7)])
+
+    def test_mixed_sizes(self):
+        self.assertSamePlan(0.7, [(17.3, 13.7), (9.1, 31.9), (45, 20),
+                                  (120, 5.5)])
+
+if __name__ == '__main__':
+    unittest.main()
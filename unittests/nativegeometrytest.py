@@ -0,0 +1,71 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import unittest
+
+import inkex
+import countersheet
+
+def dummy_logwrite(msg):
+    pass
+
+SVG = b"""<svg xmlns="http://www.w3.org/2000/svg"
+     xmlns:xlink="http://www.w3.org/1999/xlink"
+     xmlns:inkscape="http://www.inkscape.org/namespaces/inkscape"
+     width="100mm" height="100mm" viewBox="0 0 100 100">
+  <g inkscape:groupmode="layer" id="layer" transform="translate(10,20)">
+    <g id="group" transform="translate(1.0000001,2)">
+      <rect id="plain" x="0" y="0" width="10" height="5"/>
+      <rect id="stroked" x="20" y="0" width="10" height="5"
+            style="stroke:#000;stroke-width:2"/>
+    </g>
+    <use id="clone" xlink:href="#plain" x="30" y="0"/>
+    <text id="text" x="0" y="0">Hello</text>
+  </g>
+</svg>"""
+
+class NativeGeometryTest(unittest.TestCase):
+    def setUp(self):
+        self.svg = inkex.load_svg(SVG).getroot()
+        self.fallbacks = 0
+        self.geometry = countersheet.NativeGeometry(
+            self.svg, self.fallback, dummy_logwrite)
+
+    def fallback(self):
+        self.fallbacks += 1
+        return {'text' : countersheet.Rectangle(1, 2, 3, 4)}
+
+    def check(self, element_id, expected):
+        r = self.geometry[element_id]
+        for actual, e in zip((r.x, r.y, r.w, r.h), expected):
+            self.assertAlmostEqual(e, actual, 4)
+
+    def test_rect_in_translated_groups(self):
+        self.check('plain', (11, 22, 10, 5))
+
+    def test_stroke(self):
+        self.check('stroked', (30, 21, 12, 7))
+
+    def test_group(self):
+        self.check('group', (11, 21, 31, 7))
+
+    def test_use(self):
+        self.check('clone', (40, 20, 10, 5))
+
+    def test_text_falls_back(self):
+        self.check('text', (1, 2, 3, 4))
+        self.geometry['text']
+        self.assertEqual(1, self.fallbacks)
+
+    def test_no_fallback_needed(self):
+        self.geometry['plain']
+        self.assertEqual(0, self.fallbacks)
+
+    def test_template_not_rewritten(self):
+        self.geometry['group']
+        group = self.svg.getElementById('group')
+        self.assertEqual('translate(1.0000001,2)',
+                         group.attrib.get('transform'))
+
+if __name__ == '__main__':
+    unittest.main()
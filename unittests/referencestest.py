@@ -0,0 +1,83 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import os
+import tempfile
+import unittest
+
+from lxml import etree
+import countersheet
+
+SVG = """<svg xmlns="http://www.w3.org/2000/svg"
+     xmlns:xlink="http://www.w3.org/1999/xlink">
+  <defs>
+    <linearGradient id="stops"/>
+    <linearGradient id="gradient" xlink:href="#stops"/>
+    <clipPath id="clip"><rect id="cliprect"/></clipPath>
+    <linearGradient id="unused"/>
+  </defs>
+  <g id="template"><rect id="original" style="fill:url(#gradient)"/></g>
+  <g id="counter" clip-path="url(#clip)">
+    <use id="clone" xlink:href="#original"/>
+    <rect id="inside"/>
+    <use id="insideclone" xlink:href="#inside"/>
+  </g>
+</svg>"""
+
+class ReferencesTest(unittest.TestCase):
+    def setUp(self):
+        self.svg = etree.fromstring(SVG)
+        self.counter = self.svg.xpath("//*[@id='counter']")[0]
+
+    def test_referenced_ids(self):
+        self.assertEqual(['clip', 'original', 'inside'],
+                         countersheet.referenced_ids(self.counter))
+
+    def test_find_referenced_elements(self):
+        found = countersheet.find_referenced_elements([self.counter],
+                                                      self.svg)
+        self.assertEqual(['clip', 'original', 'gradient', 'stops'],
+                         [e.get('id') for e in found])
+
+    def test_nothing_referenced(self):
+        template = self.svg.xpath("//*[@id='cliprect']")[0]
+        self.assertEqual([], countersheet.find_referenced_elements(
+            [template], self.svg))
+
+    def test_minimal_svg(self):
+        clone = self.svg.xpath("//*[@id='clone']")[0]
+        root = countersheet.make_minimal_svg(self.svg, [clone])
+        self.assertEqual(['defs', 'g'],
+                         [etree.QName(e).localname for e in root])
+        self.assertEqual(['clip', 'original', 'gradient', 'stops'],
+                         [e.get('id') for e in root[0]])
+        self.assertEqual('counter', root[1].get('id'))
+        self.assertEqual('url(#clip)', root[1].get('clip-path'))
+        self.assertEqual(['clone'], [e.get('id') for e in root[1]])
+        self.assertEqual(3, len(self.counter))
+
+    def test_minimal_svg_shares_ancestors(self):
+        elements = self.svg.xpath("//*[@id='clone' or @id='inside']")
+        root = countersheet.make_minimal_svg(self.svg, elements)
+        self.assertEqual(2, len(root))
+        self.assertEqual(['clone', 'inside'], [e.get('id') for e in root[1]])
+
+    def test_sheet_svg(self):
+        effect = countersheet.CountersheetEffect()
+        fd, filename = tempfile.mkstemp(".svg")
+        os.close(fd)
+        try:
+            effect.write_sheet_svg(self.svg, self.counter, filename)
+            root = etree.parse(filename).getroot()
+        finally:
+            os.remove(filename)
+        self.assertEqual(['defs', 'g'],
+                         [etree.QName(e).localname for e in root])
+        self.assertEqual(['clip', 'original', 'gradient', 'stops'],
+                         [e.get('id') for e in root[0]])
+        self.assertEqual(['clone', 'inside', 'insideclone'],
+                         [e.get('id') for e in root[1]])
+        self.assertEqual(self.svg, self.counter.getparent())
+
+if __name__ == '__main__':
+    unittest.main()
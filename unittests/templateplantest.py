@@ -0,0 +1,95 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import unittest
+
+from lxml import etree
+import countersheet
+
+SVG = """<svg xmlns="http://www.w3.org/2000/svg"
+     xmlns:inkscape="http://www.inkscape.org/namespaces/inkscape">
+  <g id="layer" inkscape:groupmode="layer">
+    <g id="template">
+      <rect id="r"/>
+      <flowRoot id="flow"><flowPara><flowSpan id="fs">a</flowSpan></flowPara></flowRoot>
+      <text id="t1">x</text>
+      <image id="img"/>
+      <g><text id="t2">%side%</text><use id="u"/></g>
+    </g>
+  </g>
+</svg>"""
+
+class TemplatePlanTest(unittest.TestCase):
+    def setUp(self):
+        self.svg = etree.fromstring(SVG)
+        self.group = self.svg.xpath("//*[@id='template']")[0]
+        self.plan = countersheet.TemplatePlan(
+            self.group, "r", True, countersheet.Rectangle(1, 2, 3, 4),
+            (-1, -2))
+
+    def ids(self, nodes, indices):
+        return [nodes[i].get("id") for i in indices]
+
+    def test_nodes_in_copy(self):
+        clone, nodes = self.plan.copy()
+        self.assertFalse(clone is self.group)
+        self.assertEqual(["t1", "t2", "fs", "flow"],
+                         self.ids(nodes, self.plan.textish))
+        self.assertEqual(["img"], self.ids(nodes, self.plan.images))
+        self.assertEqual(["u"], self.ids(nodes, self.plan.uses))
+        self.assertEqual("r", nodes[self.plan.killindex].get("id"))
+
+    def test_same_order_as_xpath(self):
+        clone, nodes = self.plan.copy()
+        xpath = [e for tag in ("text", "flowSpan", "flowRoot")
+                 for e in clone.xpath("//svg:%s" % tag,
+                                      namespaces=countersheet.NSS)]
+        self.assertEqual(xpath, [nodes[i] for i in self.plan.textish])
+
+    def test_keep_rect(self):
+        plan = countersheet.TemplatePlan(
+            self.group, "r", False, countersheet.Rectangle(1, 2, 3, 4),
+            (0, 0))
+        self.assertEqual(None, plan.killindex)
+        self.assertEqual(3, plan.width)
+
+    def test_depends_on(self):
+        self.assertTrue(self.plan.depends_on("t*"))
+        self.assertTrue(self.plan.depends_on("img"))
+        self.assertTrue(self.plan.depends_on("side"))
+        self.assertFalse(self.plan.depends_on("autonumber"))
+        self.assertFalse(self.plan.depends_on("x*"))
+
+    def test_digest_follows_template(self):
+        before = self.plan.digest()
+        self.svg.xpath("//*[@id='t1']")[0].text = "y"
+        plan = countersheet.TemplatePlan(
+            self.group, "r", True, countersheet.Rectangle(1, 2, 3, 4),
+            (-1, -2))
+        self.assertEqual(before, self.plan.digest())
+        self.assertNotEqual(before, plan.digest())
+
+    def counter(self, nr, side):
+        counter = countersheet.Counter(countersheet.Repeat(1))
+        counter.addpart("r")
+        counter.addsubst("autonumber", str(nr))
+        counter.addsubst("side", side)
+        return counter
+
+    def test_signature_without_unused_subst(self):
+        self.assertEqual(
+            countersheet.counter_signature(self.counter(1, "a"), [self.plan]),
+            countersheet.counter_signature(self.counter(2, "a"), [self.plan]))
+        self.assertNotEqual(
+            countersheet.counter_signature(self.counter(1, "a"), [self.plan]),
+            countersheet.counter_signature(self.counter(1, "b"), [self.plan]))
+
+    def test_signature_with_subst_in_value(self):
+        first = self.counter(1, "%autonumber%")
+        second = self.counter(2, "%autonumber%")
+        self.assertNotEqual(
+            countersheet.counter_signature(first, [self.plan]),
+            countersheet.counter_signature(second, [self.plan]))
+
+if __name__ == '__main__':
+    unittest.main()